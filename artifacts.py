@@ -0,0 +1,187 @@
+import logging
+import os
+import shutil
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Tuple
+
+from store import SqliteStore
+
+log = logging.getLogger(__name__)
+
+
+def default_roots() -> Dict[str, Tuple[Path, int]]:
+    """name -> (root dir, depth of entries under root)"""
+    return {
+        'downloads': (Path('/tmp/cprc/downloads'), 1),  # downloads/<video id>/
+        'coverted': (Path('/tmp/cprc/coverted'), 1),  # coverted/<hash>.flac
+    }
+
+
+def disk_size(path: Path) -> int:
+    if not path.is_dir():
+        return path.stat().st_size
+    size = 0
+    for dir_path, _, file_names in os.walk(path):
+        for file_name in file_names:
+            try:
+                size += os.stat(os.path.join(dir_path, file_name)).st_size
+            except FileNotFoundError:
+                pass
+    return size
+
+
+class ArtifactStore(SqliteStore):
+    """Keeps intermediate artifacts (downloads, converted audio) under byte budget.
+    Least recently used entries and entries older than max_age seconds are evicted first.
+    Entries pinned by in-flight tasks are never evicted, pins older than pin_timeout are considered stale.
+    Hits, misses and evicted bytes are counted in the same db, so counters are shared by all workers"""
+    schema = '''
+        CREATE TABLE IF NOT EXISTS entries (
+            path TEXT PRIMARY KEY,
+            root TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            last_used REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used);
+        CREATE TABLE IF NOT EXISTS pins (
+            path TEXT PRIMARY KEY,
+            count INTEGER NOT NULL,
+            updated REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS counters (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        );
+    '''
+
+    def __init__(self, path: Path = Path('/tmp/cprc/artifacts.sqlite'), roots: Dict[str, Tuple[Path, int]] = None,
+                 budget: int = None, max_age: float = None, pin_timeout: float = 6 * 3600,
+                 evict_interval: float = 60.0):
+        super().__init__(path)
+        self.roots = roots or default_roots()
+        self.budget = budget
+        self.max_age = max_age
+        self.pin_timeout = pin_timeout
+        self.evict_interval = evict_interval
+        self._last_evict = 0.0
+
+    def access(self, path: Path) -> bool:
+        """Register usage of entry. Returns True if entry exists (cache hit)"""
+        hit = path.exists()
+        self._count('hits' if hit else 'misses')
+        if hit:
+            self.touch(path)
+        return hit
+
+    def touch(self, path: Path) -> None:
+        """Mark entry as recently used, size is updated as entry could grow"""
+        root = self._root_name(path)
+        if root is None or not path.exists():
+            return
+        self.connection.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)',
+                                (str(path), root, disk_size(path), time.time()))
+
+    def pin(self, path: Path) -> None:
+        self.connection.execute(
+            '''INSERT INTO pins VALUES (?, 1, ?)
+               ON CONFLICT (path) DO UPDATE SET count = count + 1, updated = excluded.updated''',
+            (str(path), time.time()))
+
+    def unpin(self, path: Path) -> None:
+        with self.transaction() as connection:
+            connection.execute('UPDATE pins SET count = count - 1 WHERE path = ?', (str(path),))
+            connection.execute('DELETE FROM pins WHERE count <= 0')
+
+    def release(self, path: Path) -> None:
+        """Unpin entry after task finished using it"""
+        self.touch(path)
+        self.unpin(path)
+
+    @contextmanager
+    def use(self, path: Path):
+        self.pin(path)
+        try:
+            yield path
+        finally:
+            self.release(path)
+
+    def maybe_evict(self) -> None:
+        """Evict if evict_interval passed since last eviction"""
+        if time.monotonic() - self._last_evict > self.evict_interval:
+            self.evict()
+
+    def evict(self) -> None:
+        self._last_evict = time.monotonic()
+        self._scan()
+        now = time.time()
+        connection = self.connection
+        pinned = {path for path, in connection.execute('SELECT path FROM pins WHERE updated > ?',
+                                                       (now - self.pin_timeout,))}
+        used, = connection.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()
+        evicted_bytes = 0
+        evicted_entries = 0
+        for path, size, last_used in connection.execute('SELECT path, size, last_used FROM entries '
+                                                        'ORDER BY last_used').fetchall():
+            expired = self.max_age is not None and now - last_used > self.max_age
+            over_budget = self.budget is not None and used > self.budget
+            if not expired and not over_budget:
+                break
+            if path in pinned:
+                continue
+            self._remove(Path(path))
+            connection.execute('DELETE FROM entries WHERE path = ?', (path,))
+            used -= size
+            evicted_bytes += size
+            evicted_entries += 1
+        if evicted_entries:
+            self._count('bytes_evicted', evicted_bytes)
+            self._count('entries_evicted', evicted_entries)
+        log.info(f'Artifacts: {self.stats()}')
+
+    def stats(self) -> dict:
+        stats = dict(hits=0, misses=0, bytes_evicted=0, entries_evicted=0)
+        stats.update(self.connection.execute('SELECT name, value FROM counters'))
+        stats['bytes_used'], = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()
+        return stats
+
+    def _scan(self) -> None:
+        """Synchronize entries table with disk, unknown entries get their mtime as last usage time"""
+        on_disk = {}
+        for name, (root, depth) in self.roots.items():
+            if root.exists():
+                on_disk.update((str(path), name) for path in root.glob('/'.join(['*'] * depth))
+                               if '.part' not in path.suffixes)  # conversions in progress
+        with self.transaction() as connection:
+            known = {path for path, in connection.execute('SELECT path FROM entries')}
+            connection.executemany('DELETE FROM entries WHERE path = ?', ((path,) for path in known - on_disk.keys()))
+            for path in on_disk.keys() - known:
+                try:
+                    connection.execute('INSERT INTO entries VALUES (?, ?, ?, ?)',
+                                       (path, on_disk[path], disk_size(Path(path)), os.stat(path).st_mtime))
+                except FileNotFoundError:
+                    pass
+
+    def _root_name(self, path: Path):
+        for name, (root, depth) in self.roots.items():
+            try:
+                relative = path.relative_to(root)
+            except ValueError:
+                continue
+            if len(relative.parts) == depth:
+                return name
+        return None
+
+    def _count(self, name: str, value: int = 1) -> None:
+        self.connection.execute(
+            '''INSERT INTO counters VALUES (?, ?)
+               ON CONFLICT (name) DO UPDATE SET value = value + excluded.value''', (name, value))
+
+    @staticmethod
+    def _remove(path: Path) -> None:
+        log.info(f'Evicting {path}')
+        if path.is_dir():
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            path.unlink(missing_ok=True)
@@ -0,0 +1,262 @@
+"""Offline benchmark of dataset build pipeline.
+Generates synthetic audio with matching SRT captions, stubs EpisodeSource so nothing is downloaded,
+times single stages and end-to-end runs and compares throughput with stored baseline.
+Fails when there is no baseline, peak RSS is reported for the whole run.
+
+    python benchmark.py --episodes 4 --duration 600 --workers 1,2,4
+    python benchmark.py --save-baseline   # store current results as baseline
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Callable, Dict, List
+
+import numpy as np
+import soundfile
+
+import utils
+
+log = logging.getLogger(__name__)
+
+COLD_START_BUDGET = 0.5  # seconds of prepare.py startup for a no-op command
+
+WORDS = ('so', 'the', 'meeting', 'starts', 'now', 'we', 'will', 'discuss', 'budget', 'and', 'roads', 'council',
+         'motion', 'carried', 'thank', 'you', 'chair', 'next', 'item', 'please')
+
+
+def synthetic_audio(duration: float, samplerate: int = 16000, seed: int = 0) -> np.ndarray:
+    """Speech-like int16 audio: noise bursts modulated at syllable rate separated by pauses"""
+    rng = np.random.default_rng(seed)
+    n = int(duration * samplerate)
+    audio = rng.normal(0, 0.02, n)
+    position = 0
+    while position < n:
+        length = int(rng.uniform(0.5, 4.0) * samplerate)
+        t = np.arange(min(length, n - position)) / samplerate
+        envelope = 0.5 * (1 + np.sin(2 * np.pi * rng.uniform(3, 6) * t))
+        audio[position:position + len(t)] += rng.normal(0, 0.3, len(t)) * envelope
+        position += length + int(rng.uniform(0.1, 1.0) * samplerate)
+    return (np.clip(audio, -1, 1) * 32767).astype(np.int16)
+
+
+def srt_time(ms: int) -> str:
+    return f'{ms // 3600000:02d}:{ms // 60000 % 60:02d}:{ms // 1000 % 60:02d},{ms % 1000:03d}'
+
+
+def synthetic_srt(duration: float, seed: int = 0) -> str:
+    """Cues of 1-4 seconds with small gaps and random words, like auto generated captions"""
+    rng = random.Random(seed)
+    cues = []
+    start = 0
+    while start < duration * 1000 - 1000:
+        end = min(start + rng.randint(1000, 4000), int(duration * 1000))
+        text = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(2, 10)))
+        cues.append(f'{len(cues) + 1}\n{srt_time(start)} --> {srt_time(end)}\n{text}\n')
+        start = end + rng.randint(0, 500)
+    return '\n'.join(cues)
+
+
+def make_fixtures(root: Path, episodes: int, duration: float, audio_format: str = 'opus') -> Dict[str, tuple]:
+    """Writes audio and captions of synthetic episodes, returns video id -> (audio_path, captions_path).
+    opus audio is encoded with ffmpeg like real downloads, flac is written directly"""
+    fixtures = {}
+    for i in range(episodes):
+        ep_id = f'bench{i:06d}'
+        folder = root / ep_id
+        folder.mkdir(parents=True, exist_ok=True)
+        flac_path = folder / f'{ep_id}.flac'
+        captions_path = folder / f'{ep_id}.srt'
+        audio_path = folder / f'{ep_id}.{audio_format}'
+        if not audio_path.exists():
+            soundfile.write(str(flac_path), synthetic_audio(duration, seed=i), 16000, subtype='PCM_16')
+            if audio_format != 'flac':
+                utils.run(f'ffmpeg -y -loglevel error -i "{flac_path}" -c:a libopus -b:a 48k "{audio_path}"')
+                flac_path.unlink()
+        captions_path.write_text(synthetic_srt(duration, seed=i))
+        fixtures[ep_id] = (audio_path, captions_path)
+    return fixtures
+
+
+def stub_episodes(fixtures: Dict[str, tuple], duration: float) -> None:
+    """EpisodeSource returns fixtures instead of downloading. Patches are inherited by forked process workers"""
+    from episode import EpisodeSource, video_id
+    from episode_cache import episode_info
+
+    def cached(self, url, record=None):
+        audio_path, captions_path = fixtures[video_id(url)]
+        return episode_info(video_id(url), audio_path, captions_path, 251, '48kbps', int(duration), None)
+
+    EpisodeSource.cached = cached
+    EpisodeSource.preload = lambda self, urls: None
+
+
+def clear_converted(fixtures: Dict[str, tuple]) -> None:
+    for audio_path, _ in fixtures.values():
+        utils.converted_path(audio_path, '.flac').unlink(missing_ok=True)
+
+
+def measure(name: str, func: Callable, audio_seconds: float) -> dict:
+    """Wall and CPU time of func including child processes (ffmpeg), throughput in audio hours per CPU hour"""
+    before_self = resource.getrusage(resource.RUSAGE_SELF)
+    before_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start = time.perf_counter()
+    func()
+    wall = time.perf_counter() - start
+    after_self = resource.getrusage(resource.RUSAGE_SELF)
+    after_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu = sum(getattr(after, field) - getattr(before, field)
+              for before, after in ((before_self, after_self), (before_children, after_children))
+              for field in ('ru_utime', 'ru_stime'))
+    result = dict(name=name, wall=wall, cpu=cpu, audio_hours_per_cpu_hour=audio_seconds / max(cpu, 1e-9),
+                  realtime_factor=audio_seconds / max(wall, 1e-9))
+    log.info(f'{name}: wall {wall:.2f}s, cpu {cpu:.2f}s, {result["audio_hours_per_cpu_hour"]:.1f} audio h/CPU h, '
+             f'{result["realtime_factor"]:.1f}x realtime')
+    return result
+
+
+def peak_rss() -> dict:
+    """Peak RSS in MB of benchmark process and of its largest child process over the whole run.
+    ru_maxrss is never reset, so it can't be attributed to single stages run in one process"""
+    return dict(self=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+                children=resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024)
+
+
+def cold_start(commands=('fetch', 'convert', 'segment', 'pack', 'upload', 'run'), attempts: int = 3) -> dict:
+    """Best of attempts wall time of `prepare.py <command> --help` per command, nothing but argparse should run"""
+    prepare_path = Path(__file__).resolve().parent / 'prepare.py'
+    timings = {}
+    for command in commands:
+        best = float('inf')
+        for _ in range(attempts):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, str(prepare_path), command, '--help'], check=True,
+                           stdout=subprocess.DEVNULL)
+            best = min(best, time.perf_counter() - start)
+        timings[command] = best
+    log.info(f'Cold start: {", ".join(f"{c} {t:.2f}s" for c, t in timings.items())}')
+    return timings
+
+
+def run_benchmark(root: Path, episodes: int, duration: float, workers: List[int], executor: str,
+                  audio_format: str) -> List[dict]:
+    from segmenter import Segmenter
+    from subtitles import Subtitles
+    from youtube import YouTube
+    import planner
+
+    fixtures = make_fixtures(root / 'fixtures', episodes, duration, audio_format)
+    stub_episodes(fixtures, duration)
+    ep_id, (audio_path, captions_path) = next(iter(fixtures.items()))
+    url = f'https://www.youtube.com/watch?v={ep_id}'
+    dataset_path = root / 'playlist.txt'
+    dataset_path.write_text('\n'.join(f'https://www.youtube.com/watch?v={i}' for i in fixtures))
+    os.chdir(root)
+    results = []
+
+    def work(workers_count=1, dataset='youtube_bench'):
+        return YouTube(work_path=root / f'work_{dataset}', dataset_path=dataset_path, dataset=dataset,
+                       platform='cpu', workers=workers_count, executor=executor, dedup=False)
+
+    results.append(measure('subtitles', lambda: [Subtitles.from_srt(captions_path) for _ in range(10)],
+                           duration * 10))
+    clear_converted(fixtures)
+    converted = []
+    results.append(measure('convert', lambda: converted.append(utils.convert(audio_path, '.flac')), duration))
+
+    segments = planner.plan_segments(Subtitles.from_srt(captions_path))
+    output_audio_path = root / 'segment_output'
+    shutil.rmtree(output_audio_path, ignore_errors=True)
+    output_audio_path.mkdir(parents=True)
+    results.append(measure('segment', lambda: Segmenter(output_audio_path).write(converted[0], segments, []),
+                           duration))
+
+    single = work()
+    clear_converted(fixtures)
+    results.append(measure('process', lambda: single._process(url), duration))
+
+    for count in workers:
+        clear_converted(fixtures)
+        results.append(measure(f'run_{executor}_{count}', work(count, f'youtube_bench_{count}').run,
+                               duration * episodes))
+    return results
+
+
+def compare(results: List[dict], baseline: dict, tolerance: float) -> List[str]:
+    """Stages whose throughput dropped more than tolerance below baseline results"""
+    regressions = []
+    for result in results:
+        expected = baseline['results'].get(result['name'])
+        if expected is None:
+            continue
+        ratio = result['audio_hours_per_cpu_hour'] / expected['audio_hours_per_cpu_hour']
+        log.info(f'{result["name"]}: {ratio:.2f} of baseline throughput')
+        if ratio < 1 - tolerance:
+            regressions.append(f'{result["name"]} throughput {result["audio_hours_per_cpu_hour"]:.1f} < '
+                               f'baseline {expected["audio_hours_per_cpu_hour"]:.1f}')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmark of dataset build pipeline')
+    parser.add_argument('--root', type=str, default='/tmp/cprc/benchmark', help='Fixtures and outputs location')
+    parser.add_argument('--episodes', type=int, default=4, help='Number of synthetic episodes')
+    parser.add_argument('--duration', type=float, default=600, help='Duration of each episode in seconds')
+    parser.add_argument('--audio-format', type=str, default='opus', choices=('opus', 'flac'),
+                        help='Format of synthetic downloads, opus requires ffmpeg with libopus')
+    parser.add_argument('--workers', type=str, default='1,2,4', help='Comma separated worker counts of runs')
+    parser.add_argument('--executor', type=str, default='thread', choices=('thread', 'process', 'pipeline'))
+    parser.add_argument('--baseline', type=str, default='benchmark_baseline.json')
+    parser.add_argument('--save-baseline', action='store_true', help='Store results as new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Allowed throughput drop relative to baseline, 0.2 = 20%%')
+    parser.add_argument('--output', type=str, default=None, help='Write results json there')
+    parser.add_argument('--cold-start-budget', type=float, default=COLD_START_BUDGET,
+                        help='Max seconds of prepare.py startup for a no-op command')
+    params = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s|%(levelname)-4.4s|%(filename)-10.10s|%(message)s')
+    for name in ('segmenter', 'work_base', 'youtube', 'artifacts', 'transcript', 'planner', 'ingest', 'manifest'):
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+    baseline_path = Path(params.baseline).resolve()
+    config = dict(episodes=params.episodes, duration=params.duration, audio_format=params.audio_format,
+                  executor=params.executor, cpus=os.cpu_count())
+    root = Path(params.root)
+    root.mkdir(parents=True, exist_ok=True)
+    slow_starts = {c: t for c, t in cold_start().items() if t > params.cold_start_budget}
+    if slow_starts:
+        log.error(f'Cold start exceeds budget of {params.cold_start_budget}s: {slow_starts}')
+        sys.exit(1)
+    results = run_benchmark(root, params.episodes, params.duration, [int(w) for w in params.workers.split(',')],
+                            params.executor, params.audio_format)
+    rss = peak_rss()
+    log.info(f'Peak RSS of run: {rss["self"]:.0f} MB, largest child process {rss["children"]:.0f} MB')
+    if params.output:
+        Path(params.output).write_text(json.dumps(dict(results=results, peak_rss_mb=rss), indent=1))
+    if params.save_baseline:
+        baseline_path.write_text(json.dumps(dict(config=config, results={r['name']: r for r in results},
+                                                 peak_rss_mb=rss), indent=1))
+        log.info(f'Saved baseline {baseline_path}')
+        return
+    if not baseline_path.exists():
+        log.error(f'No baseline {baseline_path}, run with --save-baseline to store one')
+        sys.exit(1)
+    baseline = json.loads(baseline_path.read_text())
+    if baseline['config'] != config:
+        log.warning(f'Baseline was measured with {baseline["config"]}, now {config}')
+    regressions = compare(results, baseline, params.tolerance)
+    if regressions:
+        log.error('Performance regressions:\n' + '\n'.join(regressions))
+        sys.exit(1)
+    log.info('No regressions')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+import hashlib
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from collections import namedtuple
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+from store import SqliteStore
+from work_queue import worker_id
+
+log = logging.getLogger(__name__)
+
+content_entry = namedtuple('content_entry', 'item_key output_path lines')  # lines is None while being segmented
+
+_digests = {}
+_digests_lock = threading.Lock()
+
+
+def file_digest(path: Path, chunk_size: int = 2 ** 20) -> str:
+    """blake2b digest of file content, read in chunks. Memoized per process by path, size and mtime"""
+    stat = os.stat(path)
+    memo_key = (str(path), stat.st_size, stat.st_mtime_ns)
+    digest = _digests.get(memo_key)
+    if digest is None:
+        hasher = hashlib.blake2b(digest_size=16)
+        with open(path, 'rb') as fp:
+            for chunk in iter(lambda: fp.read(chunk_size), b''):
+                hasher.update(chunk)
+        digest = hasher.hexdigest()
+        with _digests_lock:
+            _digests[memo_key] = digest
+    return digest
+
+
+def worker_alive(worker: str) -> bool:
+    """False when worker is a process of this host which is gone, workers of other hosts are assumed alive"""
+    host, _, pid = worker.rpartition(':')
+    if host != socket.gethostname():
+        return True
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def params_digest(params: dict) -> str:
+    return hashlib.blake2b(json.dumps(params, sort_keys=True).encode(), digest_size=8).hexdigest()
+
+
+class ContentStore(SqliteStore):
+    """Transcript lines of segmented audio keyed by audio content digest and segmentation parameters,
+    shared by all runs, so identical audio under different urls is segmented once.
+    Item segmenting the content claims it first, entries without lines are claims in progress.
+    Claims of workers which are gone (killed runs) or older than claim_timeout are stale and taken over.
+    Counts reuses of each content for dedup stats"""
+    schema = '''
+        CREATE TABLE IF NOT EXISTS contents (
+            key TEXT PRIMARY KEY,
+            item_key TEXT NOT NULL,
+            output_path TEXT NOT NULL,
+            lines TEXT,
+            duration REAL NOT NULL DEFAULT 0,
+            reused INTEGER NOT NULL DEFAULT 0,
+            reused_duration REAL NOT NULL DEFAULT 0,
+            updated REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS contents_output_path ON contents (output_path);
+        CREATE TABLE IF NOT EXISTS claims (
+            key TEXT PRIMARY KEY,
+            worker TEXT NOT NULL
+        );
+    '''
+
+    def __init__(self, path: Path, claim_timeout: float = 3600.0):
+        super().__init__(path)
+        self.claim_timeout = claim_timeout
+
+    def claim(self, key: str, item_key: str, output_path: Path, force: bool = False) -> Optional[content_entry]:
+        """Returns None when content is claimed for item_key. Otherwise returns existing entry:
+        finished one (with lines) or claim of other item in progress (lines is None).
+        force claims content even if it is finished or claimed by other item"""
+        with self.transaction() as connection:
+            row = connection.execute('SELECT item_key, output_path, lines, updated FROM contents WHERE key = ?',
+                                     (key,)).fetchone()
+            if row is not None and not force:
+                other_key, other_output_path, lines, updated = row
+                if lines is not None:
+                    return content_entry(other_key, Path(other_output_path),
+                                         [tuple(fields) for fields in json.loads(lines)])
+                claimer = connection.execute('SELECT worker FROM claims WHERE key = ?', (key,)).fetchone()
+                if other_key != item_key and time.time() - updated < self.claim_timeout \
+                        and (claimer is None or worker_alive(claimer[0])):
+                    return content_entry(other_key, Path(other_output_path), None)
+            connection.execute(
+                '''INSERT INTO contents (key, item_key, output_path, lines, updated) VALUES (?, ?, ?, NULL, ?)
+                   ON CONFLICT (key) DO UPDATE SET item_key = excluded.item_key, output_path = excluded.output_path,
+                       lines = NULL, updated = excluded.updated''',
+                (key, item_key, str(output_path), time.time()))
+            connection.execute('INSERT OR REPLACE INTO claims VALUES (?, ?)', (key, worker_id()))
+        return None
+
+    def unclaim(self, key: str, item_key: str) -> None:
+        with self.transaction() as connection:
+            if connection.execute('DELETE FROM contents WHERE key = ? AND item_key = ? AND lines IS NULL',
+                                  (key, item_key)).rowcount:
+                connection.execute('DELETE FROM claims WHERE key = ?', (key,))
+
+    def put(self, key: str, item_key: str, output_path: Path, lines: List[Tuple[str, str]], duration: float) -> None:
+        with self.transaction() as connection:
+            connection.execute(
+                '''INSERT INTO contents (key, item_key, output_path, lines, duration, updated)
+                   VALUES (?, ?, ?, ?, ?, ?)
+                   ON CONFLICT (key) DO UPDATE SET item_key = excluded.item_key, output_path = excluded.output_path,
+                       lines = excluded.lines, duration = excluded.duration, updated = excluded.updated''',
+                (key, item_key, str(output_path), json.dumps([line[:2] for line in lines]), duration, time.time()))
+            connection.execute('DELETE FROM claims WHERE key = ?', (key,))
+
+    def reused(self, key: str, duration: float) -> None:
+        self.connection.execute('UPDATE contents SET reused = reused + 1, reused_duration = reused_duration + ? '
+                                'WHERE key = ?', (duration, key))
+
+    def forget(self, output_path: Path) -> None:
+        """Drops entries of samples in output_path, e.g. when output is rebuilt from scratch"""
+        with self.transaction() as connection:
+            connection.execute('DELETE FROM contents WHERE output_path = ?', (str(output_path),))
+            connection.execute('DELETE FROM claims WHERE key NOT IN (SELECT key FROM contents)')
+
+    def stats(self) -> dict:
+        contents, duration, reused, reused_duration = self.connection.execute(
+            'SELECT COUNT(*), TOTAL(duration), TOTAL(reused), TOTAL(reused_duration) FROM contents').fetchone()
+        return dict(contents=contents, duration=duration, reused=int(reused), reused_duration=reused_duration)
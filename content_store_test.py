@@ -0,0 +1,38 @@
+from pathlib import Path
+
+from content_store import ContentStore
+
+LINES = [('a.flac audio/a.flac 1.00 hi \n', 'hi\n')]
+
+
+def test_claim_put_and_reuse(tmp_path):
+    store = ContentStore(tmp_path / 'content.sqlite')
+    assert store.claim('k', 'first', tmp_path / 'ds') is None
+    # live claim of other item is in progress, the same item claims again
+    assert store.claim('k', 'second', tmp_path / 'ds') == ('first', tmp_path / 'ds', None)
+    assert store.claim('k', 'first', tmp_path / 'ds') is None
+    store.put('k', 'first', tmp_path / 'ds', LINES, 1000.0)
+    assert store.claim('k', 'second', tmp_path / 'other') == ('first', tmp_path / 'ds', LINES)
+    store.reused('k', 1000.0)
+    assert store.stats() == dict(contents=1, duration=1000.0, reused=1, reused_duration=1000.0)
+
+
+def test_stale_and_forced_claims(tmp_path):
+    store = ContentStore(tmp_path / 'content.sqlite', claim_timeout=0.0)
+    store.claim('k', 'first', tmp_path / 'ds')
+    assert store.claim('k', 'second', tmp_path / 'ds') is None  # timed out
+    store.put('k', 'second', tmp_path / 'ds', LINES, 1000.0)
+    assert store.claim('k', 'third', tmp_path / 'ds', force=True) is None
+    store.unclaim('k', 'third')
+    assert store.stats()['contents'] == 0
+
+
+def test_forget_output(tmp_path):
+    store = ContentStore(tmp_path / 'content.sqlite')
+    store.put('a', 'a', tmp_path / 'ds', LINES, 1000.0)
+    store.put('b', 'b', tmp_path / 'other', LINES, 1000.0)
+    store.claim('c', 'c', tmp_path / 'ds')
+    store.forget(tmp_path / 'ds')
+    assert store.claim('a', 'x', Path('/x')) is None and store.claim('c', 'x', Path('/x')) is None
+    assert store.claim('b', 'x', Path('/x')).lines == LINES
+    assert store.connection.execute('SELECT key FROM claims ORDER BY key').fetchall() == [('a',), ('c',)]
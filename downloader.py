@@ -0,0 +1,166 @@
+import json
+import logging
+import os
+import re
+import threading
+from contextlib import nullcontext
+from multiprocessing.dummy import Pool as ThreadPool
+from pathlib import Path
+from typing import Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+from throttle import Throttle, is_transient
+
+log = logging.getLogger(__name__)
+
+CONTENT_RANGE_RE = re.compile(r'bytes (\d+)-(\d+)/(\d+|\*)')
+
+
+class Downloader:
+    """Downloads large files as parallel byte ranges over pooled connections.
+    Data is written into preallocated <path>.part file, finished chunks are recorded in <path>.part.json,
+    so interrupted download continues from unfinished chunks. Files smaller than chunk_size,
+    or when server does not report size, are downloaded with single request.
+    With throttle given, every request waits for its slot and token, see throttle.Throttle.
+    Transient failures (throttling, timeouts, 5xx) are raised right away, finished chunks are kept for retry"""
+
+    def __init__(self, chunk_size: int = 8 * 1024 * 1024, parallelism: int = 4, attempts: int = 3,
+                 timeout: float = 30.0, throttle: Throttle = None):
+        self.chunk_size = chunk_size
+        self.parallelism = parallelism
+        self.attempts = attempts
+        self.timeout = timeout
+        self.throttle = throttle
+        self._session = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_session'] = None
+        return state
+
+    @property
+    def session(self) -> requests.Session:
+        """Shared session, its connection pool is reused by all chunks and downloads"""
+        if self._session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.parallelism * 4)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            self._session = session
+        return self._session
+
+    def _slot(self, kind: str):
+        return self.throttle.slot(kind) if self.throttle is not None else nullcontext()
+
+    def download(self, url: str, path: Path, size: Optional[int] = None) -> Path:
+        with metrics.timer('download'):
+            path = self._download(url, Path(path), size)
+        metrics.inc('bytes_total', path.stat().st_size, kind='download')
+        return path
+
+    def _download(self, url: str, path: Path, size: Optional[int]) -> Path:
+        size = size or self._size(url)
+        if not size or size <= self.chunk_size:
+            return self._download_whole(url, path, size)
+
+        part_path = path.with_name(f'{path.name}.part')
+        state_path = path.with_name(f'{path.name}.part.json')
+        done = self._load_state(state_path, size) if part_path.exists() and part_path.stat().st_size == size else set()
+        if not done:
+            with part_path.open('wb') as fp:
+                fp.truncate(size)
+
+        chunks = [offset for offset in range(0, size, self.chunk_size) if offset not in done]
+        log.info(f'Downloading {path.name}: {size} bytes, {len(chunks)} of {-(-size // self.chunk_size)} chunks left')
+        lock = threading.Lock()
+
+        def fetch(offset):
+            self._download_range(url, part_path, offset, min(offset + self.chunk_size, size) - 1, size)
+            with lock:
+                done.add(offset)
+                state_path.write_text(json.dumps(dict(size=size, chunk_size=self.chunk_size, done=sorted(done))))
+
+        with ThreadPool(self.parallelism) as pool:
+            pool.map(fetch, chunks, chunksize=1)
+
+        # preallocated part file has the right size anyway, completeness is known from finished chunks only
+        missing = [offset for offset in range(0, size, self.chunk_size) if offset not in done]
+        if missing:
+            raise IOError(f'{len(missing)} chunks of {path} are missing, first at {missing[0]}')
+        part_path.rename(path)
+        state_path.unlink()
+        return path
+
+    def _size(self, url: str) -> Optional[int]:
+        with self._slot('head'):
+            response = self.session.head(url, allow_redirects=True, timeout=self.timeout)
+            response.raise_for_status()
+        if response.headers.get('Accept-Ranges') != 'bytes':
+            return None
+        return int(response.headers.get('Content-Length', 0)) or None
+
+    def _load_state(self, state_path: Path, size: int) -> set:
+        try:
+            state = json.loads(state_path.read_text())
+        except (OSError, ValueError):
+            return set()
+        if state.get('size') != size or state.get('chunk_size') != self.chunk_size:
+            return set()
+        return set(state['done'])
+
+    def _download_range(self, url: str, part_path: Path, first: int, last: int, size: int) -> None:
+        """Downloads bytes first..last of size bytes file into part_path, checks that response is that range"""
+        for attempt in range(self.attempts):
+            try:
+                with self._slot('range'):
+                    response = self.session.get(url, headers={'Range': f'bytes={first}-{last}'},
+                                                timeout=self.timeout)
+                    response.raise_for_status()
+                content_range = CONTENT_RANGE_RE.fullmatch(response.headers.get('Content-Range', ''))
+                if response.status_code != 206 or content_range is None \
+                        or (int(content_range.group(1)), int(content_range.group(2))) != (first, last) \
+                        or content_range.group(3) not in ('*', str(size)) or len(response.content) != last - first + 1:
+                    raise IOError(f'Bad response to range {first}-{last}/{size}: {response.status_code}, '
+                                  f'Content-Range {response.headers.get("Content-Range")}, '
+                                  f'{len(response.content)} bytes')
+                fd = os.open(part_path, os.O_WRONLY)
+                try:
+                    os.pwrite(fd, response.content, first)
+                finally:
+                    os.close(fd)
+                return
+            except (requests.RequestException, IOError) as e:
+                # throttling and server errors are not retried right away, item is requeued with delay
+                if is_transient(e) or attempt == self.attempts - 1:
+                    raise
+                log.exception(f'Got exception while downloading range {first}-{last} of {part_path.name}')
+
+    def _download_whole(self, url: str, path: Path, size: Optional[int] = None) -> Path:
+        """Downloads file with single request, its length is checked against size, or Content-Length when size
+        is unknown, before it is renamed into place"""
+        tmp_path = path.with_name(f'{path.name}.part')
+        for attempt in range(self.attempts):
+            try:
+                with self._slot('whole'):
+                    response = self.session.get(url, stream=True, timeout=self.timeout)
+                    response.raise_for_status()
+                with response:
+                    expected = size or (None if 'Content-Encoding' in response.headers
+                                        else int(response.headers.get('Content-Length', 0)) or None)
+                    with tmp_path.open('wb') as fp:
+                        for chunk in response.iter_content(self.chunk_size):
+                            fp.write(chunk)
+                length = tmp_path.stat().st_size
+                if expected is not None and length != expected:
+                    raise IOError(f'Got {length} bytes of {path.name}, expected {expected}')
+                break
+            except (requests.RequestException, IOError) as e:
+                if is_transient(e) or attempt == self.attempts - 1:
+                    tmp_path.unlink(missing_ok=True)
+                    raise
+                log.exception(f'Got exception while downloading {path.name}')
+        tmp_path.rename(path)
+        return path
@@ -0,0 +1,189 @@
+import json
+import os
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import pytest
+import requests
+
+from downloader import Downloader
+from throttle import Requeue, Throttle
+from work_base import WorkBase
+
+DATA = os.urandom(10_000)
+CHUNK_SIZE = 1000
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self._respond(head=True)
+
+    def do_GET(self):
+        self._respond(head=False)
+
+    def _respond(self, head: bool):
+        server = self.server
+        match = re.match(r'bytes=(\d+)-(\d+)', self.headers.get('Range', ''))
+        first, last = (int(match.group(1)), int(match.group(2))) if match else (0, len(server.data) - 1)
+        with server.lock:
+            throttled = server.throttled > 0
+            server.throttled -= throttled
+            status = 429 if throttled else 404 if first in server.missing else 206
+            server.requests.append((self.command, first if match else None, status))
+            if server.shifted.get(first):
+                server.shifted[first] -= 1
+                first, last = first + 1, last + 1
+            if not match and server.truncated > 0 and not head:
+                server.truncated -= 1
+                last = len(server.data) // 2
+        if status != 206:
+            self.send_response(status)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = server.data[first:last + 1]
+        self.send_response(206 if match else 200)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(len(body)))
+        if match:
+            self.send_header('Content-Range', f'bytes {first}-{first + len(body) - 1}/{len(server.data)}')
+        self.end_headers()
+        if not head:
+            self.wfile.write(body)
+
+
+class RangeServer(ThreadingHTTPServer):
+    """Local stand-in of audio stream host. Answers next throttled requests with 429, ranges starting
+    at missing offsets with 404, next shifted[offset] requests of range at offset with range shifted by a byte,
+    next truncated requests of whole file with its first half"""
+    daemon_threads = True
+
+    def __init__(self, data: bytes = DATA):
+        super().__init__(('127.0.0.1', 0), RangeHandler)
+        self.data = data
+        self.throttled = 0
+        self.missing = set()
+        self.shifted = {}
+        self.truncated = 0
+        self.requests = []
+        self.lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.server_address[1]}/audio'
+
+    def ranges(self, status: int = None) -> list:
+        """Offsets of requested ranges, of ranges answered with status if it is given"""
+        return [first for command, first, answer in self.requests
+                if command == 'GET' and first is not None and status in (None, answer)]
+
+
+@pytest.fixture
+def server():
+    server = RangeServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_throttled_range_is_not_retried_right_away(server, tmp_path):
+    throttle = Throttle('download', max_concurrency=8, latency_tolerance=None, cooldown=0.0)
+    downloader = Downloader(chunk_size=CHUNK_SIZE, parallelism=1, throttle=throttle)
+    server.throttled = 1
+    with pytest.raises(requests.HTTPError) as error:
+        downloader.download(server.url, tmp_path / 'audio.webm', size=len(DATA))
+    assert error.value.response.status_code == 429
+    assert server.ranges() == list(range(0, len(DATA), CHUNK_SIZE))  # one request per chunk
+    assert throttle.limit < 8
+    downloader.download(server.url, tmp_path / 'audio.webm')
+    assert server.ranges()[10:] == [0]  # only throttled chunk is downloaded again
+    assert (tmp_path / 'audio.webm').read_bytes() == DATA
+
+
+def test_interrupted_download_resumes_missing_chunks(server, tmp_path):
+    downloader = Downloader(chunk_size=CHUNK_SIZE, parallelism=3, attempts=2)
+    path = tmp_path / 'audio.webm'
+    server.missing = {3000, 7000}
+    with pytest.raises(requests.HTTPError):
+        downloader.download(server.url, path)
+    assert not path.exists()
+    assert sorted(server.ranges(status=206)) == [offset for offset in range(0, len(DATA), CHUNK_SIZE)
+                                                 if offset not in server.missing]
+    server.missing = set()
+    requested = len(server.ranges())
+    downloader.download(server.url, path)
+    assert sorted(server.ranges()[requested:]) == [3000, 7000]
+    assert path.read_bytes() == DATA
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['audio.webm']
+
+
+def test_wrong_content_range_is_rejected(server, tmp_path):
+    downloader = Downloader(chunk_size=CHUNK_SIZE, parallelism=2, attempts=2)
+    path = tmp_path / 'audio.webm'
+    server.shifted = {5000: 2}
+    with pytest.raises(IOError, match='Bad response to range 5000-5999/10000'):
+        downloader.download(server.url, path)
+    assert not path.exists()
+    downloader.download(server.url, path)
+    assert path.read_bytes() == DATA
+
+
+def test_truncated_whole_download_is_retried(server, tmp_path):
+    downloader = Downloader(chunk_size=2 * len(DATA), attempts=2)
+    path = tmp_path / 'audio.webm'
+    server.truncated = 2
+    with pytest.raises(IOError, match=f'Got {len(DATA) // 2 + 1} bytes of audio.webm, expected {len(DATA)}'):
+        downloader.download(server.url, path, size=len(DATA))
+    assert sorted(p.name for p in tmp_path.iterdir()) == []
+    server.truncated = 1
+    downloader.download(server.url, path, size=len(DATA))
+    assert path.read_bytes() == DATA
+    assert [first for command, first, _ in server.requests if command == 'GET'] == [None] * 4
+
+
+def test_state_of_other_part_file_is_ignored(server, tmp_path):
+    downloader = Downloader(chunk_size=CHUNK_SIZE)
+    path = tmp_path / 'audio.webm'
+    (tmp_path / 'audio.webm.part').write_bytes(b'partial')
+    (tmp_path / 'audio.webm.part.json').write_text(json.dumps(dict(size=len(DATA), chunk_size=CHUNK_SIZE,
+                                                                   done=list(range(0, len(DATA), CHUNK_SIZE)))))
+    downloader.download(server.url, path)
+    assert path.read_bytes() == DATA
+
+
+class DownloadWork(WorkBase):
+    def __init__(self, *args, url: str, downloader: Downloader, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.url = url
+        self.downloader = downloader
+
+    def _files_generator(self):
+        yield from ['a', 'b', 'c']
+
+    def _fetch(self, name):
+        return self.downloader.download(self.url, self.work_path / f'{name}.webm'),
+
+    def _process(self, path: Path):
+        assert path.read_bytes() == DATA
+        return []
+
+
+def test_throttled_items_are_requeued(server, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    server.throttled = 12
+    throttle = Throttle('download', rate=100.0, max_concurrency=4, latency_tolerance=None)
+    work = DownloadWork(work_path=tmp_path, dataset_path=None, dataset='ds', platform='cpu', workers=3, dedup=False,
+                        requeue=Requeue(attempts=20, delay=0.01, max_delay=0.05), url=server.url,
+                        downloader=Downloader(chunk_size=CHUNK_SIZE, parallelism=2, throttle=throttle))
+    work.run()
+    assert work.manifest.stats()['done']['items'] == 3
+    assert server.throttled == 0
+    # each chunk is downloaded once, throttled ones are not retried by downloader but with the item
+    assert sorted(server.ranges(status=206)) == sorted(3 * list(range(0, len(DATA), CHUNK_SIZE)))
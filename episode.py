@@ -4,9 +4,17 @@ import pytube
 import os
 import logging
 import shutil
+import time
 from pathlib import Path
+from typing import Dict, Iterable, Optional
 
-import cache
+import ingest
+import metrics
+import throttle
+from downloader import Downloader
+from episode_cache import EpisodeCache, episode_info
+from resolver import best_audio, video_record
+from subtitles import Subtitles, parse_timed_text
 
 logging.getLogger('pytube').setLevel(logging.WARNING)
 log = logging.getLogger(__name__)
@@ -31,54 +39,192 @@ log = logging.getLogger(__name__)
 # print(response)
 
 
-class Episode:
+def video_id(url: str) -> str:
+    ep_id = ingest.video_id(url)
+    if ep_id is None:
+        raise ValueError(f'Not a video url {url}')
+    return ep_id
+
+
+def episode_folder(ep_id: str) -> Path:
+    return Path('/tmp/cprc/downloads') / ep_id
+
+
+def record_captions(record: video_record) -> pytube.CaptionQuery:
+    """Caption tracks of record as pytube builds them from player response, so they are keyed by the same codes:
+    vssId without leading dot, 'a.' prefixed language code for auto-generated tracks"""
+    return pytube.CaptionQuery([pytube.Caption(dict(baseUrl=c.url, name=dict(simpleText=c.name),
+                                                    languageCode=c.language_code,
+                                                    vssId=('a.' if c.kind == 'asr' else '.') + c.language_code))
+                                for c in record.captions])
+
+
+class EpisodeSource:
+    """Episodes of one dataset build: fetching configuration, metadata cache and cache hits preloaded for
+    the playlist. It is kept on the work object, so process workers get it pickled with the work whatever
+    the start method is. Preloaded hits and records resolved ahead are not pickled, as the work is pickled
+    for every task, workers look episodes up in metadata_cache one by one instead"""
+
+    def __init__(self, downloader: Downloader = None, metadata_throttle: throttle.Throttle = None,
+                 timed_text: bool = False, caption_languages: Iterable[str] = ('en', 'en-US', 'en-GB'),
+                 auto_captions: bool = False, metadata_cache: EpisodeCache = None):
+        """timed_text - fetch captions as timed text and keep parsed cues in metadata_cache, no SRT files
+        auto_captions - fall back to auto-generated tracks of caption_languages"""
+        self.downloader = downloader or Downloader()
+        self.metadata_throttle = metadata_throttle or throttle.Throttle('metadata', rate=5.0)
+        self.timed_text = timed_text
+        self.caption_languages = tuple(caption_languages)
+        self.auto_captions = auto_captions
+        self.metadata_cache = metadata_cache or EpisodeCache('/tmp/cprc/episodes.sqlite')
+        self.preloaded = {}
+        self.resolved = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['preloaded'] = {}
+        state['resolved'] = {}
+        return state
+
+    def preload(self, urls: Iterable[str]) -> None:
+        """Resolve cache hits for all urls with batched lookups before any work is scheduled"""
+        self.preloaded = self.metadata_cache.get_many(video_id(url) for url in urls)
+        log.info(f'Preloaded {len(self.preloaded)} cached episodes')
+
+    def keep(self, records: Dict[str, video_record]) -> None:
+        """Keeps records resolved ahead of processing, until they are taken for their episodes"""
+        now = time.monotonic()
+        self.resolved.update((ep_id, (now, record)) for ep_id, record in records.items())
+
+    def take(self, ep_id: str, max_age: float) -> Optional[video_record]:
+        """Kept record of episode, None if there is none or it is older than max_age seconds,
+        as stream urls of records expire"""
+        resolved, record = self.resolved.pop(ep_id, (None, None))
+        return record if resolved is not None and time.monotonic() - resolved < max_age else None
+
+    def cached(self, url, record: video_record = None) -> Optional[episode_info]:
+        """Returns cached episode info, None if episode is failed.
+        Transient failures (throttling, timeouts, 5xx) are raised and not cached, so the episode is retried later.
+        record - metadata resolved by resolver.MetadataResolver, pytube is used if it is not given"""
+        ep_id = video_id(url)
+        info = self.preloaded.get(ep_id) or self.metadata_cache.get(ep_id)
+        hit = info is not None and (info.error or (info.audio_path.exists() and (info.captions_path is None
+                                                                                  or info.captions_path.exists())))
+        metrics.inc('cache_total', cache='episode', result='hit' if hit else 'miss')
+        if not hit:
+            captions = None
+            try:
+                episode = Episode(url, record, self)
+                info, captions = episode.info(), episode.captions
+            except Exception as e:
+                if throttle.is_transient(e):
+                    log.warning(f'Got transient error while processing {url}: {e!r}')
+                    raise
+                log.exception(f'Got exception while processing {url}')
+                info = episode_info(ep_id, None, None, None, None, None, repr(e))
+            self.metadata_cache.put(info, captions)
+        return None if info.error else info
+
+    def subtitles(self, info: episode_info) -> Subtitles:
+        """Captions of cached episode, from SRT file or from timed text parsed into metadata_cache"""
+        if info.captions_path is not None:
+            return Subtitles.from_file(info.captions_path)
+        return Subtitles.from_bytes(self.metadata_cache.get_captions(info.video_id))
 
-    @classmethod
-    @cache.cache
-    def cached(cls, url):
-        try:
-            return cls(url)
-        except Exception:
-            log.exception(f'Got exception while processing {url}')
-            return None
 
-    def __init__(self, url):
+class Episode:
+    """Downloads audio and captions of one video with configuration of source"""
+
+    def __init__(self, url, record: video_record = None, source: EpisodeSource = None):
         self.url = url
-        self.video_info = self._video_info(self.url)
+        self.source = source or EpisodeSource()
+        self.video_id = video_id(url)
+        ep_folder = episode_folder(self.video_id)
+        ep_folder.mkdir(parents=True, exist_ok=True)
+
+        if record is not None and record.error:
+            raise Exception(f'Failed to resolve {self.url}: {record.error}')
+        audio = record and best_audio(record)
+        if audio is not None and audio.url:
+            try:
+                self._init_from_record(record, audio, ep_folder)
+            except Exception as e:
+                if throttle.status_code(e) != 403:
+                    raise
+                # signed urls of record expired, pytube resolves fresh ones
+                log.warning(f'Got HTTP 403 for resolved urls of {self.url}, resolving them with pytube')
+                self._init_from_pytube(ep_folder)
+        else:
+            self._init_from_pytube(ep_folder)
+
+    def _init_from_pytube(self, ep_folder):
+        with metrics.timer('metadata'):
+            self.video_info = self._video_info(self.url, self.source.metadata_throttle)
 
         filtered_audios = self.video_info.streams.filter(only_audio=True, audio_codec="opus").order_by('abr').desc()
         if not filtered_audios:
             raise Exception(f'Video has no opus audio streams {self.url}')
-        self.audio_info = filtered_audios[0]
-
-        self.captions_info = self._get_captions(self.video_info)
-        _, _, ep_name = self.url.partition('=')
-
-        ep_folder = Path('/tmp/cprc/downloads') / ep_name
-        ep_folder.mkdir(parents=True, exist_ok=True)
-
-        self.captions_path = self.captions_info.download(title=ep_name, output_path=ep_folder)
-        self.audio_path = self.audio_info.download(filename=ep_name, output_path=ep_folder)
+        audio_info = filtered_audios[0]
+        self.itag, self.abr, self.duration = audio_info.itag, audio_info.abr, self.video_info.length
+
+        captions_info = self._get_captions(self.video_info.captions)
+        self._fetch_captions(captions_info, ep_folder)
+        self.audio_path = ep_folder / f'{self.video_id}.{audio_info.subtype}'
+        self.source.downloader.download(audio_info.url, self.audio_path, size=audio_info.filesize)
+
+    def _init_from_record(self, record: video_record, audio, ep_folder):
+        """Metadata is already resolved, only captions and audio are downloaded"""
+        self.itag, self.abr, self.duration = audio.itag, audio.abr, record.duration
+
+        captions_info = self._get_captions(record_captions(record))
+        self._fetch_captions(captions_info, ep_folder)
+        self.audio_path = ep_folder / f'{self.video_id}.{audio.mime_type.split("/")[-1]}'
+        self.source.downloader.download(audio.url, self.audio_path, size=audio.filesize)
+
+    def _fetch_captions(self, captions_info, ep_folder) -> None:
+        """Downloads captions into SRT file at captions_path or, with timed_text, fetches them as json3
+        timed text and keeps parsed cues in captions"""
+        self.captions_path, self.captions = None, None
+        downloader = self.source.downloader
+        with metrics.timer('captions'), self.source.metadata_throttle.slot('captions'):
+            if not self.source.timed_text:
+                self.captions_path = captions_info.download(title=self.video_id, output_path=ep_folder)
+                return
+            response = downloader.session.get(f'{captions_info.url}&fmt=json3', timeout=downloader.timeout)
+            response.raise_for_status()
+        self.captions = parse_timed_text(response.text).to_bytes()
+
+    def info(self) -> episode_info:
+        return episode_info(video_id=self.video_id, audio_path=Path(self.audio_path),
+                            captions_path=self.captions_path and Path(self.captions_path), itag=self.itag,
+                            abr=self.abr, duration=self.duration, error=None)
 
     @staticmethod
-    def _video_info(url, attempts=3):
-        """Loading info with several attempts"""
+    def _video_info(url, metadata_throttle: throttle.Throttle, attempts=3):
+        """Loading info with several attempts. Transient errors are not retried right away, they are raised
+        and the item is requeued with delay"""
         for i in range(attempts):
             try:
                 log.info(f"Getting info for: {url}")
-                return YouTube(url)
-            except Exception:
+                with metadata_throttle.slot('watch'):
+                    return YouTube(url)
+            except Exception as e:
                 log.exception(f'Got exception while loading {url}')
-                if i == attempts - 1:
+                if throttle.is_transient(e) or i == attempts - 1:
                     raise
 
-    def _get_captions(self, video):
-        log.info(video.captions)
-        for lang in ('en', 'en-US', 'en-GB'):
-            captions = video.captions.get(lang)
+    def _get_captions(self, all_captions):
+        """First of caption_languages tracks, then auto-generated one if auto_captions is set.
+        Tracks are picked from already fetched track list, so fallback costs no requests"""
+        log.info(all_captions)
+        languages = self.source.caption_languages
+        codes = list(languages)
+        if self.source.auto_captions:
+            codes += [f'a.{lang}' for lang in languages]
+        for code in codes:
+            captions = all_captions.get(code)
             if captions is not None:
                 return captions
-        raise Exception(f"Lack of en subtitles. Url:{self.url}")
+        raise Exception(f"Lack of {'/'.join(languages)} subtitles. Url:{self.url}")
 
 
 if __name__ == '__main__':
@@ -88,5 +234,6 @@ if __name__ == '__main__':
                         format='%(asctime)s.%(msecs)03d|%(levelname)-4.4s|%(thread)-6.6s|%(funcName)-10.10s|%(message)s',
                         handlers=[logging.StreamHandler()])
 
-    print(Episode.cached('https://www.youtube.com/watch?v=UiEaWkf3r9A'))
-    print(Episode.cached('https://www.youtube.com/watch?v=GniyQkgGlUA'))
\ No newline at end of file
+    source = EpisodeSource()
+    print(source.cached('https://www.youtube.com/watch?v=UiEaWkf3r9A'))
+    print(source.cached('https://www.youtube.com/watch?v=GniyQkgGlUA'))
\ No newline at end of file
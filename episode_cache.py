@@ -0,0 +1,67 @@
+import logging
+import time
+from collections import namedtuple
+from pathlib import Path
+from typing import Dict, Iterable, Optional
+
+from store import SqliteStore
+
+log = logging.getLogger(__name__)
+
+episode_info = namedtuple('episode_info', 'video_id audio_path captions_path itag abr duration error')
+
+
+class EpisodeCache(SqliteStore):
+    """Episode metadata keyed by video id.
+    Holds only what pipeline uses, failed episodes are stored with error reason.
+    Captions fetched as timed text are kept here in Subtitles.to_bytes form, such episodes have no captions_path.
+    They are in separate table, so metadata lookups do not load them"""
+    schema = '''
+        CREATE TABLE IF NOT EXISTS episodes (
+            video_id TEXT PRIMARY KEY,
+            audio_path TEXT,
+            captions_path TEXT,
+            itag INTEGER,
+            abr TEXT,
+            duration REAL,
+            error TEXT,
+            updated REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS captions (
+            video_id TEXT PRIMARY KEY,
+            data BLOB NOT NULL
+        );
+    '''
+    batch_size = 500  # keeps number of sqlite variables under the limit
+
+    def get(self, video_id: str) -> Optional[episode_info]:
+        return self.get_many([video_id]).get(video_id)
+
+    def get_many(self, video_ids: Iterable[str]) -> Dict[str, episode_info]:
+        video_ids = list(video_ids)
+        result = {}
+        for i in range(0, len(video_ids), self.batch_size):
+            batch = video_ids[i:i + self.batch_size]
+            cursor = self.connection.execute(
+                f'''SELECT video_id, audio_path, captions_path, itag, abr, duration, error FROM episodes
+                    WHERE video_id IN ({', '.join('?' * len(batch))})''', batch)
+            for row in cursor:
+                info = episode_info(*row)
+                result[info.video_id] = info._replace(
+                    audio_path=info.audio_path and Path(info.audio_path),
+                    captions_path=info.captions_path and Path(info.captions_path))
+        return result
+
+    def get_captions(self, video_id: str) -> Optional[bytes]:
+        row = self.connection.execute('SELECT data FROM captions WHERE video_id = ?', (video_id,)).fetchone()
+        return row and row[0]
+
+    def put(self, info: episode_info, captions: bytes = None) -> None:
+        with self.transaction() as connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO episodes VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (info.video_id, info.audio_path and str(info.audio_path),
+                 info.captions_path and str(info.captions_path),
+                 info.itag, info.abr, info.duration, info.error, time.time()))
+            if captions is not None:
+                connection.execute('INSERT OR REPLACE INTO captions VALUES (?, ?)', (info.video_id, captions))
@@ -0,0 +1,127 @@
+import json
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+pytube = pytest.importorskip('pytube')
+
+import episode
+from downloader import Downloader
+from episode import EpisodeSource, record_captions
+from episode_cache import EpisodeCache
+from resolver import caption_record, stream_record, video_record
+from subtitles import line
+
+AUDIO = os.urandom(5000)
+URL = 'https://www.youtube.com/watch?v=abcdefghijk'
+
+
+def timed_text(text: str) -> str:
+    return json.dumps({'events': [{'tStartMs': 0, 'dDurationMs': 1500, 'segs': [{'utf8': text}]},
+                                  {'tStartMs': 2000, 'dDurationMs': 500, 'segs': [{'utf8': 'end'}]}]})
+
+
+class EpisodeHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {name: values[0] for name, values in parse_qs(url.query).items()}
+        self.server.requests.append((url.path, query))
+        if url.path == '/audio':
+            body = AUDIO
+        elif url.path == '/captions' and query.get('fmt') == 'json3':
+            body = timed_text(f'track {query["lang"]}').encode()
+        else:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class EpisodeServer(ThreadingHTTPServer):
+    """Local stand-in of audio stream and timed text hosts, captions are served in json3 format only"""
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), EpisodeHandler)
+        self.requests = []
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+
+@pytest.fixture
+def server():
+    server = EpisodeServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def folders(tmp_path, monkeypatch):
+    monkeypatch.setattr(episode, 'episode_folder', lambda ep_id: tmp_path / 'downloads' / ep_id)
+    return tmp_path
+
+
+def record(url: str, *captions: tuple) -> video_record:
+    return video_record('abcdefghijk', 12.0, [stream_record(251, 'audio/webm', 'opus', '160kbps', len(AUDIO),
+                                                            f'{url}/audio')],
+                        [caption_record(code, name, kind, f'{url}/captions?lang={kind or ""}{code}')
+                         for code, name, kind in captions], None)
+
+
+def source(root, **kwargs) -> EpisodeSource:
+    return EpisodeSource(downloader=Downloader(), metadata_cache=EpisodeCache(root / 'episodes.sqlite'), **kwargs)
+
+
+def test_record_captions_are_keyed_like_pytube_captions():
+    tracks = [dict(baseUrl='https://host/de', name=dict(simpleText='German'), languageCode='de', vssId='.de'),
+              dict(baseUrl='https://host/en', name=dict(simpleText='English (auto-generated)'), languageCode='en',
+                   vssId='a.en', kind='asr')]
+    captions = record_captions(record('https://host', ('de', 'German', None),
+                                      ('en', 'English (auto-generated)', 'asr')))
+    # pytube builds captions of video info from player response tracks like these
+    pytube_captions = pytube.CaptionQuery([pytube.Caption(track) for track in tracks])
+    assert list(captions.lang_code_index) == list(pytube_captions.lang_code_index) == ['de', 'a.en']
+    assert captions.get('a.en').url == 'https://host/captions?lang=asren' and captions.get('de').name == 'German'
+
+
+@pytest.mark.parametrize('auto_captions', [False, True])
+def test_manual_captions_are_preferred(server, folders, auto_captions):
+    episodes = source(folders, timed_text=True, caption_languages=('en',), auto_captions=auto_captions)
+    info = episodes.cached(URL, record(server.url, ('en', 'English (auto-generated)', 'asr'),
+                                       ('en', 'English', None)))
+    assert episodes.subtitles(info).lines == [line(0, 1500, 1500, 'track en'), line(2000, 2500, 500, 'end')]
+
+
+def test_auto_captions_from_record(server, folders):
+    episodes = source(folders, timed_text=True, caption_languages=('en-US', 'en'), auto_captions=True)
+    info = episodes.cached(URL, record(server.url, ('de', 'German', None), ('en', 'English (auto-generated)', 'asr')))
+    assert info.captions_path is None and info.duration == 12.0 and info.itag == 251
+    assert info.audio_path == folders / 'downloads' / 'abcdefghijk' / 'abcdefghijk.webm'
+    assert info.audio_path.read_bytes() == AUDIO
+    # captions are fetched as json3 timed text, parsed cues are kept in episode cache
+    assert ('/captions', dict(lang='asren', fmt='json3')) in server.requests
+    assert episodes.subtitles(info).lines == [line(0, 1500, 1500, 'track asren'), line(2000, 2500, 500, 'end')]
+    assert source(folders).subtitles(info).lines == episodes.subtitles(info).lines
+
+
+def test_auto_captions_are_not_taken_unless_enabled(server, folders):
+    episodes = source(folders, timed_text=True, caption_languages=('en',))
+    assert episodes.cached(URL, record(server.url, ('en', 'English (auto-generated)', 'asr'))) is None
+    info = episodes.metadata_cache.get('abcdefghijk')
+    assert 'Lack of en subtitles' in info.error
+    assert not [path for path, _ in server.requests if path == '/captions']
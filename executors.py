@@ -0,0 +1,109 @@
+import logging
+import os
+import queue
+from abc import ABC, abstractmethod
+from multiprocessing import Pool
+from multiprocessing.dummy import Pool as ThreadPool
+from typing import Callable, Iterable, Iterator
+
+from throttle import deferred
+
+log = logging.getLogger(__name__)
+
+EXECUTORS = ('thread', 'process', 'pipeline')
+
+
+def bounded_imap_unordered(pool, func: Callable, items: Iterable, limit: int) -> Iterator:
+    """Like pool.imap_unordered, but keeps at most limit tasks submitted and not yet consumed.
+    Items are pulled from items lazily, only when there is a free slot"""
+    done = queue.Queue()
+    items = iter(items)
+    pending = 0
+    exhausted = False
+    while True:
+        while not exhausted and pending < limit:
+            try:
+                item = next(items)
+            except StopIteration:
+                exhausted = True
+                break
+            pool.apply_async(func, (item,), callback=done.put, error_callback=done.put)
+            pending += 1
+        if not pending:
+            return
+        result = done.get()
+        pending -= 1
+        if isinstance(result, BaseException):
+            raise result
+        yield result
+
+
+class Executor(ABC):
+    """Runs work items and yields their results in completion order"""
+
+    @abstractmethod
+    def imap_unordered(self, work, items: Iterable[tuple]) -> Iterator[list]:
+        """work is WorkBase instance, items are argument tuples for work.process"""
+        raise NotImplementedError()
+
+
+class ThreadExecutor(Executor):
+    """All stages run in threads of single process. Good for I/O bound work"""
+    pool_class = staticmethod(ThreadPool)
+
+    def __init__(self, workers: int = os.cpu_count(), max_inflight: int = None):
+        self.workers = workers
+        self.max_inflight = max_inflight or 2 * workers
+
+    def imap_unordered(self, work, items):
+        with self.pool_class(self.workers) as pool:
+            yield from bounded_imap_unordered(pool, work.run_item, items, limit=self.max_inflight)
+
+
+class ProcessExecutor(ThreadExecutor):
+    """All stages run in worker processes. Good for CPU bound work"""
+    pool_class = staticmethod(Pool)
+
+
+class PipelineExecutor(Executor):
+    """I/O bound fetch stage (metadata + download) runs in io_workers threads and feeds
+    CPU bound process stage (convert + segment + encode) running in cpu_workers processes.
+    At most max_inflight items are being fetched and at most queue_size fetched items
+    are waiting for or being processed by CPU stage"""
+
+    def __init__(self, io_workers: int = 4 * os.cpu_count(), cpu_workers: int = os.cpu_count(), queue_size: int = None,
+                 max_inflight: int = None):
+        self.io_workers = io_workers
+        self.cpu_workers = cpu_workers
+        self.queue_size = queue_size or 2 * cpu_workers
+        self.max_inflight = max_inflight or 2 * io_workers
+
+    def imap_unordered(self, work, items):
+        deferred_items = []  # results too, see WorkBase.fetch
+
+        def processable(fetched):
+            for item in fetched:
+                if isinstance(item, deferred):
+                    deferred_items.append(item)
+                elif item is not None:
+                    yield item
+
+        with ThreadPool(self.io_workers) as io_pool, Pool(self.cpu_workers) as cpu_pool:
+            fetched = processable(bounded_imap_unordered(io_pool, work.fetch, items, limit=self.max_inflight))
+            for result in bounded_imap_unordered(cpu_pool, work.process_item, fetched, limit=self.queue_size):
+                yield result
+                while deferred_items:
+                    yield deferred_items.pop()
+            yield from deferred_items
+
+
+def create(name: str, workers: int = os.cpu_count(), io_workers: int = None, cpu_workers: int = None,
+           max_inflight: int = None) -> Executor:
+    if name == 'thread':
+        return ThreadExecutor(workers, max_inflight=max_inflight)
+    if name == 'process':
+        return ProcessExecutor(workers, max_inflight=max_inflight)
+    if name == 'pipeline':
+        return PipelineExecutor(io_workers=io_workers or 4 * workers, cpu_workers=cpu_workers or workers,
+                                max_inflight=max_inflight)
+    raise ValueError(f'Unknown executor {name}, expected one of {EXECUTORS}')
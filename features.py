@@ -0,0 +1,225 @@
+import json
+import logging
+import time
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from shards import ShardedWriter, sample_key
+
+log = logging.getLogger(__name__)
+
+DTYPE = np.float16
+FEATURES = ('logmel', 'mfcc')
+
+
+def mel_filterbank(samplerate: int, n_fft: int, n_mels: int) -> np.ndarray:
+    """(n_fft // 2 + 1, n_mels) triangular filters evenly spaced on HTK mel scale"""
+    def mel(hz):
+        return 2595.0 * np.log10(1.0 + hz / 700.0)
+
+    def hz(mels):
+        return 700.0 * (10 ** (mels / 2595.0) - 1.0)
+
+    bins = np.linspace(0, samplerate / 2, n_fft // 2 + 1)
+    edges = hz(np.linspace(mel(0.0), mel(samplerate / 2), n_mels + 2))
+    lower, center, upper = edges[:-2, None], edges[1:-1, None], edges[2:, None]
+    filters = np.maximum(0.0, np.minimum((bins - lower) / (center - lower), (upper - bins) / (upper - center)))
+    return filters.T.astype(np.float32)
+
+
+def dct_matrix(n_inputs: int, n_outputs: int) -> np.ndarray:
+    """(n_inputs, n_outputs) orthonormal DCT-II"""
+    k = np.arange(n_outputs)[None, :]
+    n = np.arange(n_inputs)[:, None]
+    matrix = np.cos(np.pi * k * (2 * n + 1) / (2 * n_inputs)) * np.sqrt(2.0 / n_inputs)
+    matrix[:, 0] /= np.sqrt(2.0)
+    return matrix.astype(np.float32)
+
+
+class LogMel:
+    """Log mel filterbank energies (or their MFCC) of int16 mono PCM, like wav2letter computes them on the fly:
+    pre-emphasis, hamming window of window ms every hop ms, power spectrum, mel filters, log.
+    Frames of many samples are stacked and transformed together in blocks of at most block_frames"""
+
+    def __init__(self, samplerate: int = 16000, n_mels: int = 80, window: float = 25.0, hop: float = 10.0,
+                 n_mfcc: int = None, preemphasis: float = 0.97, block_frames: int = 8192):
+        self.samplerate = samplerate
+        self.n_mels = n_mels
+        self.n_mfcc = n_mfcc
+        self.window = window
+        self.hop = hop
+        self.preemphasis = preemphasis
+        self.block_frames = block_frames
+        self.win_length = int(samplerate * window / 1000)
+        self.hop_length = int(samplerate * hop / 1000)
+        self.n_fft = 1 << (self.win_length - 1).bit_length()
+        self._window = np.hamming(self.win_length).astype(np.float32)
+        self._filters = mel_filterbank(samplerate, self.n_fft, n_mels)
+        self._dct = dct_matrix(n_mels, n_mfcc) if n_mfcc else None
+
+    @property
+    def n_features(self) -> int:
+        return self.n_mfcc or self.n_mels
+
+    def config(self) -> dict:
+        return dict(kind='mfcc' if self.n_mfcc else 'logmel', samplerate=self.samplerate, n_mels=self.n_mels,
+                    n_mfcc=self.n_mfcc, window=self.window, hop=self.hop, preemphasis=self.preemphasis,
+                    n_features=self.n_features, dtype=np.dtype(DTYPE).name)
+
+    def frames(self, pcm: np.ndarray) -> np.ndarray:
+        """(frames, win_length) read-only view of pre-emphasized float32 signal, empty when pcm is shorter
+        than one window. Frames overlap in memory, window is applied by transform block by block"""
+        signal = np.asarray(pcm, dtype=np.float32) / 32768.0
+        if len(signal) < self.win_length:
+            return np.zeros((0, self.win_length), dtype=np.float32)
+        signal = np.append(signal[:1], signal[1:] - self.preemphasis * signal[:-1])
+        return np.lib.stride_tricks.sliding_window_view(signal, self.win_length)[::self.hop_length]
+
+    def transform(self, frames: np.ndarray) -> np.ndarray:
+        features = np.empty((len(frames), self.n_features), dtype=DTYPE)
+        for first in range(0, len(frames), self.block_frames):
+            block = frames[first:first + self.block_frames] * self._window
+            power = np.abs(np.fft.rfft(block, n=self.n_fft, axis=1)).astype(np.float32) ** 2 / self.n_fft
+            values = np.log(np.maximum(power @ self._filters, 1e-10))
+            if self._dct is not None:
+                values = values @ self._dct
+            features[first:first + len(block)] = values
+        return features
+
+    def __call__(self, pcm: np.ndarray) -> np.ndarray:
+        return self.transform(self.frames(pcm))
+
+    def batch(self, pcms: Iterable[np.ndarray]) -> List[np.ndarray]:
+        """Features of each of pcms. Frames of consecutive short samples are stacked into blocks of at most
+        block_frames and transformed together, longer samples are transformed on their own,
+        so only frames of one block are held at once"""
+        results = []
+        pending = []
+        pending_frames = 0
+        for pcm in pcms:
+            frames = self.frames(pcm)
+            if pending_frames + len(frames) > self.block_frames:
+                results.extend(self._transform_stacked(pending))
+                pending, pending_frames = [], 0
+            if len(frames) >= self.block_frames:
+                results.append(self.transform(frames))
+            else:
+                pending.append(frames)
+                pending_frames += len(frames)
+        results.extend(self._transform_stacked(pending))
+        return results
+
+    def _transform_stacked(self, frames: List[np.ndarray]) -> List[np.ndarray]:
+        if not frames:
+            return []
+        features = self.transform(np.concatenate(frames))
+        return np.split(features, np.cumsum([len(f) for f in frames])[:-1])
+
+
+def create(kind: str, samplerate: int = 16000, n_mels: int = 80, n_mfcc: int = 13) -> Optional[LogMel]:
+    if kind in (None, 'none'):
+        return None
+    if kind == 'logmel':
+        return LogMel(samplerate, n_mels=n_mels)
+    if kind == 'mfcc':
+        return LogMel(samplerate, n_mels=n_mels, n_mfcc=n_mfcc)
+    raise ValueError(f'Unknown features {kind}, expected one of {FEATURES}')
+
+
+def line_features(lines: List[tuple]) -> Iterator[Tuple[str, np.ndarray]]:
+    """(key, features) of Segmenter result lines, features are their fourth element"""
+    for line in lines:
+        if len(line) > 3 and line[3] is not None:
+            yield sample_key(line[0]), line[3]
+
+
+class FeatureWriter(ShardedWriter):
+    """Streams (key, features) of samples into size bounded shards of raw float16 rows in output/features:
+    <name>.f16 with rows of all samples of the shard and <name>.idx - json lines with key, first row and
+    number of rows of each sample, see shards.ShardedWriter. config.json describes features,
+    so shards could be memory mapped without it"""
+    suffix = '.f16'
+
+    def __init__(self, features_path: Path, config: dict, shard_size: int = 256 * 2 ** 20, prefix: str = None,
+                 on_finalize: Callable[[Path], None] = None):
+        super().__init__(features_path, shard_size, prefix or f'features-{time.strftime("%y%m%d_%H%M%S")}',
+                         on_finalize)
+        self.features_path = features_path
+        (self.features_path / 'config.json').write_text(json.dumps(config, indent=1))
+        self.n_features = config['n_features']
+        self._fp = None
+        self._rows = 0
+
+    def add(self, key: str, values: np.ndarray) -> None:
+        if self._fp is None:
+            self._fp = self._next_path().open('wb')
+            self._rows = 0
+        values = np.ascontiguousarray(values, dtype=DTYPE).reshape(-1, self.n_features)
+        self._fp.write(values.tobytes())
+        self._index.append(dict(key=key, offset=self._rows, frames=len(values)))
+        self._rows += len(values)
+
+    def _size(self) -> int:
+        return self._rows * self.n_features * np.dtype(DTYPE).itemsize
+
+    def _close(self) -> None:
+        self._fp.close()
+        self._fp = None
+
+
+class FeatureReader:
+    """Zero-copy access to features of finalized shards, each shard is memory mapped on first use"""
+
+    def __init__(self, features_path: Path):
+        self.features_path = features_path
+        config = json.loads((features_path / 'config.json').read_text())
+        self.n_features = config['n_features']
+        self.dtype = np.dtype(config['dtype'])
+        self._entries: Dict[str, Tuple[Path, int, int]] = {}
+        self._maps: Dict[Path, np.ndarray] = {}
+        for idx_path in sorted(features_path.glob('*.idx')):
+            path = idx_path.with_suffix('.f16')
+            with idx_path.open() as fp:
+                for line in fp:
+                    entry = json.loads(line)
+                    self._entries[entry['key']] = (path, entry['offset'], entry['frames'])
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def entry(self, key: str) -> Tuple[Path, int, int]:
+        """Shard path, first row and number of rows of sample"""
+        return self._entries[key]
+
+    def __getitem__(self, key: str) -> np.ndarray:
+        path, offset, frames = self._entries[key]
+        if not frames:  # empty shard files could not be mapped
+            return np.zeros((0, self.n_features), dtype=self.dtype)
+        data = self._maps.get(path)
+        if data is None:
+            data = self._maps[path] = np.memmap(path, dtype=self.dtype, mode='r').reshape(-1, self.n_features)
+        return data[offset:offset + frames]
+
+
+def write_index(output_path: Path) -> None:
+    """Writes output/features/index.lst aligned with output/transcript.lst: shard file name, first row and
+    number of rows of features of each transcript line, '- 0 0' for samples without features"""
+    reader = FeatureReader(output_path / 'features')
+    missing = 0
+    with (output_path / 'transcript.lst').open() as transcript, \
+            (output_path / 'features' / 'index.lst').open('w') as index:
+        for line in transcript:
+            key = sample_key(line)
+            if key in reader:
+                path, offset, frames = reader.entry(key)
+                index.write(f'{path.name} {offset} {frames}\n')
+            else:
+                index.write('- 0 0\n')
+                missing += 1
+    if missing:
+        log.warning(f'{missing} samples have no features')
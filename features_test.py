@@ -0,0 +1,60 @@
+import tracemalloc
+
+import numpy as np
+import pytest
+
+from features import FeatureReader, FeatureWriter, LogMel, create
+
+SAMPLERATE = 16000
+
+
+def pcm(seconds: float, seed: int = 0) -> np.ndarray:
+    return (np.random.default_rng(seed).standard_normal(int(seconds * SAMPLERATE)) * 3000).astype(np.int16)
+
+
+def test_mel_peak_at_tone_frequency():
+    features = LogMel(SAMPLERATE, n_mels=40)
+    tone = (np.sin(2 * np.pi * 1000 * np.arange(SAMPLERATE) / SAMPLERATE) * 10000).astype(np.int16)
+    values = features(tone)
+    assert values.shape == (98, 40) and values.dtype == np.float16
+    centers = np.argmax(features._filters, axis=0) * SAMPLERATE / features.n_fft
+    assert abs(centers[np.argmax(values.mean(axis=0))] - 1000) < 100
+
+
+@pytest.mark.parametrize('kind', ['logmel', 'mfcc'])
+@pytest.mark.parametrize('block_frames', [64, 250, 8192])
+def test_batch_matches_single_samples(kind, block_frames):
+    features = create(kind, SAMPLERATE)
+    features.block_frames = block_frames
+    pcms = [pcm(seconds, seed) for seed, seconds in enumerate([1.0, 0.01, 3.0, 0.5, 0.0, 2.2, 0.03])]
+    batched = features.batch(pcms)
+    assert len(batched) == len(pcms)
+    for values, samples in zip(batched, pcms):
+        np.testing.assert_array_equal(values, features(samples))
+    assert [len(values) for values in batched] == [98, 0, 298, 48, 0, 218, 1]
+
+
+def test_batch_memory_is_bounded_by_block():
+    features = LogMel(SAMPLERATE, block_frames=1024)
+    pcms = [pcm(10.0, seed) for seed in range(30)]
+    tracemalloc.start()
+    try:
+        batched = features.batch(pcms)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    # frames of all samples at once would take about 46 MB
+    all_frames = sum(len(values) for values in batched) * features.win_length * 4
+    assert peak < all_frames / 2
+
+
+def test_writer_and_reader_round_trip(tmp_path):
+    features = LogMel(SAMPLERATE, n_mels=8)
+    values = features.batch([pcm(1.0), pcm(0.5, 1)])
+    with FeatureWriter(tmp_path, features.config(), shard_size=1, prefix='f') as writer:
+        writer.write([('a', values[0])])
+        writer.write([('b', values[1])])
+    reader = FeatureReader(tmp_path)
+    assert len(reader) == 2 and reader.entry('b')[0].name == 'f-000001.f16'
+    np.testing.assert_array_equal(reader['a'], values[0])
+    np.testing.assert_array_equal(reader['b'], values[1])
@@ -0,0 +1,178 @@
+import hashlib
+import logging
+import re
+from multiprocessing.dummy import Pool as ThreadPool
+from typing import Iterable, List, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import requests
+
+log = logging.getLogger(__name__)
+
+ALPHABET = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-_'
+ID_RE = re.compile(r'^[A-Za-z0-9_-]{11}$')
+PATH_ID_RE = re.compile(r'^/(?:embed|v|shorts|live|e)/([A-Za-z0-9_-]{11})')
+CHANNEL_RE = re.compile(r'^/channel/(UC[A-Za-z0-9_-]{22})')
+CHANNEL_NAME_RE = re.compile(r'^/(@[^/]+|c/[^/]+|user/[^/]+)')
+PAGE_CHANNEL_ID_RE = re.compile(
+    r'(?:<link rel="canonical" href="https://www\.youtube\.com/channel/|"externalId":")(UC[A-Za-z0-9_-]{22})')
+
+
+def on_domain(host: str, *domains: str) -> bool:
+    """Host is one of domains or their subdomain, lookalikes like evilyoutube.com are not"""
+    return any(host == domain or host.endswith(f'.{domain}') for domain in domains)
+
+
+def video_id(url: str) -> Optional[str]:
+    """Canonical video id of any youtube video url variant or bare id, None for other urls"""
+    url = url.strip()
+    if ID_RE.match(url):
+        return url
+    parsed = urlparse(url if '//' in url else f'//{url}')
+    host = parsed.netloc.lower().split(':')[0]
+    if on_domain(host, 'youtu.be'):
+        candidate = parsed.path.lstrip('/')[:11]
+        return candidate if ID_RE.match(candidate) else None
+    if not on_domain(host, 'youtube.com', 'youtube-nocookie.com'):
+        return None
+    candidate = parse_qs(parsed.query).get('v', [''])[0][:11]
+    if ID_RE.match(candidate):
+        return candidate
+    match = PATH_ID_RE.match(parsed.path)
+    return match.group(1) if match else None
+
+
+def collection_url(url: str) -> Optional[str]:
+    """Playlist url for playlist and channel id urls, None for other urls"""
+    parsed = urlparse(url.strip())
+    playlist_id = parse_qs(parsed.query).get('list', [None])[0]
+    if playlist_id:
+        return f'https://www.youtube.com/playlist?list={playlist_id}'
+    match = CHANNEL_RE.match(parsed.path)
+    if match:
+        # uploads playlist of channel UCxxx is UUxxx
+        return f'https://www.youtube.com/playlist?list=UU{match.group(1)[2:]}'
+    return None
+
+
+def channel_page_url(url: str) -> Optional[str]:
+    """Channel page url for channel urls by name (/@handle, /c/name, /user/name), None for other urls.
+    Their channel ids are not in the url, see uploads_url"""
+    parsed = urlparse(url if '//' in url else f'//{url}')
+    if not on_domain(parsed.netloc.lower().split(':')[0], 'youtube.com'):
+        return None
+    match = CHANNEL_NAME_RE.match(parsed.path)
+    return f'https://www.youtube.com/{match.group(1)}' if match else None
+
+
+def uploads_url(channel_page: str, timeout: float = 30.0) -> str:
+    """Uploads playlist url of channel, its id is read from channel page. Raises ValueError if it is not there"""
+    response = requests.get(channel_page, timeout=timeout, headers={'Accept-Language': 'en-US,en'})
+    response.raise_for_status()
+    match = PAGE_CHANNEL_ID_RE.search(response.text)
+    if match is None:
+        raise ValueError(f'Channel id not found on {channel_page}')
+    return collection_url(f'https://www.youtube.com/channel/{match.group(1)}')
+
+
+def canonical_url(video_id: str) -> str:
+    return f'https://www.youtube.com/watch?v={video_id}'
+
+
+def encode_id(video_id: str) -> int:
+    """Packs video id into 64 bits. Last char of real ids carries 4 bits only, so they are packed exactly,
+    anything else is hashed"""
+    value = 0
+    for char in video_id:
+        value = (value << 6) | ALPHABET.index(char)
+    if value & 3 == 0:
+        return value >> 2
+    return int.from_bytes(hashlib.blake2b(video_id.encode(), digest_size=8).digest(), 'big')
+
+
+def shard_of(video_id: str, shards: int) -> int:
+    """Stable across machines and python runs, unlike hash()"""
+    return int.from_bytes(hashlib.blake2b(video_id.encode(), digest_size=8).digest(), 'big') % shards
+
+
+class IdSet:
+    """Set of video ids packed into sorted uint64 array, 8 bytes per id.
+    Ids are added in batches, so sorting cost is amortized"""
+
+    def __init__(self):
+        self.ids = np.zeros(0, dtype=np.uint64)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add_many(self, video_ids: List[str]) -> np.ndarray:
+        """Adds ids, returns mask of ids which were not seen before (first occurrence within batch)"""
+        codes = np.array([encode_id(i) for i in video_ids], dtype=np.uint64)
+        new = np.zeros(len(codes), dtype=bool)
+        if not len(codes):
+            return new
+        unique, first_index = np.unique(codes, return_index=True)
+        position = np.searchsorted(self.ids, unique)
+        seen = (position < len(self.ids)) & (self.ids[np.minimum(position, len(self.ids) - 1)] == unique) \
+            if len(self.ids) else np.zeros(len(unique), dtype=bool)
+        new[first_index[~seen]] = True
+        self.ids = np.union1d(self.ids, unique[~seen])
+        return new
+
+
+def expand_collection(url: str) -> List[str]:
+    """Video urls of playlist, channel pages are resolved to their uploads playlists first"""
+    import pytube
+    try:
+        playlist_url = uploads_url(url) if channel_page_url(url) else url
+        video_urls = list(pytube.Playlist(playlist_url).video_urls)
+    except Exception:
+        log.exception(f'Got exception while expanding {url}')
+        return []
+    log.info(f'Expanded {url} to {len(video_urls)} videos')
+    return video_urls
+
+
+def ingest(lines: Iterable[str], shard: Tuple[int, int] = None, expand_workers: int = 8,
+           batch_size: int = 65536) -> List[str]:
+    """Normalizes input lines to canonical video urls, expands playlists and channels concurrently,
+    drops duplicates and keeps only ids of shard (index, count).
+    Channels are given by id (/channel/UC...) or by name (/@handle, /c/name, /user/name), names are resolved
+    to ids with a request to channel page"""
+    seen = IdSet()
+    result = []
+    collections = []
+    skipped = 0
+
+    def add(ids):
+        mask = seen.add_many(ids)
+        result.extend(canonical_url(i) for i, new in zip(ids, mask)
+                      if new and (shard is None or shard_of(i, shard[1]) == shard[0]))
+
+    batch = []
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        ep_id = video_id(line)
+        collection = None if ep_id is not None else collection_url(line) or channel_page_url(line)
+        if ep_id is not None:
+            batch.append(ep_id)
+        elif collection is not None:
+            collections.append(collection)
+        else:
+            skipped += 1
+            log.warning(f'Unsupported url {line}')
+        if len(batch) >= batch_size:
+            add(batch)
+            batch = []
+    add(batch)
+
+    if collections:
+        with ThreadPool(expand_workers) as pool:
+            for video_urls in pool.imap(expand_collection, collections):
+                add([i for i in map(video_id, video_urls) if i is not None])
+    log.info(f'Ingested {len(result)} videos of {len(seen)} unique, {len(collections)} collections expanded, '
+             f'{skipped} lines skipped')
+    return result
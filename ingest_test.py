@@ -0,0 +1,116 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import ingest
+from ingest import IdSet, channel_page_url, collection_url, encode_id, shard_of, uploads_url, video_id
+
+CHANNEL_ID = 'UC' + 'abcdefghijklmnopqrstuv'
+UPLOADS = 'https://www.youtube.com/playlist?list=UUabcdefghijklmnopqrstuv'
+
+
+@pytest.mark.parametrize('url', [
+    'dQw4w9WgXcQ', ' dQw4w9WgXcQ\n', 'https://www.youtube.com/watch?v=dQw4w9WgXcQ',
+    'http://youtube.com/watch?feature=share&v=dQw4w9WgXcQ&t=10', 'm.youtube.com/watch?v=dQw4w9WgXcQ',
+    'https://youtu.be/dQw4w9WgXcQ?t=1', 'https://www.youtube.com/embed/dQw4w9WgXcQ',
+    'https://www.youtube.com/shorts/dQw4w9WgXcQ', 'https://www.youtube.com/live/dQw4w9WgXcQ?si=x',
+    'https://www.youtube-nocookie.com/embed/dQw4w9WgXcQ', 'https://www.youtube.com:443/v/dQw4w9WgXcQ'])
+def test_video_id_of_url_variants(url):
+    assert video_id(url) == 'dQw4w9WgXcQ'
+
+
+@pytest.mark.parametrize('url', [
+    'https://example.com/watch?v=dQw4w9WgXcQ', 'https://www.youtube.com/watch?v=short',
+    'https://www.youtube.com/playlist?list=PLxyz', f'https://www.youtube.com/channel/{CHANNEL_ID}', 'not a url',
+    'https://evilyoutube.com/watch?v=dQw4w9WgXcQ', 'https://notyoutu.be/dQw4w9WgXcQ',
+    'https://www.youtube.com.evil.com/watch?v=dQw4w9WgXcQ'])
+def test_video_id_of_other_urls(url):
+    assert video_id(url) is None
+
+
+def test_collection_url():
+    assert collection_url('https://www.youtube.com/playlist?list=PLxyz') == \
+        'https://www.youtube.com/playlist?list=PLxyz'
+    assert collection_url('https://www.youtube.com/watch?v=dQw4w9WgXcQ&list=PLxyz') == \
+        'https://www.youtube.com/playlist?list=PLxyz'
+    assert collection_url(f'https://www.youtube.com/channel/{CHANNEL_ID}/videos') == UPLOADS
+    assert collection_url('https://www.youtube.com/@handle') is None
+
+
+@pytest.mark.parametrize('url, page', [
+    ('https://www.youtube.com/@Some.Handle/videos', 'https://www.youtube.com/@Some.Handle'),
+    ('youtube.com/c/CustomName', 'https://www.youtube.com/c/CustomName'),
+    ('https://m.youtube.com/user/LegacyName?sub=1', 'https://www.youtube.com/user/LegacyName'),
+    ('https://example.com/@handle', None), ('https://evilyoutube.com/@handle', None),
+    (f'https://www.youtube.com/channel/{CHANNEL_ID}', None)])
+def test_channel_page_url(url, page):
+    assert channel_page_url(url) == page
+
+
+class ChannelHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        body = self.server.pages.get(self.path)
+        self.send_response(404 if body is None else 200)
+        body = (body or '').encode()
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), ChannelHandler)
+    server.daemon_threads = True
+    server.pages = {
+        '/@canonical': f'<link rel="canonical" href="https://www.youtube.com/channel/{CHANNEL_ID}">',
+        '/c/external': f'<script>var ytInitialData = {{"metadata": {{"externalId":"{CHANNEL_ID}"}}}};</script>',
+        '/user/renamed': '<html>no channel here</html>'}
+    server.url = f'http://127.0.0.1:{server.server_address[1]}'
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_channel_name_is_resolved_to_uploads(server):
+    assert uploads_url(f'{server.url}/@canonical') == UPLOADS
+    assert uploads_url(f'{server.url}/c/external') == UPLOADS
+    with pytest.raises(ValueError, match='Channel id not found'):
+        uploads_url(f'{server.url}/user/renamed')
+
+
+def test_ingest_dedups_and_expands_collections(monkeypatch):
+    expanded = []
+    videos = {UPLOADS: ['https://www.youtube.com/watch?v=bbbbbbbbbbb', 'https://www.youtube.com/watch?v=ccccccccccc'],
+              'https://www.youtube.com/@handle': ['https://www.youtube.com/watch?v=ddddddddddd', 'not a video']}
+    monkeypatch.setattr(ingest, 'expand_collection', lambda url: expanded.append(url) or videos[url])
+    lines = ['# comment', '', 'https://youtu.be/aaaaaaaaaaa', 'aaaaaaaaaaa',
+             f'https://www.youtube.com/channel/{CHANNEL_ID}', 'https://www.youtube.com/@handle/videos',
+             'https://www.youtube.com/watch?v=bbbbbbbbbbb', 'https://example.com/video']
+    urls = ingest.ingest(lines, batch_size=2)
+    assert sorted(expanded) == ['https://www.youtube.com/@handle', UPLOADS]
+    assert urls[:2] == ['https://www.youtube.com/watch?v=aaaaaaaaaaa', 'https://www.youtube.com/watch?v=bbbbbbbbbbb']
+    assert sorted(urls[2:]) == ['https://www.youtube.com/watch?v=ccccccccccc',
+                                'https://www.youtube.com/watch?v=ddddddddddd']
+
+
+def test_shards_partition_videos():
+    ids = [f'{i:011d}' for i in range(200)]
+    shards = [ingest.ingest(ids, shard=(index, 3)) for index in range(3)]
+    assert sorted(url for urls in shards for url in urls) == sorted(map(ingest.canonical_url, ids))
+    assert all(shards) and all(shard_of(video_id(url), 3) == index for index, urls in enumerate(shards) for url in urls)
+
+
+def test_encode_id_packs_real_ids_exactly():
+    assert encode_id('AAAAAAAAAAA') == 0 and encode_id('AAAAAAAAAAE') == 1
+    assert encode_id('_' * 10 + '8') == 2 ** 64 - 1
+    assert encode_id('dQw4w9WgXcQ') != encode_id('dQw4w9WgXcA')
+    ids = IdSet()
+    assert ids.add_many(['dQw4w9WgXcQ', 'aaaaaaaaaaa', 'dQw4w9WgXcQ']).tolist() == [True, True, False]
+    assert ids.add_many(['aaaaaaaaaaa', 'bbbbbbbbbbb']).tolist() == [False, True] and len(ids) == 3
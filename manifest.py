@@ -0,0 +1,70 @@
+import json
+import logging
+import time
+from typing import Iterator, List, Set, Tuple
+
+from store import SqliteStore
+
+log = logging.getLogger(__name__)
+
+DONE = 'done'
+FAILED = 'failed'
+
+
+def lines_duration(lines: List[Tuple[str, str]]) -> float:
+    """Summary duration of transcript lines: <name> <path> <duration> <text>"""
+    return sum(float(fields[0].split(' ', 3)[2]) for fields in lines)
+
+
+class Manifest(SqliteStore):
+    """Persistent per item progress of dataset build.
+    Stores status, segments count, duration and transcript lines contributed by each item,
+    so rerun can skip finished items and rebuild merged transcripts without touching audio"""
+    schema = '''
+        CREATE TABLE IF NOT EXISTS items (
+            key TEXT PRIMARY KEY,
+            status TEXT NOT NULL,
+            segments INTEGER NOT NULL DEFAULT 0,
+            duration REAL NOT NULL DEFAULT 0,
+            lines TEXT,
+            error TEXT,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            updated REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS items_status ON items (status);
+    '''
+
+    def done(self, key: str, lines: List[Tuple[str, str]]) -> None:
+        self._set(key, DONE, segments=len(lines), duration=lines_duration(lines), lines=json.dumps(lines))
+
+    def failed(self, key: str, error: str) -> None:
+        self._set(key, FAILED, error=error)
+
+    def _set(self, key, status, segments=0, duration=0.0, lines=None, error=None):
+        self.connection.execute(
+            '''INSERT INTO items (key, status, segments, duration, lines, error, attempts, updated)
+               VALUES (?, ?, ?, ?, ?, ?, 1, ?)
+               ON CONFLICT (key) DO UPDATE SET status = excluded.status, segments = excluded.segments,
+                   duration = excluded.duration, lines = excluded.lines, error = excluded.error,
+                   attempts = attempts + 1, updated = excluded.updated''',
+            (key, status, segments, duration, lines, error, time.time()))
+
+    def keys(self, status: str = DONE) -> Set[str]:
+        return {key for key, in self.connection.execute('SELECT key FROM items WHERE status = ?', (status,))}
+
+    def lines(self) -> Iterator[List[Tuple[str, str]]]:
+        """Yields transcript lines of finished items in order of completion"""
+        for _, lines in self.items():
+            yield lines
+
+    def items(self) -> Iterator[Tuple[str, List[Tuple[str, str]]]]:
+        """Yields (key, transcript lines) of finished items in order of completion"""
+        cursor = self.connection.execute('SELECT key, lines FROM items WHERE status = ? ORDER BY updated', (DONE,))
+        for key, lines in cursor:
+            yield key, [tuple(fields) for fields in json.loads(lines)]
+
+    def stats(self) -> dict:
+        cursor = self.connection.execute(
+            'SELECT status, COUNT(*), SUM(segments), SUM(duration) FROM items GROUP BY status')
+        return {status: dict(items=items, segments=segments, duration=duration)
+                for status, items, segments, duration in cursor}
@@ -0,0 +1,229 @@
+import bisect
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+from typing import Callable, Iterable, Iterator, Optional
+
+log = logging.getLogger(__name__)
+
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 1800.0)
+_NULL_TIMER = nullcontext()
+
+
+def metric_key(name: str, labels: dict) -> str:
+    """Prometheus style key: name{label="value",...}"""
+    if not labels:
+        return name
+    return name + '{' + ','.join(f'{k}="{v}"' for k, v in sorted(labels.items())) + '}'
+
+
+class Metrics:
+    """Counters, gauges and latency histograms of dataset build.
+    Disabled registry does nothing. Each process keeps its own values and flushes them into
+    <path>/metrics/<host>-<pid>-<start>.json, export merges files of all processes into
+    <path>/metrics.json and <path>/metrics.prom. Counters and histograms are summed, gauges are levels
+    (limits, ETA, queue depth), so the value set last by any process is taken.
+    Values inherited by forked workers are dropped"""
+
+    def __init__(self):
+        self.path = None
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.pid = os.getpid()
+        self.counters = {}
+        self.gauges = {}  # key -> [value, time it was set]
+        self.histograms = {}  # key -> bucket counts + [sum, count]
+        self._file_name = f'{socket.gethostname()}-{self.pid}-{int(time.time())}.json'
+
+    def configure(self, path: Optional[Path], enabled: bool = True) -> None:
+        """Could be called repeatedly, e.g. by each worker before its first item"""
+        path = Path(path) if path is not None else None
+        if path == self.path and enabled == self.enabled and self.pid == os.getpid():
+            return
+        self.path = path
+        self.enabled = enabled and path is not None
+        self._reset()
+        if self.enabled:
+            (self.path / 'metrics').mkdir(parents=True, exist_ok=True)
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        if not self.enabled:
+            return
+        key = metric_key(name, labels)
+        with self._lock:
+            self._check_pid()
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels) -> None:
+        if not self.enabled:
+            return
+        key = metric_key(name, labels)
+        with self._lock:
+            self._check_pid()
+            self.gauges[key] = [value, time.time()]
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        if not self.enabled:
+            return
+        key = metric_key(name, labels)
+        with self._lock:
+            self._check_pid()
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [0] * (len(BUCKETS) + 3)
+            histogram[bisect.bisect_left(BUCKETS, value)] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    def timer(self, stage: str):
+        """Context manager observing duration of stage in stage_seconds histogram"""
+        if not self.enabled:
+            return _NULL_TIMER
+        return self._timer(stage)
+
+    @contextmanager
+    def _timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe('stage_seconds', time.perf_counter() - start, stage=stage)
+
+    def flush(self) -> None:
+        """Writes values of current process"""
+        if not self.enabled:
+            return
+        with self._lock:
+            self._check_pid()
+            data = json.dumps(dict(counters=self.counters, gauges=self.gauges, histograms=self.histograms))
+        path = self.path / 'metrics' / self._file_name
+        tmp_path = path.with_suffix('.tmp')
+        tmp_path.write_text(data)
+        tmp_path.rename(path)
+
+    def collect(self) -> dict:
+        """Merged values of all processes"""
+        self.flush()
+        merged = dict(counters={}, gauges={}, histograms={})
+        gauges_set = {}
+        for path in (self.path / 'metrics').glob('*.json'):
+            try:
+                data = json.loads(path.read_text())
+            except ValueError:
+                continue
+            for key, value in data['counters'].items():
+                merged['counters'][key] = merged['counters'].get(key, 0) + value
+            for key, (value, updated) in data['gauges'].items():
+                if updated >= gauges_set.get(key, 0):
+                    merged['gauges'][key], gauges_set[key] = value, updated
+            for key, values in data['histograms'].items():
+                total = merged['histograms'].setdefault(key, [0] * len(values))
+                merged['histograms'][key] = [a + b for a, b in zip(total, values)]
+        return merged
+
+    def export(self) -> Optional[dict]:
+        if not self.enabled:
+            return None
+        merged = self.collect()
+        (self.path / 'metrics.json').write_text(json.dumps(merged, indent=1, sort_keys=True))
+        (self.path / 'metrics.prom').write_text(prometheus_text(merged))
+        return merged
+
+    def _check_pid(self):
+        if self.pid != os.getpid():
+            self._reset()
+
+
+def metric_name(key: str) -> str:
+    return key.partition('{')[0]
+
+
+def prometheus_text(merged: dict) -> str:
+    """Text exposition format, samples of each metric follow its # TYPE line"""
+    lines = []
+    for kind, metric_type in (('counters', 'counter'), ('gauges', 'gauge'), ('histograms', 'histogram')):
+        previous = None
+        # by name first, as '{' sorts after '_' and would split samples of one metric
+        for key in sorted(merged[kind], key=lambda key: (metric_name(key), key)):
+            name, _, labels = key.partition('{')
+            if name != previous:
+                lines.append(f'# TYPE {name} {metric_type}')
+                previous = name
+            if kind != 'histograms':
+                lines.append(f'{key} {merged[kind][key]}')
+                continue
+            values = merged[kind][key]
+            labels = labels.rstrip('}')
+            separator = ',' if labels else ''
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ('+Inf',), values[:-2]):
+                cumulative += count
+                lines.append(f'{name}_bucket{{{labels}{separator}le="{bound}"}} {cumulative}')
+            suffix = f'{{{labels}}}' if labels else ''
+            lines.append(f'{name}_sum{suffix} {values[-2]}')
+            lines.append(f'{name}_count{suffix} {values[-1]}')
+    return '\n'.join(lines) + '\n'
+
+
+registry = Metrics()
+configure = registry.configure
+inc = registry.inc
+set_gauge = registry.set
+observe = registry.observe
+timer = registry.timer
+flush = registry.flush
+export = registry.export
+
+
+def failure_reason(error: str) -> str:
+    """Exception class name of repr(e) errors, error text itself otherwise"""
+    return error.split('(', 1)[0][:64]
+
+
+class Progress:
+    """Counts finished items and produced audio, logs progress line with rates and ETA every interval seconds.
+    total is called to get number of items, ETA is not shown while it returns None"""
+
+    def __init__(self, interval: float = 60.0, total: Callable[[], Optional[int]] = lambda: None):
+        self.interval = interval
+        self.total = total
+        self.items = 0
+        self.submitted = 0
+        self.audio_seconds = 0.0
+        self.started = time.monotonic()
+        self._last_report = self.started
+
+    def track(self, items: Iterable) -> Iterator:
+        """Counts items pulled for processing, so number of items in flight is known"""
+        for item in items:
+            self.submitted += 1
+            yield item
+
+    def update(self, audio_seconds: float = 0.0) -> None:
+        self.items += 1
+        self.audio_seconds += audio_seconds
+        if time.monotonic() - self._last_report >= self.interval:
+            self.report()
+
+    def report(self) -> None:
+        self._last_report = time.monotonic()
+        elapsed = max(self._last_report - self.started, 1e-9)
+        total = self.total()
+        eta = 'unknown'
+        if total is not None and self.items:
+            left = max(total - self.items, 0) * elapsed / self.items
+            eta = f'{int(left // 3600)}h{int(left % 3600 // 60):02d}m'
+            set_gauge('eta_seconds', left)
+        set_gauge('queue_depth', self.submitted - self.items, queue='inflight')
+        log.info(f'Progress: {self.items}/{total if total is not None else "?"} items, '
+                 f'{self.audio_seconds / 3600:.2f} audio h, {self.audio_seconds / elapsed:.2f} audio h/h, '
+                 f'{self.items * 60 / elapsed:.1f} items/min, ETA {eta}')
+        export()
@@ -0,0 +1,98 @@
+import json
+import multiprocessing
+import re
+
+import pytest
+
+import metrics
+from metrics import Metrics, Progress, prometheus_text
+
+
+def run_worker(path, limit: float) -> None:
+    registry = Metrics()
+    registry.configure(path)
+    registry.inc('items_total', status='done')
+    registry.inc('audio_seconds_total', 1.5)
+    registry.set('throttle_limit', limit, stage='download')
+    registry.observe('stage_seconds', 0.02, stage='fetch')
+    registry.flush()
+
+
+def run_workers(path, limits: list) -> None:
+    # one after another, so the last limit is set last
+    for limit in limits:
+        worker = multiprocessing.Process(target=run_worker, args=(path, limit))
+        worker.start()
+        worker.join()
+        assert worker.exitcode == 0
+
+
+def test_values_of_processes_are_merged(tmp_path):
+    run_workers(tmp_path, [4.0, 2.5, 8.0])
+    registry = Metrics()
+    registry.configure(tmp_path)
+    registry.inc('items_total', status='failed')
+    registry.observe('stage_seconds', 100.0, stage='fetch')
+    merged = registry.export()
+    assert merged['counters'] == {'items_total{status="done"}': 3, 'items_total{status="failed"}': 1,
+                                  'audio_seconds_total': 4.5}
+    # levels are not summed, the one set last is taken
+    assert merged['gauges'] == {'throttle_limit{stage="download"}': 8.0}
+    histogram = merged['histograms']['stage_seconds{stage="fetch"}']
+    assert histogram[3] == 3 and histogram[11] == 1 and histogram[-2:] == [pytest.approx(100.06), 4]
+    assert json.loads((tmp_path / 'metrics.json').read_text()) == merged
+
+
+def test_gauge_set_later_by_main_process_wins(tmp_path):
+    registry = Metrics()
+    registry.configure(tmp_path)
+    registry.set('throttle_limit', 1.0, stage='download')
+    registry.flush()
+    run_workers(tmp_path, [4.0])
+    assert registry.collect()['gauges'] == {'throttle_limit{stage="download"}': 4.0}
+    registry.set('throttle_limit', 2.0, stage='download')
+    assert registry.collect()['gauges'] == {'throttle_limit{stage="download"}': 2.0}
+
+
+def test_prometheus_text_has_type_of_each_metric():
+    merged = dict(counters={'items_total{status="done"}': 2, 'items_total_other': 1, 'items_total{status="x"}': 1},
+                  gauges={'eta_seconds': 60.0, 'queue_depth{queue="work"}': 3, 'queue_depth{queue="inflight"}': 2},
+                  histograms={'stage_seconds{stage="fetch"}': [1] + [0] * 12 + [2, 5.5, 3]})
+    text = prometheus_text(merged)
+    types = re.findall(r'^# TYPE (\S+) (\S+)$', text, re.M)
+    assert types == [('items_total', 'counter'), ('items_total_other', 'counter'), ('eta_seconds', 'gauge'),
+                     ('queue_depth', 'gauge'), ('stage_seconds', 'histogram')]
+    lines = text.splitlines()
+    # samples of each metric follow its type line
+    index = lines.index('# TYPE items_total counter')
+    assert lines[index + 1:index + 3] == ['items_total{status="done"} 2', 'items_total{status="x"} 1']
+    assert 'stage_seconds_bucket{stage="fetch",le="0.001"} 1' in lines
+    assert 'stage_seconds_bucket{stage="fetch",le="1800.0"} 1' in lines
+    assert 'stage_seconds_bucket{stage="fetch",le="+Inf"} 3' in lines
+    assert lines[-2:] == ['stage_seconds_sum{stage="fetch"} 5.5', 'stage_seconds_count{stage="fetch"} 3']
+
+
+def test_disabled_registry_does_nothing(tmp_path):
+    registry = Metrics()
+    registry.configure(None)
+    registry.inc('items_total')
+    with registry.timer('fetch'):
+        pass
+    assert registry.export() is None and registry.counters == {} and registry.histograms == {}
+
+
+def test_progress_eta(tmp_path, monkeypatch):
+    metrics.configure(tmp_path)
+    try:
+        progress = Progress(interval=3600.0, total=lambda: 10)
+        monkeypatch.setattr(progress, 'started', progress.started - 100.0)
+        for _ in progress.track(range(5)):
+            pass
+        for _ in range(4):
+            progress.update(audio_seconds=60.0)
+        progress.report()
+        gauges = json.loads((tmp_path / 'metrics.json').read_text())['gauges']
+        assert gauges['eta_seconds'] == pytest.approx(150.0, rel=0.01)
+        assert gauges['queue_depth{queue="inflight"}'] == 1
+    finally:
+        metrics.configure(None)
@@ -0,0 +1,121 @@
+import json
+import logging
+from pathlib import Path
+from typing import List, Tuple
+
+import numpy as np
+
+from segmenter import segment
+from subtitles import Subtitles
+
+log = logging.getLogger(__name__)
+
+
+def plan_cuts(starts: np.ndarray, ends: np.ndarray, min_duration: int = 5000, target_duration: int = 10000,
+              max_duration: int = 15000, min_gap: int = 200) -> Tuple[np.ndarray, np.ndarray]:
+    """Groups cues into segments, returns indices of first and last cue of each segment.
+    Segment is cut after cue whose end gives duration in [min_duration, max_duration] ms.
+    Among such cues those followed by silence of at least min_gap ms are preferred,
+    then the one giving duration closest to target_duration. Cues longer than max_duration
+    become single segments, trailing cues always form the last segment"""
+    starts = np.asarray(starts, dtype=np.int64)
+    n = len(starts)
+    if not n:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    reach = np.maximum.accumulate(np.asarray(ends, dtype=np.int64))
+    gaps = np.append(starts[1:] - reach[:-1], np.iinfo(np.int64).max)  # silence after each cue
+    # cut for segment starting at each cue is computed for all cues at once,
+    # then cuts are followed from the first cue
+    index = np.arange(n)
+    lo = np.maximum(np.searchsorted(reach, starts + min_duration, side='left'), index)
+    hi = np.minimum(np.searchsorted(reach, starts + max_duration, side='right') - 1, n - 1)
+    targets = starts + target_duration
+    closest = _closest(reach, lo, hi, targets)
+    # the same among cues followed by gap
+    at_gap = np.flatnonzero(gaps >= min_gap)
+    gap_lo = np.searchsorted(at_gap, lo, side='left')
+    gap_hi = np.searchsorted(at_gap, hi, side='right') - 1
+    has_gap = gap_lo <= gap_hi
+    if len(at_gap):
+        closest_at_gap = at_gap[_closest(reach[at_gap], gap_lo, gap_hi, targets)]
+        closest = np.where(has_gap, closest_at_gap, closest)
+    # no cut point in [min, max]: take everything below max, or single long cue
+    lasts = np.where(hi < lo, np.maximum(hi, index), closest)
+    following = (lasts + 1).tolist()
+    firsts = []
+    first = 0
+    while first < n:
+        firsts.append(first)
+        first = following[first]
+    firsts = np.array(firsts, dtype=np.int64)
+    lasts = np.append(firsts[1:], n) - 1
+    return firsts, lasts
+
+
+def _closest(values: np.ndarray, lo: np.ndarray, hi: np.ndarray, targets: np.ndarray) -> np.ndarray:
+    """Index of first of values[lo..hi] closest to target for each range, values are sorted.
+    Ranges with hi < lo give undefined index in [0, len(values))"""
+    lo = np.minimum(lo, len(values) - 1)
+    hi = np.clip(hi, lo, len(values) - 1)
+    above = np.searchsorted(values, targets, side='left')
+    right = np.clip(above, lo, hi)
+    left = np.clip(above - 1, lo, hi)
+    closest = np.where(np.abs(values[left] - targets) <= np.abs(values[right] - targets), values[left], values[right])
+    # among equal values the first one
+    return np.maximum(np.searchsorted(values, closest, side='left'), lo)
+
+
+def plan_segments(subtitles: Subtitles, **kwargs) -> List[segment]:
+    """Segments of subtitles, see plan_cuts for kwargs"""
+    firsts, lasts = plan_cuts(subtitles.starts, subtitles.ends, **kwargs)
+    reach = np.maximum.accumulate(subtitles.ends) if len(subtitles) else subtitles.ends
+    return [segment(int(subtitles.starts[first]), int(reach[last]), subtitles.texts(first, last))
+            for first, last in zip(firsts, lasts)]
+
+
+def alignment_cuts(starts: np.ndarray, duration: int, max_duration: int = 20000,
+                   pad: int = 200) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Cuts of word aligned audio, returns segments words ranges [first, stop) and start and end ms.
+    Segment is cut before first word starting more than max_duration ms after segment start,
+    cut is moved pad ms earlier, because aligned word start is generally in the middle of the word.
+    Last segment ends at duration and is dropped if it is longer than max_duration"""
+    starts = np.asarray(starts, dtype=np.int64)
+    if not len(starts):
+        return tuple(np.zeros(0, dtype=np.int64) for _ in range(4))
+    # first word starting after threshold is the first one where running max of starts exceeds it
+    reach = np.maximum.accumulate(starts)
+    # thresholds only grow, so words before a cut never exceed later thresholds.
+    # Cut before the very first word gives leading segment without words, as word by word walk did
+    firsts, bounds = [0], [0]
+    while True:
+        first = int(np.searchsorted(reach, bounds[-1] + max_duration, side='right'))
+        if first >= len(starts):
+            break
+        firsts.append(first)
+        bounds.append(int(starts[first]) - pad)
+    bounds.append(duration)
+    firsts, bounds = np.array(firsts, dtype=np.int64), np.array(bounds, dtype=np.int64)
+    stops = np.append(firsts[1:], len(starts))
+    if duration - bounds[-2] > max_duration:
+        log.error(f'Big last segment: {duration - bounds[-2]}')
+        return firsts[:-1], stops[:-1], bounds[:-2], bounds[1:-1]
+    return firsts, stops, bounds[:-1], bounds[1:]
+
+
+def write_sorted_manifest(output_path: Path, bucket_width: int = 1000) -> None:
+    """Writes output/transcript_sorted.lst with transcript.lst lines sorted by duration
+    and output/buckets.json: {"<from>-<to>": [first line, lines count]} for buckets of bucket_width ms,
+    so dataloaders could batch samples of similar length"""
+    with (output_path / 'transcript.lst').open() as fp:
+        lines = fp.readlines()
+    durations = np.array([float(l.split(' ', 3)[2]) for l in lines], dtype=np.float64)
+    order = np.argsort(durations, kind='stable')
+    with (output_path / 'transcript_sorted.lst').open('w') as fp:
+        fp.writelines(lines[i] for i in order)
+
+    bucket_ids = (durations[order] // bucket_width).astype(np.int64)
+    ids, firsts, counts = np.unique(bucket_ids, return_index=True, return_counts=True)
+    buckets = {f'{i * bucket_width}-{(i + 1) * bucket_width}': [int(first), int(count)]
+               for i, first, count in zip(ids, firsts, counts)}
+    (output_path / 'buckets.json').write_text(json.dumps(buckets, indent=1))
+    log.info(f'Written {len(lines)} sorted lines in {len(buckets)} buckets')
@@ -0,0 +1,148 @@
+import json
+
+import numpy as np
+import pytest
+
+from planner import alignment_cuts, plan_cuts, plan_segments, write_sorted_manifest
+from segmenter import segment
+from subtitles import Subtitles, line
+
+
+def cuts(cues: list, **kwargs) -> list:
+    firsts, lasts = plan_cuts([start for start, _ in cues], [end for _, end in cues], **kwargs)
+    return list(zip(firsts.tolist(), lasts.tolist()))
+
+
+def greedy_cuts(starts: np.ndarray, ends: np.ndarray, min_duration=5000, target_duration=10000, max_duration=15000,
+                min_gap=200) -> list:
+    """Cue by cue walk plan_cuts is equivalent to"""
+    reach = np.maximum.accumulate(ends)
+    result = []
+    first = 0
+    while first < len(starts):
+        candidates = [i for i in range(first, len(starts))
+                      if min_duration <= reach[i] - starts[first] <= max_duration]
+        at_gap = [i for i in candidates if i == len(starts) - 1 or starts[i + 1] - reach[i] >= min_gap]
+        if not candidates:
+            below = [i for i in range(first, len(starts)) if reach[i] - starts[first] <= max_duration]
+            last = max(below + [first])
+        else:
+            last = min(at_gap or candidates, key=lambda i: abs(reach[i] - starts[first] - target_duration))
+        result.append((first, last))
+        first = last + 1
+    return result
+
+
+def test_cut_closest_to_target_within_min_max():
+    # one second cues without gaps, every cue end is a cut candidate, end of cues counts as gap
+    cues = [(i * 1000, (i + 1) * 1000) for i in range(25)]
+    assert cuts(cues) == [(0, 9), (10, 24)]
+    assert cuts(cues, min_duration=3000, target_duration=3000, max_duration=4000) == \
+        [(i, i + 2) for i in range(0, 21, 3)] + [(21, 24)]
+
+
+def test_cut_at_gap_is_preferred():
+    # gap after cue ending at 6 s, cut there is in [min, max] but farther from target than 10 s
+    cues = [(i * 1000, (i + 1) * 1000) for i in range(6)] + [(7000 + i * 1000, 8000 + i * 1000) for i in range(14)]
+    assert cuts(cues) == [(0, 5), (6, 19)]
+    assert cuts(cues, min_gap=2000) == [(0, 8), (9, 19)]
+
+
+def test_boundaries_are_inclusive():
+    cues = [(0, 5000), (5000, 15000), (15000, 15001)]
+    assert cuts(cues, target_duration=5000, min_gap=0) == [(0, 0), (1, 1), (2, 2)]
+    assert cuts(cues, target_duration=16000, min_gap=0) == [(0, 1), (2, 2)]
+
+
+def test_over_long_cues_are_single_segments():
+    cues = [(0, 2000), (2000, 30000), (30000, 31000), (31000, 60000), (61000, 62000)]
+    assert cuts(cues) == [(0, 0), (1, 1), (2, 2), (3, 3), (4, 4)]
+    # short cues below max are taken together when there is no cut point in [min, max]
+    assert cuts([(0, 1000), (1000, 3000), (3000, 40000)]) == [(0, 1), (2, 2)]
+
+
+def test_overlapping_cues_are_measured_by_furthest_end():
+    cues = [(0, 12000), (1000, 2000), (2500, 3000), (12500, 14000)]
+    assert cuts(cues) == [(0, 2), (3, 3)]
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_matches_greedy_walk(seed):
+    rng = np.random.default_rng(seed)
+    n = int(rng.integers(1, 200))
+    durations = rng.integers(0, 8000, n) // 500 * 500
+    gaps = rng.integers(-1000, 1500, n) // 100 * 100
+    starts = np.maximum.accumulate(np.concatenate(([0], np.cumsum(durations[:-1] + gaps[1:]))))
+    ends = starts + durations
+    kwargs = dict(min_gap=int(rng.choice([0, 200, 1000])), target_duration=int(rng.choice([6000, 10000, 14000])))
+    firsts, lasts = plan_cuts(starts, ends, **kwargs)
+    assert list(zip(firsts.tolist(), lasts.tolist())) == greedy_cuts(starts, ends, **kwargs)
+
+
+def test_no_cues():
+    firsts, lasts = plan_cuts([], [])
+    assert len(firsts) == len(lasts) == 0
+    assert plan_segments(Subtitles.from_lines([])) == []
+
+
+def test_plan_segments():
+    subtitles = Subtitles.from_lines([line(0, 4000, 4000, 'one'), line(3000, 9000, 6000, 'two'),
+                                      line(4000, 5000, 1000, 'three'), line(9500, 11000, 1500, 'four'),
+                                      line(20000, 21000, 1000, 'five')])
+    # cuts after three and after four are both 1 s from target, the first one is taken
+    assert plan_segments(subtitles) == [segment(0, 9000, 'one two three'), segment(9500, 21000, 'four five')]
+    assert plan_segments(subtitles, min_duration=1000, target_duration=4000, max_duration=9000) == \
+        [segment(0, 9000, 'one two three'), segment(9500, 11000, 'four'), segment(20000, 21000, 'five')]
+
+
+def walked_alignment_cuts(starts: list, duration: int, max_duration=20000, pad=200) -> list:
+    """Word by word walk alignment_cuts replaced, words without start have start None or 0"""
+    result = []
+    first = previous = 0
+    for i, start in enumerate(starts):
+        if start and start - previous > max_duration:
+            start -= pad
+            result.append((first, i, previous, start))
+            first, previous = i, start
+    if starts and duration - previous <= max_duration:
+        result.append((first, len(starts), previous, duration))
+    return result
+
+
+def alignment_segments(starts: list, duration: int, **kwargs) -> list:
+    cuts = alignment_cuts([start or 0 for start in starts], duration, **kwargs)
+    return list(zip(*(values.tolist() for values in cuts)))
+
+
+def test_alignment_cuts():
+    starts = [0, 5000, 21000, None, 30000, 45000]
+    assert alignment_segments(starts, 50000) == [(0, 2, 0, 20800), (2, 5, 20800, 44800), (5, 6, 44800, 50000)]
+    # too long last segment is dropped, so is leading segment when first word starts late
+    assert alignment_segments(starts, 70000) == [(0, 2, 0, 20800), (2, 5, 20800, 44800)]
+    assert alignment_segments([25000, 26000], 30000) == [(0, 0, 0, 24800), (0, 2, 24800, 30000)]
+    assert alignment_segments([], 30000) == []
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_alignment_cuts_match_word_walk(seed):
+    rng = np.random.default_rng(seed)
+    n = int(rng.integers(0, 300))
+    starts = np.cumsum(rng.integers(0, 12000, n) * rng.choice([0, 1, 1, 1], n)).tolist()
+    # words without start and words starting before previous ones
+    starts = [None if rng.random() < 0.1 else max(start - int(rng.choice([0, 0, 0, 15000])), 0) for start in starts]
+    duration = max([start or 0 for start in starts], default=0) + int(rng.integers(0, 30000))
+    max_duration = int(rng.choice([10000, 20000]))
+    assert alignment_segments(starts, duration, max_duration=max_duration) == \
+        walked_alignment_cuts(starts, duration, max_duration=max_duration)
+
+
+def test_write_sorted_manifest(tmp_path):
+    lines = [f'{name}.flac audio/{name}.flac {duration} text of {name} \n'
+             for name, duration in [('a', '2500.00'), ('b', '400.00'), ('c', '2500.00'), ('d', '1000.00'),
+                                    ('e', '12000.00')]]
+    (tmp_path / 'transcript.lst').write_text(''.join(lines))
+    write_sorted_manifest(tmp_path)
+    # equal durations keep their order
+    assert (tmp_path / 'transcript_sorted.lst').read_text() == ''.join(lines[i] for i in [1, 3, 0, 2, 4])
+    assert json.loads((tmp_path / 'buckets.json').read_text()) == \
+        {'0-1000': [0, 1], '1000-2000': [1, 1], '2000-3000': [2, 2], '12000-13000': [4, 1]}
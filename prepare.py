@@ -1,90 +1,265 @@
+"""Dataset build CLI. Stages could be run one by one, each continues from outputs of previous ones:
+    fetch   - resolve metadata, download audio and captions into download cache
+    convert - fetch, then convert audio into converted cache
+    segment - fetch, convert and segment into output, downloads and conversions are taken from caches
+    pack    - pack output samples into shards
+    upload  - upload output and log wandb artifact
+    run     - all stages, output is packed and uploaded while processing goes on (default command)
+Work commands with --dry-run only estimate wall time of processing items in file order and longest first.
+Modules are imported by commands which need them, so startup stays fast"""
 import argparse
 import logging
 import os
-import tarfile
+import sys
 from pathlib import Path
 
-import wandb
+log = logging.getLogger(__name__)
 
-import utils
+COMMANDS = ('fetch', 'convert', 'segment', 'pack', 'upload', 'run')
 
-# Path manipulaton
-utils.add_ffmpeg_to_path()
-utils.add_sox_to_path()
 
-import work_base
-from youtube import YouTube
+def build_parser() -> argparse.ArgumentParser:
+    common_parser = argparse.ArgumentParser(add_help=False)
+    common_parser.add_argument('-p', '--path', type=str, help='Location of the dataset')
+    common_parser.add_argument('-d', '--dataset', type=str, help='Dataset')
+    common_parser.add_argument('--platform', type=str, default='cpu', help='Platform - cuda or cpu')
+    common_parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Number of workers')
+    common_parser.add_argument('--work-path', type=str, default=None,
+                               help='Existing work path to continue, new one is created by default')
+    common_parser.add_argument('--resume', action='store_true',
+                               help='Keep output and skip items finished according to work path manifest')
+    common_parser.add_argument('--debug', action='store_true', help='Connect to pydevd debug server')
 
-log = logging.getLogger(__name__)
+    work_parser = argparse.ArgumentParser(add_help=False)
+    work_parser.add_argument('--executor', type=str, default='thread', choices=('thread', 'process', 'pipeline'),
+                             help='thread/process pool for all stages or pipeline of I/O threads feeding CPU processes')
+    work_parser.add_argument('--io-workers', type=int, default=None,
+                             help='Number of metadata/download workers in pipeline executor')
+    work_parser.add_argument('--cpu-workers', type=int, default=None,
+                             help='Number of convert/segment workers in pipeline executor')
+    work_parser.add_argument('--max-inflight', type=int, default=None,
+                             help='Max number of items submitted to workers at once, 2 * workers by default')
+    work_parser.add_argument('--cache-budget', type=float, default=None,
+                             help='Max size of downloaded/converted intermediates in GB, unlimited by default')
+    work_parser.add_argument('--cache-max-age', type=float, default=None,
+                             help='Intermediates unused for more hours are evicted')
+    work_parser.add_argument('--stream', action='store_true',
+                             help='Decode audio through ffmpeg pipe straight into segmentation, without converted file')
+    work_parser.add_argument('--metadata-concurrency', type=int, default=None,
+                             help='Resolve episodes metadata with async resolver using that many concurrent requests')
+    work_parser.add_argument('--download-chunk-size', type=float, default=8,
+                             help='Audio streams are downloaded in parallel ranges of that many MB')
+    work_parser.add_argument('--download-parallelism', type=int, default=4,
+                             help='Number of parallel ranges per audio stream download')
+    work_parser.add_argument('--metadata-rate', type=float, default=5.0,
+                             help='Max metadata requests per second, lowered automatically while throttled')
+    work_parser.add_argument('--download-rate', type=float, default=20.0,
+                             help='Max download requests per second, lowered automatically while throttled')
+    work_parser.add_argument('--max-connections', type=int, default=16,
+                             help='Max in-flight requests of metadata and download stages, adapted to throttling')
+    work_parser.add_argument('--retry-attempts', type=int, default=5,
+                             help='Items failed with transient errors (throttling, timeouts) are retried that many '
+                                  'times, by the queue in queue mode')
+    work_parser.add_argument('--retry-delay', type=float, default=30.0,
+                             help='Seconds before first retry of item failed with transient error, doubled each time')
+    work_parser.add_argument('--timed-text', action='store_true',
+                             help='Fetch captions as timed text parsed in memory and kept in episode cache, '
+                                  'no SRT files are written')
+    work_parser.add_argument('--caption-languages', type=str, default='en,en-US,en-GB',
+                             help='Comma separated captions languages in order of preference')
+    work_parser.add_argument('--auto-captions', action='store_true',
+                             help='Fall back to auto-generated captions when there are no manual ones')
+    work_parser.add_argument('--min-duration', type=float, default=5.0, help='Min sample duration in seconds')
+    work_parser.add_argument('--target-duration', type=float, default=10.0, help='Preferred sample duration in seconds')
+    work_parser.add_argument('--max-duration', type=float, default=15.0, help='Max sample duration in seconds')
+    work_parser.add_argument('--order', type=str, default='file', choices=('file', 'lpt'),
+                             help='Process items in playlist order or longest first, so long ones do not end up last')
+    work_parser.add_argument('--dry-run', action='store_true',
+                             help='Only log audio hours and estimated wall time in file order and longest first')
+    work_parser.add_argument('--speed', type=float, default=25.0,
+                             help='Audio seconds one worker processes per second, for dry run estimates')
+    work_parser.add_argument('--item-overhead', type=float, default=10.0,
+                             help='Seconds of download and setup per item, for dry run estimates')
+    work_parser.add_argument('--plan-workers', type=str, default=None,
+                             help='Comma separated numbers of workers to estimate in dry run, '
+                                  'half, configured and double number of workers by default')
+    work_parser.add_argument('--shard', type=str, default=None,
+                             help='i/N - process only i-th of N hash partitions of the playlist')
+    work_parser.add_argument('--queue', type=str, default=None,
+                             help='Path of sqlite work queue on shared filesystem, hosts running with it share the work')
+    work_parser.add_argument('--lease', type=float, default=600.0,
+                             help='Seconds a claimed queue item stays leased without heartbeat')
+    work_parser.add_argument('--packed', action='store_true',
+                             help='Write samples into tar shards in output/shards instead of one file per sample')
+    work_parser.add_argument('--no-dedup', action='store_true',
+                             help='Segment identical audio of different urls again instead of reusing samples')
+    work_parser.add_argument('--metrics', action='store_true',
+                             help='Export stage latencies and counters to work path metrics.json and metrics.prom')
+    work_parser.add_argument('--progress-interval', type=float, default=60.0,
+                             help='Seconds between progress lines with ETA')
+    work_parser.add_argument('--features', type=str, default='none', choices=('none', 'logmel', 'mfcc'),
+                             help='Precompute features of samples into float16 shards in output/features')
+    work_parser.add_argument('--n-mels', type=int, default=80, help='Number of mel filters of features')
+    work_parser.add_argument('--n-mfcc', type=int, default=13, help='Number of MFCC coefficients of mfcc features')
+    work_parser.add_argument('--silence-statistic', type=str, default='rms', choices=('rms', 'peak', 'voiced'),
+                             help='Statistic used to filter out silent samples')
+    work_parser.add_argument('--silence-threshold', type=float, default=0.01,
+                             help='Samples with silence statistic not greater than threshold are skipped')
 
+    pack_parser = argparse.ArgumentParser(add_help=False)
+    pack_parser.add_argument('--pack-size', type=float, default=256,
+                             help='Packed shards are finalized when they reach that many MB')
 
-def main():
-    utils.start_debug()
+    upload_parser = argparse.ArgumentParser(add_help=False)
+    upload_parser.add_argument('--storage', type=str, default='gs://cprc-dataset-bucket/datasets',
+                               help='gs://bucket/prefix or local directory the dataset is uploaded to')
+    upload_parser.add_argument('--upload-workers', type=int, default=8, help='Number of parallel uploads')
 
     parser = argparse.ArgumentParser(description='Create a dataset for wav2letter from rc_meetings')
-    parser.add_argument('-p', '--path', type=str, help='Location of the dataset')
-    parser.add_argument('-d', '--dataset', type=str, help='Dataset')
-    parser.add_argument('--platform', type=str, default='cpu', help='Platform - cuda or cpu')
-    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Number of workers')
-    params = parser.parse_args()
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('fetch', parents=[common_parser, work_parser], help='Download episodes')
+    commands.add_parser('convert', parents=[common_parser, work_parser], help='Download and convert episodes')
+    commands.add_parser('segment', parents=[common_parser, work_parser, pack_parser], help='Build dataset output')
+    commands.add_parser('pack', parents=[common_parser, pack_parser], help='Pack output samples into shards')
+    commands.add_parser('upload', parents=[common_parser, upload_parser], help='Upload output')
+    commands.add_parser('run', parents=[common_parser, work_parser, pack_parser, upload_parser],
+                        help='Build and upload dataset')
+    return parser
 
-    if params.dataset.startswith('youtube_'):
-        WorkType = YouTube 
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv and argv[0] not in COMMANDS and argv[0] not in ('-h', '--help'):
+        argv = ['run'] + argv  # commandless invocation of previous versions
+    parser = build_parser()
+    params = parser.parse_args(argv)
+    if params.resume and not params.work_path:
+        parser.error('--resume requires --work-path')
+    if params.debug:
+        import utils
+        utils.start_debug()
+
+    work_path = setup_logging(params)
+    if getattr(params, 'dry_run', False):
+        create_work(params, work_path).plan(speed=params.speed, overhead=params.item_overhead,
+                                            workers=params.plan_workers and map(int, params.plan_workers.split(',')))
+    elif params.command in ('fetch', 'convert'):
+        create_work(params, work_path).run_stage(params.command)
+    elif params.command == 'segment':
+        create_work(params, work_path).run()
+    elif params.command == 'pack':
+        import planner
+        import shards
+        shards.pack_output(output_path(params), shard_size=int(params.pack_size * 2 ** 20))
+        planner.write_sorted_manifest(output_path(params))
+    elif params.command == 'upload':
+        uploader, version_name = create_uploader(params, work_path)
+        log_artifact(params.dataset, version_name, uploader.close(output_path(params)))
     else:
-        assert f'unsupported dataset: {params.dataset}'
-   
-    work_path = work_base.new_work_path()
+        uploader, version_name = create_uploader(params, work_path)
+        work = create_work(params, work_path, uploader=uploader)
+        work.run()
+        log_artifact(params.dataset, version_name, work.manifest_uri)
+
+
+def output_path(params) -> Path:
+    return Path().cwd() / params.dataset
+
+
+def setup_logging(params) -> Path:
+    """Returns work path, logs are written there"""
+    import utils
+
+    if params.work_path:
+        work_path = Path(params.work_path)
+        work_path.mkdir(parents=True, exist_ok=True)
+    else:
+        work_path = utils.uniq_file_name(prefix=f'{Path().cwd()}/work_path')
+        work_path.mkdir(parents=True, exist_ok=True)
     handler = logging.StreamHandler()
     handlers = [handler, logging.FileHandler(utils.uniq_file_name(prefix=f'{work_path}/log_', postfix='.log'))]
     logging.basicConfig(level=logging.INFO,
                         format='%(asctime)s|%(levelname)-4.4s|%(thread)s|%(filename)-10.10s|%(funcName)-10.10s|%(message)s',
                         handlers=handlers)
-    logging.getLogger('sox').setLevel(logging.WARNING)
-
+    log.info(f'command={params.command}')
     log.info(f'work_path={work_path}')
     log.info(f'dataset={params.dataset}')
-    
-    work = WorkType(work_path=Path(work_path), dataset_path=Path(params.path),
-                    dataset=params.dataset, platform=params.platform, workers=params.workers)
-    work.run()
-    upload(params.dataset)
+    return work_path
+
 
+def create_work(params, work_path: Path, uploader=None):
+    import features
+    import utils
+    from throttle import Requeue
+    from work_queue import SqliteQueueBackend
 
-def upload_blob(bucket_name, source_file_name, destination_blob_name):
-    """Uploads a file to the bucket."""
+    utils.add_ffmpeg_to_path()
+    if params.dataset.startswith('youtube_'):
+        from youtube import YouTube
+        WorkType = YouTube
+    else:
+        raise ValueError(f'unsupported dataset: {params.dataset}')
+    shard = tuple(map(int, params.shard.split('/'))) if params.shard else None
+    return WorkType(work_path=work_path, dataset_path=Path(params.path),
+                    dataset=params.dataset, platform=params.platform, workers=params.workers,
+                    silence_statistic=params.silence_statistic, silence_threshold=params.silence_threshold,
+                    executor=params.executor, io_workers=params.io_workers, cpu_workers=params.cpu_workers,
+                    max_inflight=params.max_inflight, resume=params.resume,
+                    cache_budget=params.cache_budget and int(params.cache_budget * 2 ** 30),
+                    cache_max_age=params.cache_max_age and params.cache_max_age * 3600,
+                    stream_audio=params.stream, metadata_concurrency=params.metadata_concurrency,
+                    download_chunk_size=int(params.download_chunk_size * 2 ** 20),
+                    download_parallelism=params.download_parallelism, min_duration=params.min_duration,
+                    target_duration=params.target_duration, max_duration=params.max_duration, shard=shard,
+                    queue=params.queue and SqliteQueueBackend(params.queue, max_attempts=params.retry_attempts + 1),
+                    lease=params.lease, packed=params.packed,
+                    shard_size=int(getattr(params, 'pack_size', 256) * 2 ** 20),
+                    uploader=uploader, export_metrics=params.metrics, progress_interval=params.progress_interval,
+                    dedup=not params.no_dedup, metadata_rate=params.metadata_rate,
+                    download_rate=params.download_rate, max_connections=params.max_connections,
+                    requeue=Requeue(attempts=params.retry_attempts, delay=params.retry_delay),
+                    timed_text=params.timed_text, caption_languages=params.caption_languages.split(','),
+                    auto_captions=params.auto_captions,
+                    features=features.create(params.features, n_mels=params.n_mels, n_mfcc=params.n_mfcc),
+                    order=params.order)
 
-    from google.cloud import storage
-    from google.oauth2 import service_account
 
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(bucket_name)
-    blob = bucket.blob(destination_blob_name)
+def create_uploader(params, work_path: Path):
+    """Returns uploader and versioned dataset name"""
+    from uploader import Uploader, create_backend
 
-    blob.upload_from_filename(source_file_name)
-    logging.info("Uploaded {}".format(blob.crc32c))
-    return blob
+    setup_credentials()
+    # resumed run keeps uploading to the same destination, already uploaded files are skipped
+    version_path = work_path / 'upload_version'
+    if not version_path.exists():
+        version_path.write_text(f'{params.dataset}_v{dataset_version(params.dataset)}')
+    version_name = version_path.read_text()
+    return Uploader(create_backend(f'{params.storage}/{version_name}'), workers=params.upload_workers), version_name
 
 
-def upload(name):
+def setup_credentials():
     os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = '/home/comp/git/gke_service_account.json'
     os.environ["WANDB_API_KEY"] = '5c5f03d42e16ce3df7aaabb404480128adef6719'
 
+
+def dataset_version(name):
+    import wandb
+
     api = wandb.Api()
     try:
         existing = api.artifact(f"cprc/asr/{name}:latest")
-        version = int(existing.name.split(":")[-1][1:]) + 1
+        return int(existing.name.split(":")[-1][1:]) + 1
     except wandb.apis.CommError as e:
         if 'does not contain artifact' in str(e):
-            version = 0
+            return 0
         else:
             raise e
-    new_name = f"{name}_v{version}.tar"
-    with tarfile.open(new_name, "w:gz") as tar:
-        tar.add(name, arcname=os.path.basename(name))
 
-    upload_blob(bucket_name="cprc-dataset-bucket",
-                source_file_name=new_name,
-                destination_blob_name=f"datasets/{new_name}")
+
+def log_artifact(name, version_name, manifest_uri):
+    """Dataset files are uploaded during the run, artifact references manifest listing them"""
+    import wandb
+
     run = wandb.init(job_type="create-dataset",
                      tags=["dataset_creation"],
                      group="dataset",
@@ -93,7 +268,7 @@ def upload(name):
                      entity="cprc")
 
     artifact = wandb.Artifact(type='dataset', name=name)
-    artifact.add_reference(uri=f"gs://cprc-dataset-bucket/datasets/{new_name}", name=new_name)
+    artifact.add_reference(uri=manifest_uri, name=f'{version_name}/manifest.json')
     run.log_artifact(artifact)
 
 
@@ -0,0 +1,26 @@
+import json
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+import benchmark
+import prepare
+
+HEAVY_MODULES = ('wandb', 'pytube', 'google.cloud', 'sox', 'pydevd', 'numpy', 'requests', 'aiohttp')
+
+
+@pytest.mark.parametrize('command', prepare.COMMANDS)
+def test_help_imports_no_heavy_modules(command):
+    code = (f'import json, sys\nimport prepare\ntry:\n    prepare.main([{command!r}, "--help"])\n'
+            f'except SystemExit:\n    pass\nprint(json.dumps([m for m in {HEAVY_MODULES!r} if m in sys.modules]))')
+    result = subprocess.run([sys.executable, '-c', code], cwd=Path(prepare.__file__).parent, check=True,
+                            capture_output=True, text=True)
+    assert json.loads(result.stdout.splitlines()[-1]) == []
+
+
+def test_cold_start_budget():
+    timings = benchmark.cold_start()
+    assert set(timings) == set(prepare.COMMANDS)
+    assert max(timings.values()) < benchmark.COLD_START_BUDGET, timings
@@ -0,0 +1,152 @@
+import asyncio
+import json
+import logging
+import random
+import re
+import time
+from collections import namedtuple
+from typing import Dict, Iterable, List, Optional
+
+import aiohttp
+
+from throttle import Throttle, TransientError, is_throttled
+
+log = logging.getLogger(__name__)
+
+video_record = namedtuple('video_record', 'video_id duration streams captions error')
+stream_record = namedtuple('stream_record', 'itag mime_type codec abr filesize url')
+caption_record = namedtuple('caption_record', 'language_code name kind url')
+
+PLAYER_RESPONSE_RE = re.compile(r'ytInitialPlayerResponse\s*=\s*')
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+def parse_player_response(html: str) -> dict:
+    match = PLAYER_RESPONSE_RE.search(html)
+    if match is None:
+        raise ValueError('ytInitialPlayerResponse not found')
+    player_response, _ = json.JSONDecoder().raw_decode(html, match.end())
+    return player_response
+
+
+def parse_streams(player_response: dict) -> List[stream_record]:
+    streaming_data = player_response.get('streamingData', {})
+    streams = []
+    for fmt in streaming_data.get('formats', []) + streaming_data.get('adaptiveFormats', []):
+        mime_type = fmt.get('mimeType', '')
+        codec = re.search(r'codecs="([^"]+)"', mime_type)
+        bitrate = fmt.get('averageBitrate') or fmt.get('bitrate') or 0
+        streams.append(stream_record(
+            itag=fmt.get('itag'),
+            mime_type=mime_type.split(';')[0],
+            codec=codec.group(1) if codec else None,
+            abr=f'{bitrate // 1000}kbps',
+            filesize=int(fmt.get('contentLength', 0)) or None,
+            url=fmt.get('url')))  # None for streams with signatureCipher, they need pytube deciphering
+    return streams
+
+
+def parse_captions(player_response: dict) -> List[caption_record]:
+    tracks = (player_response.get('captions', {})
+              .get('playerCaptionsTracklistRenderer', {})
+              .get('captionTracks', []))
+    captions = []
+    for track in tracks:
+        name = track.get('name', {})
+        name = name.get('simpleText') or ''.join(run.get('text', '') for run in name.get('runs', []))
+        captions.append(caption_record(language_code=track.get('languageCode'), name=name,
+                                       kind=track.get('kind'), url=track.get('baseUrl')))
+    return captions
+
+
+def parse_record(video_id: str, html: str) -> video_record:
+    player_response = parse_player_response(html)
+    status = player_response.get('playabilityStatus', {})
+    if status.get('status', 'OK') != 'OK':
+        return video_record(video_id, None, [], [], f'{status.get("status")}: {status.get("reason")}')
+    duration = player_response.get('videoDetails', {}).get('lengthSeconds')
+    return video_record(video_id=video_id, duration=duration and float(duration),
+                        streams=parse_streams(player_response), captions=parse_captions(player_response), error=None)
+
+
+class MetadataResolver:
+    """Fetches watch page metadata for many video ids concurrently over shared connection pool.
+    At most concurrency requests are in flight, failed requests are retried with jittered exponential backoff.
+    With throttle given, requests are spaced by its token bucket and their outcomes adapt its rate.
+    Ids which still fail with transient errors after all attempts are left out of results, so they are
+    resolved again later instead of being recorded as failed.
+    base_url could point to local server with recorded responses"""
+
+    def __init__(self, base_url: str = 'https://www.youtube.com', concurrency: int = 16, attempts: int = 5,
+                 timeout: float = 30.0, backoff: float = 1.0, max_backoff: float = 60.0, throttle: Throttle = None):
+        self.base_url = base_url.rstrip('/')
+        self.throttle = throttle
+        self.concurrency = concurrency
+        self.attempts = attempts
+        self.timeout = timeout
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    def resolve(self, video_ids: Iterable[str]) -> Dict[str, video_record]:
+        return asyncio.run(self.resolve_async(video_ids))
+
+    async def resolve_async(self, video_ids: Iterable[str]) -> Dict[str, video_record]:
+        semaphore = asyncio.Semaphore(self.concurrency)
+        connector = aiohttp.TCPConnector(limit=self.concurrency)
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        headers = {'Accept-Language': 'en-US,en'}
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout, headers=headers) as session:
+            records = await asyncio.gather(*(self._resolve_one(session, semaphore, video_id)
+                                             for video_id in video_ids))
+        return {record.video_id: record for record in records if record is not None}
+
+    async def _resolve_one(self, session, semaphore, video_id: str) -> Optional[video_record]:
+        for attempt in range(self.attempts):
+            try:
+                async with semaphore:
+                    html = await self._throttled_fetch(session, video_id)
+                return parse_record(video_id, html)
+            except aiohttp.ClientResponseError as e:
+                log.error(f'Got HTTP {e.status} while resolving {video_id}')
+                return video_record(video_id, None, [], [], f'HTTP {e.status}')
+            except (aiohttp.ClientError, asyncio.TimeoutError, TransientError) as e:
+                if attempt == self.attempts - 1:
+                    log.error(f'Giving up resolving {video_id} for now: {e!r}')
+                    return None
+                delay = self.delay(attempt)
+                log.warning(f'Got {e!r} while resolving {video_id}, retrying in {delay:.1f}s')
+                await asyncio.sleep(delay)
+            except Exception as e:
+                log.exception(f'Got exception while resolving {video_id}')
+                return video_record(video_id, None, [], [], repr(e))
+
+    def delay(self, attempt: int) -> float:
+        """Full jitter exponential backoff"""
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    async def _throttled_fetch(self, session, video_id: str) -> str:
+        if self.throttle is None:
+            return await self._fetch(session, video_id)
+        await asyncio.sleep(self.throttle.reserve())
+        start = time.monotonic()
+        try:
+            html = await self._fetch(session, video_id)
+        except (aiohttp.ClientError, asyncio.TimeoutError, TransientError) as e:
+            self.throttle.record(time.monotonic() - start,
+                                 throttled=isinstance(e, asyncio.TimeoutError) or is_throttled(e), kind='watch')
+            raise
+        self.throttle.record(time.monotonic() - start, kind='watch')
+        return html
+
+    async def _fetch(self, session, video_id: str) -> str:
+        async with session.get(f'{self.base_url}/watch', params={'v': video_id}) as response:
+            if response.status in RETRY_STATUSES:
+                raise TransientError(f'HTTP {response.status}', status=response.status)
+            response.raise_for_status()
+            return await response.text()
+
+
+def best_audio(record: video_record, codec: str = 'opus') -> Optional[stream_record]:
+    """Highest bitrate audio stream with given codec"""
+    streams = [s for s in record.streams if s.mime_type.startswith('audio/') and s.codec == codec]
+    return max(streams, key=lambda s: int(s.abr[:-4]), default=None)
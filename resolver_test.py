@@ -0,0 +1,135 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+from resolver import MetadataResolver, best_audio, caption_record, stream_record, video_record
+from throttle import Throttle
+
+
+def player_response(video_id: str) -> dict:
+    return {
+        'playabilityStatus': {'status': 'OK'},
+        'videoDetails': {'videoId': video_id, 'lengthSeconds': '61'},
+        'streamingData': {
+            'formats': [{'itag': 18, 'mimeType': 'video/mp4; codecs="avc1.42001E, mp4a.40.2"', 'bitrate': 500000,
+                         'url': f'http://s/{video_id}/18'}],
+            'adaptiveFormats': [
+                {'itag': 140, 'mimeType': 'audio/mp4; codecs="mp4a.40.2"', 'averageBitrate': 129000,
+                 'contentLength': '990000', 'url': f'http://s/{video_id}/140'},
+                {'itag': 250, 'mimeType': 'audio/webm; codecs="opus"', 'averageBitrate': 64000,
+                 'contentLength': '490000', 'url': f'http://s/{video_id}/250'},
+                {'itag': 251, 'mimeType': 'audio/webm; codecs="opus"', 'bitrate': 160000, 'averageBitrate': 130000,
+                 'contentLength': '1000000', 'signatureCipher': 's=x&url=http://s'}]},
+        'captions': {'playerCaptionsTracklistRenderer': {'captionTracks': [
+            {'baseUrl': f'http://c/{video_id}/en', 'name': {'simpleText': 'English'}, 'languageCode': 'en'},
+            {'baseUrl': f'http://c/{video_id}/a.en', 'name': {'runs': [{'text': 'English '}, {'text': '(auto)'}]},
+             'languageCode': 'en', 'kind': 'asr'}]}}}
+
+
+UNPLAYABLE = {'playabilityStatus': {'status': 'ERROR', 'reason': 'Video unavailable'}}
+
+
+class WatchHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        video_id = parse_qs(urlparse(self.path).query)['v'][0]
+        with server.lock:
+            server.requests.append(video_id)
+            server.inflight += 1
+            server.max_inflight = max(server.max_inflight, server.inflight)
+            failing = server.failures.get(video_id, 0)
+            server.failures[video_id] = failing - 1
+        time.sleep(server.delay)
+        with server.lock:
+            server.inflight -= 1
+        status = server.statuses.get(video_id, 200) if failing <= 0 else 503
+        if video_id in server.pages:
+            body = server.pages[video_id]
+        else:
+            body = f'<script>var ytInitialPlayerResponse = {json.dumps(player_response(video_id))};</script>'
+        body = body.encode() if status == 200 else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class WatchServer(ThreadingHTTPServer):
+    """Local stand-in of watch pages. Answers next failures[id] requests of id with 503, then with statuses[id]
+    or with pages[id], by default with a page of playable video"""
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), WatchHandler)
+        self.failures = {}
+        self.statuses = {}
+        self.pages = {}
+        self.delay = 0.0
+        self.requests = []
+        self.inflight = self.max_inflight = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+
+@pytest.fixture
+def server():
+    server = WatchServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_watch_page_is_mapped_to_record(server):
+    server.pages['unplayable1'] = f'ytInitialPlayerResponse = {json.dumps(UNPLAYABLE)};'
+    records = MetadataResolver(base_url=server.url).resolve(['abcdefghijk', 'unplayable1'])
+    record = records['abcdefghijk']
+    assert (record.video_id, record.duration, record.error) == ('abcdefghijk', 61.0, None)
+    assert record.streams == [
+        stream_record(18, 'video/mp4', 'avc1.42001E, mp4a.40.2', '500kbps', None, 'http://s/abcdefghijk/18'),
+        stream_record(140, 'audio/mp4', 'mp4a.40.2', '129kbps', 990000, 'http://s/abcdefghijk/140'),
+        stream_record(250, 'audio/webm', 'opus', '64kbps', 490000, 'http://s/abcdefghijk/250'),
+        stream_record(251, 'audio/webm', 'opus', '130kbps', 1000000, None)]
+    assert record.captions == [caption_record('en', 'English', None, 'http://c/abcdefghijk/en'),
+                               caption_record('en', 'English (auto)', 'asr', 'http://c/abcdefghijk/a.en')]
+    assert best_audio(record).itag == 251 and best_audio(record, codec='mp4a.40.2').itag == 140
+    assert best_audio(record, codec='vorbis') is None
+    assert records['unplayable1'] == video_record('unplayable1', None, [], [], 'ERROR: Video unavailable')
+
+
+def test_batch_is_resolved_with_bounded_concurrency(server):
+    server.delay = 0.05
+    video_ids = [f'video{i:06d}' for i in range(20)]
+    records = MetadataResolver(base_url=server.url, concurrency=4).resolve(video_ids)
+    assert sorted(records) == video_ids and all(record.error is None for record in records.values())
+    assert sorted(server.requests) == video_ids
+    assert 1 < server.max_inflight <= 4
+
+
+def test_transient_errors_are_retried_then_left_out(server):
+    server.failures = {'recovered01': 2, 'unavailable': 10}
+    server.statuses = {'missing0001': 404}
+    server.pages = {'garbled0001': '<html>no player response</html>'}
+    throttle = Throttle('metadata', rate=1000.0, max_concurrency=8, cooldown=0.0)
+    resolver = MetadataResolver(base_url=server.url, attempts=3, backoff=0.01, max_backoff=0.02, throttle=throttle)
+    records = resolver.resolve(['recovered01', 'unavailable', 'missing0001', 'garbled0001'])
+    # still failing id is not recorded as failed, so it is resolved again later
+    assert sorted(records) == ['garbled0001', 'missing0001', 'recovered01']
+    assert records['recovered01'].error is None and records['recovered01'].duration == 61.0
+    assert records['missing0001'] == video_record('missing0001', None, [], [], 'HTTP 404')
+    assert 'ytInitialPlayerResponse not found' in records['garbled0001'].error
+    assert {video_id: server.requests.count(video_id) for video_id in set(server.requests)} == \
+        dict(recovered01=3, unavailable=3, missing0001=1, garbled0001=1)
+    assert throttle.limit < 8  # 503s cut the limit
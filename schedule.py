@@ -0,0 +1,50 @@
+import heapq
+import logging
+from typing import List, Optional, Sequence, TypeVar
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+ORDERS = ('file', 'lpt')
+
+T = TypeVar('T')
+
+
+def fill_unknown(durations: Sequence[Optional[float]]) -> np.ndarray:
+    """Durations with unknown (None) ones replaced by median of known ones, 0 if none is known"""
+    known = [d for d in durations if d is not None]
+    default = float(np.median(known)) if known else 0.0
+    return np.array([default if d is None else d for d in durations], dtype=np.float64)
+
+
+def lpt_order(items: Sequence[T], durations: Sequence[Optional[float]]) -> List[T]:
+    """Items longest first. Workers of a pool taking items in this order finish within 4/3 of optimal makespan,
+    long items do not end up alone at the tail. Order of items with equal durations is kept"""
+    order = np.argsort(-fill_unknown(durations), kind='stable')
+    return [items[i] for i in order]
+
+
+def makespan(times: Sequence[float], workers: int) -> float:
+    """Wall time of pool of workers taking items in order as they get free"""
+    finish = [0.0] * max(min(workers, len(times)), 1)
+    for t in times:
+        heapq.heappush(finish, heapq.heappop(finish) + float(t))
+    return max(finish)
+
+
+def summary(durations: Sequence[Optional[float]]) -> dict:
+    filled = fill_unknown(durations)
+    return dict(items=len(durations), unknown=sum(d is None for d in durations),
+                audio_hours=float(filled.sum()) / 3600, longest_hours=float(filled.max(initial=0)) / 3600)
+
+
+def estimate(durations: Sequence[Optional[float]], workers: int, speed: float, overhead: float) -> dict:
+    """Estimated wall time of processing items by workers in file order and longest first.
+    Item takes overhead + duration / speed seconds, speed is audio seconds one worker processes per second"""
+    times = overhead + fill_unknown(durations) / speed
+    file_time = makespan(times, workers)
+    lpt_time = makespan(np.sort(times)[::-1], workers)
+    return dict(workers=workers, file_order_hours=file_time / 3600, lpt_hours=lpt_time / 3600,
+                lower_bound_hours=max(float(times.sum()) / workers, float(times.max(initial=0))) / 3600,
+                speedup=file_time / lpt_time if lpt_time else 1.0)
@@ -0,0 +1,161 @@
+import io
+import logging
+import re
+import tempfile
+from collections import namedtuple
+from pathlib import Path
+from typing import Iterable, List, Tuple
+
+import numpy as np
+import soundfile
+
+import metrics
+from features import LogMel
+from silence import SilenceFilter
+
+log = logging.getLogger(__name__)
+
+segment = namedtuple('segment', 'start end text')  # start/end in ms
+
+
+def load_pcm(audio_path: Path, mmap_threshold: float = 600.0) -> Tuple[np.ndarray, int]:
+    """Decode whole audio file once into int16 mono buffer.
+    Files longer than mmap_threshold seconds are decoded into anonymous memory mapped file"""
+    info = soundfile.info(str(audio_path))
+    if info.duration <= mmap_threshold:
+        data, samplerate = soundfile.read(str(audio_path), dtype='int16', always_2d=True)
+        return to_mono(data), samplerate
+
+    # TemporaryFile is unlinked right away, the mapping keeps it alive until buffer is released
+    buffer = np.memmap(tempfile.TemporaryFile(), dtype=np.int16, mode='w+', shape=(info.frames,))
+    offset = 0
+    for block in soundfile.blocks(str(audio_path), blocksize=info.samplerate * 60, dtype='int16', always_2d=True):
+        buffer[offset:offset + len(block)] = to_mono(block)
+        offset += len(block)
+    return buffer[:offset], info.samplerate
+
+
+def to_mono(data: np.ndarray) -> np.ndarray:
+    if data.shape[1] == 1:
+        return data[:, 0]
+    return data.mean(axis=1).astype(np.int16)
+
+
+def with_features(lines: List[tuple], features: List[np.ndarray]) -> List[tuple]:
+    """(transcript, text, audio or None, features) lines"""
+    return [(line[0], line[1], line[2] if len(line) > 2 else None, values) for line, values in zip(lines, features)]
+
+
+def sample_name(audio_name: str, start, end) -> str:
+    name = re.sub(r'[^\d-]', '', f'{start}-{end}')
+    return f'{audio_name}-{name}.flac'
+
+
+class Segmenter:
+    """Splits audio into samples.
+    write: audio file is decoded once and all segments are written from the decoded buffer in a single pass.
+    write_stream: PCM chunks are consumed as they are decoded and each segment is written as soon as
+        its end is reached, so only about one segment is held in memory
+    With packed=True samples are not written to files, encoded FLAC bytes are appended to result lines
+    as third element for shards.ShardWriter.
+    With features given, features of saved samples are computed from the same PCM and appended to result lines
+    as fourth element for features.FeatureWriter, third element is None unless packed"""
+
+    def __init__(self, output_audio_path: Path, silence_filter: SilenceFilter = None, mmap_threshold: float = 600.0,
+                 packed: bool = False, features: LogMel = None):
+        self.output_audio_path = output_audio_path
+        self.packed = packed
+        self.features = features
+        self.silence_filter = silence_filter or SilenceFilter()
+        self.mmap_threshold = mmap_threshold
+
+    def write(self, audio_path: Path, segments: Iterable[segment], results: List[Tuple[str, str]]) -> int:
+        """Write all segments of audio_path, append (transcript, text) lines to results.
+        Returns summary duration of segments in ms"""
+        segments = list(segments)
+        if not segments:
+            return 0
+        with metrics.timer('decode'):
+            pcm, samplerate = load_pcm(audio_path, mmap_threshold=self.mmap_threshold)
+        return self.write_pcm(audio_path.name, pcm, samplerate, segments, results)
+
+    def write_pcm(self, audio_name: str, pcm: np.ndarray, samplerate: int, segments: List[segment],
+                  results: List[Tuple[str, str]]) -> int:
+        """Same as write for already decoded audio (e.g. load_pcm)"""
+        if not segments:
+            return 0
+        bounds = np.array([(start, end) for start, end, _ in segments], dtype=np.int64) * samplerate // 1000
+        with metrics.timer('silence'):
+            stats = self.silence_filter.stats(pcm, samplerate, bounds)
+        accum_duration = 0
+        saved = []
+        for (start, end, text), (first, last), stat in zip(segments, bounds, stats):
+            if self._save(pcm[first:last], samplerate, sample_name(audio_name, start, end), end - start, text, stat,
+                          results):
+                saved.append(pcm[first:last])
+            accum_duration += end - start
+        if self.features is not None and saved:
+            with metrics.timer('features'):
+                features = self.features.batch(saved)
+            results[-len(saved):] = with_features(results[-len(saved):], features)
+        return accum_duration
+
+    def write_stream(self, audio_name: str, chunks: Iterable[np.ndarray], samplerate: int,
+                     segments: Iterable[segment], results: List[Tuple[str, str]]) -> int:
+        """Same as write, but audio is consumed from int16 mono chunks (e.g. utils.decode_stream).
+        Without segments chunks are not consumed, so nothing is decoded"""
+        segments = sorted(segments, key=lambda s: s.start)
+        if not segments:
+            return 0
+        chunks = iter(chunks)
+        buffer = np.zeros(0, dtype=np.int16)
+        buffer_start = 0  # offset of buffer[0] in stream
+        accum_duration = 0
+        for start, end, text in segments:
+            first, last = int(start * samplerate // 1000), int(end * samplerate // 1000)
+            while True:
+                # samples before current segment are never needed again
+                drop = min(max(first - buffer_start, 0), len(buffer))
+                buffer = buffer[drop:]
+                buffer_start += drop
+                if buffer_start + len(buffer) >= last:
+                    break
+                chunk = next(chunks, None)
+                if chunk is None:
+                    break
+                buffer = np.concatenate([buffer, chunk])
+            samples = buffer[max(first - buffer_start, 0):last - buffer_start]
+            stat = self.silence_filter.stats(samples, samplerate, [(0, len(samples))])[0]
+            if self._save(samples, samplerate, sample_name(audio_name, start, end), end - start, text, stat, results) \
+                    and self.features is not None:
+                with metrics.timer('features'):
+                    results[-1:] = with_features(results[-1:], [self.features(samples)])
+            accum_duration += end - start
+        for _ in chunks:  # let decoder finish and report errors
+            pass
+        return accum_duration
+
+    def _save(self, samples, samplerate, name, duration, text, stat, results) -> bool:
+        """Returns False if sample is skipped as silent"""
+        # Filter out mostly silent samples before encoding
+        if stat <= self.silence_filter.threshold:
+            log.warning(f'Skipped silent file {name} with {self.silence_filter.statistic} {stat}')
+            metrics.inc('samples_total', result='silent')
+            return False
+        text = re.sub(r'\s+', ' ', text)
+        log.info(f'Saving part: {name}')
+        text_result = f'{text}\n'
+        metrics.inc('samples_total', result='saved')
+        if self.packed:
+            buffer = io.BytesIO()
+            with metrics.timer('encode'):
+                soundfile.write(buffer, samples, samplerate, format='FLAC', subtype='PCM_16')
+            metrics.inc('bytes_total', buffer.tell(), kind='output')
+            results.append((f'{name} shards/{name} {duration:.2f} {text} \n', text_result, buffer.getvalue()))
+            return True
+        with metrics.timer('encode'):
+            soundfile.write(str(self.output_audio_path / name), samples, samplerate, format='FLAC', subtype='PCM_16')
+        metrics.inc('bytes_total', (self.output_audio_path / name).stat().st_size, kind='output')
+        transcript_result = f'{name} audio/{name} {duration:.2f} {text} \n'
+        results.append((transcript_result, text_result))
+        return True
@@ -0,0 +1,87 @@
+import io
+
+import numpy as np
+import pytest
+import soundfile
+
+from segmenter import Segmenter, segment
+from silence import SilenceFilter
+
+SAMPLERATE = 16000
+SEGMENTS = [segment(0, 1000, 'first'), segment(900, 2500, 'overlaps  first'), segment(3000, 3001, 'short'),
+            segment(4000, 5000, 'silent'), segment(5500, 7000, 'past end')]
+
+
+def pcm() -> np.ndarray:
+    """6 s of noise with silent 5th second"""
+    audio = (np.random.default_rng(0).standard_normal(6 * SAMPLERATE) * 3000).astype(np.int16)
+    audio[4 * SAMPLERATE:5 * SAMPLERATE] = 0
+    return audio
+
+
+def chunks(audio: np.ndarray, seed: int = 0):
+    """Chunks of random sizes, like pipe reads"""
+    rng = np.random.default_rng(seed)
+    offset = 0
+    while offset < len(audio):
+        size = int(rng.integers(1, SAMPLERATE))
+        yield audio[offset:offset + size]
+        offset += size
+
+
+def samples(lines: list) -> dict:
+    return {line[0].split()[0]: soundfile.read(io.BytesIO(line[2]), dtype='int16')[0] for line in lines}
+
+
+def test_write_decodes_once_and_writes_all_segments(tmp_path):
+    soundfile.write(str(tmp_path / 'a.wav'), pcm(), SAMPLERATE)
+    written = []
+    assert Segmenter(tmp_path, packed=True).write(tmp_path / 'a.wav', SEGMENTS, written) == 5101
+    assert [line[0].split()[0] for line in written] == \
+        ['a.wav-0-1000.flac', 'a.wav-900-2500.flac', 'a.wav-3000-3001.flac', 'a.wav-5500-7000.flac']
+    assert written[1][1] == 'overlaps first\n'
+    written = samples(written)
+    np.testing.assert_array_equal(written['a.wav-900-2500.flac'], pcm()[900 * 16:2500 * 16])
+    assert len(written['a.wav-5500-7000.flac']) == SAMPLERATE // 2
+
+
+@pytest.mark.parametrize('seed', [0, 1])
+def test_write_stream_produces_the_same_samples_as_write(tmp_path, seed):
+    soundfile.write(str(tmp_path / 'a.wav'), pcm(), SAMPLERATE)
+    segmenter = Segmenter(tmp_path, packed=True)
+    written, streamed = [], []
+    segmenter.write(tmp_path / 'a.wav', SEGMENTS, written)
+    assert segmenter.write_stream('a.wav', chunks(pcm(), seed), SAMPLERATE, SEGMENTS, streamed) == 5101
+    assert [line[:2] for line in written] == [line[:2] for line in streamed]
+    written, streamed = samples(written), samples(streamed)
+    assert written.keys() == streamed.keys()
+    for name, data in written.items():
+        np.testing.assert_array_equal(data, streamed[name])
+
+
+def test_samples_are_written_to_files(tmp_path):
+    (tmp_path / 'audio').mkdir()
+    segmenter = Segmenter(tmp_path / 'audio', silence_filter=SilenceFilter('peak', threshold=0.5))
+    results = []
+    segmenter.write_pcm('a.wav', pcm(), SAMPLERATE, [segment(0, 1000, 'quiet'), segment(1000, 2000, 'loud')],
+                        results)
+    # noise peaks stay below half of full scale, except one loud click
+    assert results == []
+    audio = pcm()
+    audio[1500 * 16] = 30000
+    segmenter.write_pcm('a.wav', audio, SAMPLERATE, [segment(0, 1000, 'quiet'), segment(1000, 2000, 'loud')],
+                        results)
+    assert results == [('a.wav-1000-2000.flac audio/a.wav-1000-2000.flac 1000.00 loud \n', 'loud\n')]
+    data, samplerate = soundfile.read(str(tmp_path / 'audio' / 'a.wav-1000-2000.flac'), dtype='int16')
+    np.testing.assert_array_equal(data, audio[16000:32000])
+
+
+def test_write_stream_without_segments_decodes_nothing(tmp_path):
+    consumed = []
+
+    def decoded():
+        consumed.append(True)
+        yield pcm()
+
+    assert Segmenter(tmp_path).write_stream('a.wav', decoded(), SAMPLERATE, [], []) == 0
+    assert not consumed
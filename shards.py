@@ -0,0 +1,201 @@
+import io
+import json
+import logging
+import shutil
+import tarfile
+import time
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+log = logging.getLogger(__name__)
+
+EXTENSIONS = ('.flac', '.txt', '.json')
+
+
+def sample_key(transcript: str) -> str:
+    """Key of sample in shards for transcript line: <name>.flac <path> <duration> <text>"""
+    return transcript.split(' ', 1)[0][:-len('.flac')]
+
+
+def line_samples(lines: List[tuple]) -> Iterator[Tuple[str, bytes, str, float]]:
+    """Converts (transcript, text, audio) lines of packed Segmenter to ShardWriter samples"""
+    for transcript, text, audio, *_ in lines:
+        _, _, duration, _ = transcript.split(' ', 3)
+        yield sample_key(transcript), audio, text.strip(), float(duration)
+
+
+class ShardedWriter:
+    """Base of writers streaming samples of items into size bounded shards <prefix>-<number><suffix>,
+    numbered from 0. Shard is written as <name><suffix>.tmp and renamed when it is full, then its index
+    <name>.idx - json lines locating each sample - is written, so only shards with index are finalized.
+    Numbers of shards already in the directory are skipped, so resumed runs do not overwrite them.
+    on_finalize is called with path of each finalized shard, so downstream steps can start early"""
+    suffix = ''
+
+    def __init__(self, path: Path, shard_size: int, prefix: str, on_finalize: Callable[[Path], None] = None):
+        self.path = path
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.shard_size = shard_size
+        self.prefix = prefix
+        self.on_finalize = on_finalize
+        self.shards = 0
+        self._number = 0
+        self._tmp_path = None
+        self._index = []
+        # leftovers of interrupted run
+        for tmp_path in [*self.path.glob(f'*{self.suffix}.tmp'), *self.path.glob('*.idx.tmp')]:
+            tmp_path.unlink()
+        for shard_path in self.path.glob(f'*{self.suffix}'):
+            if not shard_path.with_suffix('.idx').exists():
+                shard_path.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.finalize()
+
+    def write(self, samples: Iterable[tuple]) -> None:
+        """Adds samples of one item. Shard is finalized only between items,
+        so samples of an item never span finalized and unfinished shards"""
+        for sample in samples:
+            self.add(*sample)
+        if self._tmp_path is not None and self._size() >= self.shard_size:
+            self.finalize()
+
+    def finalize(self) -> Optional[Path]:
+        """Closes current shard, returns its path"""
+        if self._tmp_path is None:
+            return None
+        self._close()
+        shard_path = self._tmp_path.with_suffix('')
+        self._tmp_path.rename(shard_path)
+        self._tmp_path = None
+        index_path = shard_path.with_suffix('.idx')
+        with index_path.with_suffix('.idx.tmp').open('w') as fp:
+            fp.writelines(json.dumps(entry) + '\n' for entry in self._index)
+        index_path.with_suffix('.idx.tmp').rename(index_path)
+        self.shards += 1
+        log.info(f'Finalized shard {shard_path}: {len(self._index)} entries')
+        if self.on_finalize is not None:
+            self.on_finalize(shard_path)
+        return shard_path
+
+    def _next_path(self) -> Path:
+        """Temporary path of new shard, its index is started"""
+        while (self.path / f'{self.prefix}-{self._number:06d}{self.suffix}').exists():
+            self._number += 1
+        self._tmp_path = self.path / f'{self.prefix}-{self._number:06d}{self.suffix}.tmp'
+        self._number += 1
+        self._index = []
+        return self._tmp_path
+
+    def add(self, *sample) -> None:
+        raise NotImplementedError()
+
+    def _size(self) -> int:
+        """Bytes written into current shard"""
+        raise NotImplementedError()
+
+    def _close(self) -> None:
+        raise NotImplementedError()
+
+
+class ShardWriter(ShardedWriter):
+    """Streams (key, audio, text, duration) samples into size bounded tar shards
+    (WebDataset layout: <key>.flac, <key>.txt, <key>.json). <name>.idx has data offset and size of each member,
+    used for random access, see ShardedWriter"""
+    suffix = '.tar'
+
+    def __init__(self, shards_path: Path, shard_size: int = 256 * 2 ** 20, prefix: str = None,
+                 on_finalize: Callable[[Path], None] = None):
+        super().__init__(shards_path, shard_size, prefix or f'shard-{time.strftime("%y%m%d_%H%M%S")}', on_finalize)
+        self.samples = 0
+        self._tar = None
+
+    def add(self, key: str, audio: bytes, text: str, duration: float) -> None:
+        if self._tar is None:
+            self._tar = tarfile.open(self._next_path(), 'w', format=tarfile.GNU_FORMAT)
+        meta = json.dumps(dict(key=key, text=text, duration=duration)).encode('utf-8')
+        for extension, data in zip(EXTENSIONS, (audio, text.encode('utf-8'), meta)):
+            info = tarfile.TarInfo(key + extension)
+            info.size = len(data)
+            info.mtime = time.time()
+            self._tar.addfile(info, io.BytesIO(data))
+            # data is followed by padding up to tar block size
+            offset = self._tar.offset - -(-info.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+            self._index.append(dict(name=info.name, offset=offset, size=info.size))
+        self.samples += 1
+
+    def _size(self) -> int:
+        return self._tar.offset
+
+    def _close(self) -> None:
+        self._tar.close()
+        self._tar = None
+
+
+def pack_output(output_path: Path, shard_size: int = 256 * 2 ** 20) -> int:
+    """Packs output/audio samples listed in output/transcript.lst into output/shards,
+    rewrites transcript paths to shards/ and removes output/audio. Returns number of packed samples"""
+    transcript_path = output_path / 'transcript.lst'
+    lines = transcript_path.read_text().splitlines(keepends=True)
+    shutil.rmtree(str(output_path / 'shards'), ignore_errors=True)
+    packed = []
+    with ShardWriter(output_path / 'shards', shard_size, prefix='shard') as writer:
+        for line in lines:
+            name, path, duration, text = line.split(' ', 3)
+            writer.write([(name[:-len('.flac')], (output_path / path).read_bytes(), text.strip(), float(duration))])
+            packed.append(f'{name} shards/{name} {duration} {text}')
+    tmp_path = transcript_path.with_suffix('.tmp')
+    tmp_path.write_text(''.join(packed))
+    tmp_path.rename(transcript_path)
+    shutil.rmtree(str(output_path / 'audio'), ignore_errors=True)
+    log.info(f'Packed {len(packed)} samples into {writer.shards} shards')
+    return len(packed)
+
+
+class ShardReader:
+    """Reads samples written by ShardWriter.
+    reader[key] - O(1) random access through shard indexes, iter(reader) - sequential streaming of all shards"""
+
+    def __init__(self, shards_path: Path):
+        self.shards_path = shards_path
+        # shards are finalized once their index is written
+        self.shard_paths = sorted(index_path.with_suffix('.tar') for index_path in shards_path.glob('*.idx'))
+        self.index: Dict[str, Tuple[Path, int, int]] = {}
+        for shard_path in self.shard_paths:
+            with shard_path.with_suffix('.idx').open() as fp:
+                for line in fp:
+                    entry = json.loads(line)
+                    self.index[entry['name']] = (shard_path, entry['offset'], entry['size'])
+
+    def __len__(self):
+        return len(self.index) // len(EXTENSIONS)
+
+    def __contains__(self, key: str) -> bool:
+        return key + EXTENSIONS[0] in self.index
+
+    def __getitem__(self, key: str) -> dict:
+        """Returns dict(key, text, duration, audio)"""
+        record = json.loads(self._read(key + '.json'))
+        record['audio'] = self._read(key + '.flac')
+        return record
+
+    def __iter__(self) -> Iterator[dict]:
+        for shard_path in self.shard_paths:
+            with tarfile.open(shard_path, 'r|') as tar:
+                record = {}
+                for member in tar:
+                    data = tar.extractfile(member).read()
+                    if member.name.endswith('.flac'):
+                        record = dict(audio=data)
+                    elif member.name.endswith('.json'):
+                        record.update(json.loads(data))
+                        yield record
+
+    def _read(self, name: str) -> bytes:
+        shard_path, offset, size = self.index[name]
+        with shard_path.open('rb') as fp:
+            fp.seek(offset)
+            return fp.read(size)
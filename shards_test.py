@@ -0,0 +1,80 @@
+import os
+import tarfile
+
+import pytest
+
+from shards import ShardReader, ShardWriter, line_samples, pack_output, sample_key
+
+
+def sample(key: str, size: int = 3000) -> tuple:
+    return key, os.urandom(size), f'text of {key}', size / 1000
+
+
+def test_round_trip_and_random_access(tmp_path):
+    finalized = []
+    samples = [sample(f'a.wav-{i}') for i in range(10)]
+    # each sample takes 5.5 KiB of tar, shards are full after two items of two samples
+    with ShardWriter(tmp_path, shard_size=12000, prefix='s', on_finalize=finalized.append) as writer:
+        for first in range(0, 10, 2):
+            writer.write(samples[first:first + 2])
+    # shards are finalized between items once they reach shard_size
+    assert [path.name for path in finalized] == ['s-000000.tar', 's-000001.tar', 's-000002.tar']
+    assert sorted(path.name for path in tmp_path.iterdir()) == \
+        ['s-000000.idx', 's-000000.tar', 's-000001.idx', 's-000001.tar', 's-000002.idx', 's-000002.tar']
+    reader = ShardReader(tmp_path)
+    assert len(reader) == 10 and 'a.wav-3' in reader and 'a.wav-10' not in reader
+    for key, audio, text, duration in reversed(samples):
+        assert reader[key] == dict(key=key, text=text, duration=duration, audio=audio)
+    assert [record['key'] for record in reader] == [key for key, *_ in samples]
+    with tarfile.open(tmp_path / 's-000001.tar') as tar:
+        assert tar.extractfile('a.wav-4.txt').read() == b'text of a.wav-4'
+
+
+def test_resumed_writer_keeps_finalized_shards(tmp_path):
+    with ShardWriter(tmp_path, shard_size=1, prefix='s') as writer:
+        writer.write([sample('a')])
+        writer.write([sample('b')])
+        writer.add(*sample('c'))
+    # interrupted runs leave unfinished shards and shards renamed before their index was written
+    (tmp_path / 's-000003.tar.tmp').write_bytes(b'partial')
+    (tmp_path / 's-000004.tar').write_bytes(b'no index')
+    (tmp_path / 's-000004.idx.tmp').write_text('')
+    with ShardWriter(tmp_path, shard_size=1, prefix='s') as writer:
+        writer.write([sample('d')])
+    assert sorted(path.name for path in tmp_path.iterdir()) == \
+        ['s-000000.idx', 's-000000.tar', 's-000001.idx', 's-000001.tar', 's-000002.idx', 's-000002.tar',
+         's-000003.idx', 's-000003.tar']
+    assert sorted(record['key'] for record in ShardReader(tmp_path)) == ['a', 'b', 'c', 'd']
+
+
+def test_unfinalized_shard_is_not_read(tmp_path):
+    writer = ShardWriter(tmp_path, shard_size=1, prefix='s')
+    writer.write([sample('a')])
+    writer.add(*sample('b'))
+    reader = ShardReader(tmp_path)
+    assert 'a' in reader and 'b' not in reader and len(list(reader)) == 1
+    writer.finalize()
+    assert writer.finalize() is None and len(ShardReader(tmp_path)) == 2
+
+
+def test_line_samples():
+    lines = [('a.wav-0-1000.flac shards/a.wav-0-1000.flac 1.00 some text \n', 'some text\n', b'flac')]
+    assert sample_key(lines[0][0]) == 'a.wav-0-1000'
+    assert list(line_samples(lines)) == [('a.wav-0-1000', b'flac', 'some text', 1.0)]
+
+
+@pytest.mark.parametrize('shard_size', [1, 2 ** 20])
+def test_pack_output(tmp_path, shard_size):
+    (tmp_path / 'audio').mkdir()
+    lines = []
+    for i in range(3):
+        name = f'a.wav-{i}000-{i + 1}000.flac'
+        (tmp_path / 'audio' / name).write_bytes(f'audio {i}'.encode())
+        lines.append(f'{name} audio/{name} 1.00 text {i} \n')
+    (tmp_path / 'transcript.lst').write_text(''.join(lines))
+    assert pack_output(tmp_path, shard_size=shard_size) == 3
+    assert not (tmp_path / 'audio').exists()
+    assert (tmp_path / 'transcript.lst').read_text() == ''.join(line.replace(' audio/', ' shards/') for line in lines)
+    reader = ShardReader(tmp_path / 'shards')
+    assert len(reader.shard_paths) == (3 if shard_size == 1 else 1)
+    assert reader['a.wav-2000-3000'] == dict(key='a.wav-2000-3000', text='text 2', duration=1.0, audio=b'audio 2')
@@ -0,0 +1,74 @@
+import logging
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+STATISTICS = ('rms', 'peak', 'voiced')
+
+
+class SilenceFilter:
+    """Detects mostly silent segments on decoded int16 PCM before they are encoded.
+    Statistics are computed on short frames once per episode, segment values are then
+    derived for all segments at once with cumulative sums/reductions over frames.
+    statistic:
+        rms    - RMS amplitude of the segment (same as sox stat "RMS amplitude")
+        peak   - maximum absolute amplitude of the segment
+        voiced - fraction of frames with RMS amplitude above voiced_level
+    Segment is kept if its statistic is strictly greater than threshold.
+    """
+
+    def __init__(self, statistic: str = 'rms', threshold: float = 0.01, frame_ms: int = 10,
+                 voiced_level: float = 0.02, block_frames: int = 6000):
+        if statistic not in STATISTICS:
+            raise ValueError(f'Unknown silence statistic {statistic}, expected one of {STATISTICS}')
+        self.statistic = statistic
+        self.threshold = threshold
+        self.frame_ms = frame_ms
+        self.voiced_level = voiced_level
+        self.block_frames = block_frames
+
+    def frame_stats(self, pcm: np.ndarray, samplerate: int):
+        """Returns per frame (sum of squares, peak) of normalized samples.
+        pcm is processed in blocks, so memory mapped buffers are never fully materialized as floats"""
+        frame_len = max(1, samplerate * self.frame_ms // 1000)
+        n_frames = -(-len(pcm) // frame_len)
+        energy = np.zeros(n_frames, dtype=np.float64)
+        peak = np.zeros(n_frames, dtype=np.float32)
+        block_len = frame_len * self.block_frames
+        for offset in range(0, len(pcm), block_len):
+            block = np.asarray(pcm[offset:offset + block_len], dtype=np.float32) / 32768.0
+            pad = -len(block) % frame_len
+            if pad:
+                block = np.pad(block, (0, pad))
+            frames = block.reshape(-1, frame_len)
+            first = offset // frame_len
+            energy[first:first + len(frames)] = np.einsum('ij,ij->i', frames, frames)
+            peak[first:first + len(frames)] = np.abs(frames).max(axis=1)
+        return frame_len, energy, peak
+
+    def stats(self, pcm: np.ndarray, samplerate: int, bounds: np.ndarray) -> np.ndarray:
+        """Calculates statistic for each segment. bounds - int array of shape (n, 2) with sample offsets"""
+        bounds = np.asarray(bounds, dtype=np.int64).reshape(-1, 2)
+        frame_len, energy, peak = self.frame_stats(pcm, samplerate)
+        n_frames = len(energy)
+        first = np.clip(bounds[:, 0] // frame_len, 0, n_frames)
+        last = np.clip(-(-bounds[:, 1] // frame_len), 0, n_frames)
+        lengths = last - first
+        empty = (lengths <= 0) | (bounds[:, 1] <= bounds[:, 0])
+        safe_lengths = np.where(empty, 1, lengths)
+
+        if self.statistic == 'rms':
+            cum = np.concatenate(([0.0], np.cumsum(energy)))
+            samples = safe_lengths * frame_len
+            values = np.sqrt((cum[last] - cum[first]) / samples)
+        elif self.statistic == 'peak':
+            # reduceat over interleaved (first, last) pairs gives max of each [first, last) range
+            padded = np.append(peak, 0.0)
+            indices = np.stack([first, np.maximum(last, first)], axis=1).ravel()
+            values = np.maximum.reduceat(padded, indices)[::2]
+        else:
+            frame_rms = np.sqrt(energy / frame_len)
+            cum = np.concatenate(([0], np.cumsum(frame_rms > self.voiced_level)))
+            values = (cum[last] - cum[first]) / safe_lengths
+        return np.where(empty, 0.0, values)
@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+
+from silence import SilenceFilter
+
+SAMPLERATE = 16000
+FRAME_LEN = SAMPLERATE // 100
+
+
+def pcm(seconds: float, seed: int = 0) -> np.ndarray:
+    """Noise with loud and quiet parts, so segments have different statistics"""
+    rng = np.random.default_rng(seed)
+    envelope = np.repeat(rng.uniform(0, 1, int(seconds * 20)) ** 4, SAMPLERATE // 20)
+    return (rng.standard_normal(len(envelope)) * envelope * 8000).astype(np.int16)
+
+
+def naive_stat(silence_filter: SilenceFilter, pcm: np.ndarray, first: int, last: int) -> float:
+    """Statistic of samples of frames which segment [first, last) overlaps, last frame is padded with zeros"""
+    first_frame, last_frame = first // FRAME_LEN, min(-(-last // FRAME_LEN), -(-len(pcm) // FRAME_LEN))
+    if last <= first or last_frame <= first_frame:
+        return 0.0
+    samples = pcm[first_frame * FRAME_LEN:last_frame * FRAME_LEN].astype(np.float64) / 32768.0
+    frames = np.pad(samples, (0, -len(samples) % FRAME_LEN)).reshape(-1, FRAME_LEN)
+    if silence_filter.statistic == 'rms':
+        return np.sqrt((frames ** 2).mean())
+    if silence_filter.statistic == 'peak':
+        return np.abs(frames).max()
+    return (np.sqrt((frames ** 2).mean(axis=1)) > silence_filter.voiced_level).mean()
+
+
+@pytest.mark.parametrize('statistic', ['rms', 'peak', 'voiced'])
+@pytest.mark.parametrize('block_frames', [1, 7, 6000])
+def test_block_stats_match_naive_per_segment_stats(statistic, block_frames):
+    silence_filter = SilenceFilter(statistic, block_frames=block_frames)
+    audio = pcm(3.0)
+    bounds = np.array([(0, len(audio)), (0, 1), (5, 6), (100, 4900), (1600, 1600), (3000, 2000), (8001, 24123),
+                       (len(audio) - 50, len(audio) + 5000), (len(audio) + 10, len(audio) + 20)])
+    expected = [naive_stat(silence_filter, audio, first, last) for first, last in bounds]
+    np.testing.assert_allclose(silence_filter.stats(audio, SAMPLERATE, bounds), expected, rtol=1e-5, atol=1e-7)
+
+
+def test_silent_and_loud_segments():
+    silence_filter = SilenceFilter('rms', threshold=0.01)
+    audio = np.concatenate([np.zeros(SAMPLERATE, dtype=np.int16), np.full(SAMPLERATE, 3000, dtype=np.int16)])
+    rms = silence_filter.stats(audio, SAMPLERATE, [(0, SAMPLERATE), (SAMPLERATE, 2 * SAMPLERATE)])
+    assert rms[0] == 0.0 and rms[1] == pytest.approx(3000 / 32768)
+
+
+def test_unknown_statistic():
+    with pytest.raises(ValueError, match='Unknown silence statistic'):
+        SilenceFilter('loudness')
@@ -0,0 +1,51 @@
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+
+class SqliteStore:
+    """Base class for small sqlite backed stores.
+    Connection is opened lazily per thread and per process, so store objects
+    could be shared between threads and passed to process pools"""
+    schema = ''
+    journal_mode = 'WAL'  # WAL does not work on network filesystems, DELETE should be used there
+
+    def __init__(self, path: Path, timeout: float = 60.0):
+        self.path = Path(path)
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_local']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            connection = sqlite3.connect(str(self.path), timeout=self.timeout, isolation_level=None)
+            connection.execute(f'PRAGMA journal_mode={self.journal_mode}')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.executescript(self.schema)
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    @contextmanager
+    def transaction(self):
+        connection = self.connection
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield connection
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
@@ -1,62 +1,197 @@
-import pysrt
-import datetime
-
+import html
+import json
+import re
+import struct
+import zlib
 from collections import namedtuple
+from pathlib import Path
+from typing import Iterable, List
+from xml.etree import ElementTree
 
-line = namedtuple('line', 'start end duration text')
+import numpy as np
 
+line = namedtuple('line', 'start end duration text')
 
-def time_to_total_seconds(time):
-    return datetime.timedelta(
-        hours=time.hour,
-        minutes=time.minute,
-        seconds=time.second,
-        milliseconds=time.microsecond/1000.0).total_seconds()
+SEPARATOR = '\x1f'  # separates cue texts in text store, never appears in subtitles text
+TIME = r'(?:(\d+):)?(\d{1,2}):(\d{2})[,.](\d{1,3})'
+# timing line followed by non empty text lines
+CUE_RE = re.compile(rf'^[ \t]*{TIME}[ \t]*-->[ \t]*{TIME}[^\n]*\n?((?:[^\n]+(?:\n|\Z))*)', re.M)
+TAG_RE = re.compile(r'<[^>]*>')
+
+
+def _to_ms(hours, minutes, seconds, millis) -> np.ndarray:
+    def column(values, scale):
+        return np.array([int(v) if v else 0 for v in values], dtype=np.int64) * scale
+
+    # '5' in '00:00:01.5' means 500ms
+    millis = [m.ljust(3, '0') for m in millis]
+    return column(hours, 3600000) + column(minutes, 60000) + column(seconds, 1000) + column(millis, 1)
+
+
+def parse_cues(content: str, strip_tags: bool = False) -> 'Subtitles':
+    """Single pass parser of SRT and WebVTT cues. Cue numbers, WEBVTT header, NOTE and STYLE blocks are skipped"""
+    content = content.replace('\r\n', '\n').replace('\r', '\n')
+    cues = CUE_RE.findall(content)
+    if not cues:
+        return Subtitles.from_lines([])
+    columns = list(zip(*cues))
+    starts = _to_ms(*columns[0:4])
+    ends = _to_ms(*columns[4:8])
+    texts = [text.rstrip('\n') for text in columns[8]]
+    if strip_tags:
+        texts = [TAG_RE.sub('', text) for text in texts]
+    return Subtitles(starts, ends, *Subtitles.pack_texts(texts))
+
+
+def parse_timed_text(content: str) -> 'Subtitles':
+    """Parser of YouTube timed text: json3, srv3 XML (<p t="ms" d="ms">) and legacy XML (<text start="s" dur="s">).
+    Whitespace in texts is collapsed, cues without text (line breaks of auto-generated captions) are skipped"""
+    content = content.strip()
+    cues = []
+    if content.startswith('{'):
+        for event in json.loads(content).get('events', []):
+            text = ''.join(seg.get('utf8', '') for seg in event.get('segs', []))
+            start = event.get('tStartMs', 0)
+            cues.append((start, start + event.get('dDurationMs', 0), text))
+    else:
+        root = ElementTree.fromstring(content)
+        if root.tag == 'transcript':
+            for element in root.iter('text'):
+                start = round(float(element.get('start', 0)) * 1000)
+                cues.append((start, start + round(float(element.get('dur', 0)) * 1000),
+                             html.unescape(''.join(element.itertext()))))
+        else:
+            for element in root.iter('p'):
+                start = int(element.get('t', 0))
+                cues.append((start, start + int(element.get('d', 0)), ''.join(element.itertext())))
+    cues = [(start, end, ' '.join(text.split())) for start, end, text in cues if text.strip()]
+    return Subtitles(np.array([cue[0] for cue in cues], dtype=np.int64),
+                     np.array([cue[1] for cue in cues], dtype=np.int64),
+                     *Subtitles.pack_texts(cue[2] for cue in cues))
 
 
 class Subtitles:
-    """Subtiters wrapper"""
+    """Subtiters wrapper.
+    Cues are stored column-wise: int64 arrays of start/end/duration in ms and text store -
+    all texts joined with SEPARATOR into one string plus offsets of each text"""
 
-    def __init__(self, lines: list):
-        self.lines = lines
+    def __init__(self, starts: np.ndarray, ends: np.ndarray, text_data: str, text_offsets: np.ndarray):
+        self.starts = np.asarray(starts, dtype=np.int64)
+        self.ends = np.asarray(ends, dtype=np.int64)
+        self.text_data = text_data
+        self.text_offsets = np.asarray(text_offsets, dtype=np.int64)
 
     @staticmethod
-    def from_srt(file_path: str):  # TODO: from_lst
-        subs = pysrt.open(file_path)
-        lines = [Subtitles.line_from_sub(s) for s in subs]
-        return Subtitles(lines)
+    def pack_texts(texts: Iterable[str]):
+        texts = [text.replace(SEPARATOR, ' ') + SEPARATOR for text in texts]
+        offsets = np.zeros(len(texts) + 1, dtype=np.int64)
+        np.cumsum([len(text) for text in texts], out=offsets[1:])
+        return ''.join(texts), offsets
 
     @staticmethod
-    def line_from_sub(sub):
-        start = int(time_to_total_seconds(sub.start.to_time()) * 1000)
-        end = int(time_to_total_seconds(sub.end.to_time()) * 1000)
-        duration = end - start
-        text = sub.text
-        return line(start, end, duration, text)
+    def from_lines(lines: List[line]) -> 'Subtitles':
+        return Subtitles(np.array([l.start for l in lines], dtype=np.int64),
+                         np.array([l.end for l in lines], dtype=np.int64),
+                         *Subtitles.pack_texts(l.text for l in lines))
 
-    def get_overlap(self) -> float:
-        """Calculates overlap between adjacent lines. [0.0, 1.0]"""
-        subs_time = 0.0
-        clear_time = 0.0
-        last_end = 0.0
-        for i in range(len(self.lines)):
-            line = self.lines[i]
-            subs_time += line.end - line.start
-            clear_time += line.end - max(last_end, line.start)
-            last_end = line.end
-        return 1.0 - clear_time / subs_time
+    @staticmethod
+    def from_srt(file_path: str) -> 'Subtitles':  # TODO: from_lst
+        return parse_cues(Path(file_path).read_text(encoding='utf-8-sig', errors='replace'))
 
-    def join_lines(self, max_duration=15.0):
-        """Joins lines without braks"""
-        source_df = dc.srt_to_df(self.lines)
-        df = jh.join_lines(source_df, max_duration)
-        new_lines = list([line(row["start"], row["end"], row["duration"], row["text"]) for index, row in df.iterrows()])
-        return Subtitles(new_lines)
+    @staticmethod
+    def from_vtt(file_path: str) -> 'Subtitles':
+        return parse_cues(Path(file_path).read_text(encoding='utf-8-sig', errors='replace'), strip_tags=True)
 
+    @staticmethod
+    def from_bytes(data: bytes) -> 'Subtitles':
+        data = zlib.decompress(data)
+        n, = struct.unpack_from('<I', data)
+        starts = np.frombuffer(data, dtype='<i8', count=n, offset=4)
+        ends = np.frombuffer(data, dtype='<i8', count=n, offset=4 + 8 * n)
+        texts = data[4 + 16 * n:].decode('utf-8').split(SEPARATOR)[:-1]
+        return Subtitles(starts, ends, *Subtitles.pack_texts(texts))
+
+    def to_bytes(self) -> bytes:
+        """Compact form: count, starts, ends and text store, zlib compressed"""
+        return zlib.compress(struct.pack('<I', len(self)) + self.starts.astype('<i8').tobytes()
+                             + self.ends.astype('<i8').tobytes() + self.text_data.encode('utf-8'))
 
+    @staticmethod
+    def from_file(file_path: str) -> 'Subtitles':
+        if str(file_path).endswith('.vtt'):
+            return Subtitles.from_vtt(file_path)
+        return Subtitles.from_srt(file_path)
 
+    def __len__(self):
+        return len(self.starts)
 
+    @property
+    def durations(self) -> np.ndarray:
+        return self.ends - self.starts
 
+    def text(self, i: int) -> str:
+        return self.text_data[self.text_offsets[i]:self.text_offsets[i + 1] - 1]
 
+    def texts(self, first: int, last: int, sep: str = ' ') -> str:
+        """Texts of cues first..last (inclusive) joined with sep"""
+        return self.text_data[self.text_offsets[first]:self.text_offsets[last + 1] - 1].replace(SEPARATOR, sep)
 
+    @property
+    def lines(self) -> List[line]:
+        return [line(int(start), int(end), int(end - start), self.text(i))
+                for i, (start, end) in enumerate(zip(self.starts, self.ends))]
 
+    def get_overlap(self) -> float:
+        """Calculates overlap between adjacent lines. [0.0, 1.0]"""
+        if not len(self):
+            return 0.0
+        prev_ends = np.concatenate(([0], self.ends[:-1]))
+        subs_time = np.sum(self.durations)
+        clear_time = np.sum(self.ends - np.maximum(prev_ends, self.starts))
+        return float(1.0 - clear_time / subs_time)
+
+    def gaps(self) -> np.ndarray:
+        """Silence between cue i and all following cues, len(self) - 1 values, 0 for overlapping cues"""
+        reach = np.maximum.accumulate(self.ends)
+        return np.maximum(self.starts[1:] - reach[:-1], 0)
+
+    def join_lines(self, max_duration=15.0) -> 'Subtitles':
+        """Joins lines without braks, joined line is not longer than max_duration seconds
+        unless it is a single line"""
+        n = len(self)
+        if not n:
+            return self
+        max_ms = int(max_duration * 1000)
+        reach = np.maximum.accumulate(self.ends)
+        run_ends = np.append(np.flatnonzero(self.starts[1:] > reach[:-1]) + 1, n)  # first index after each run
+        firsts = []
+        first = 0
+        while first < n:
+            run_end = run_ends[np.searchsorted(run_ends, first, side='right')]
+            last = np.searchsorted(reach, self.starts[first] + max_ms, side='right')
+            firsts.append(first)
+            first = int(min(max(last, first + 1), run_end))
+        return self._merge(np.array(firsts, dtype=np.int64))
+
+    def deduplicate_overlaps(self) -> 'Subtitles':
+        """Merges cues repeating text of overlapping previous cue (rolling auto-generated captions)
+        and trims the remaining overlaps, so each moment of time belongs to a single cue"""
+        n = len(self)
+        if n < 2:
+            return self
+        texts = np.array([self.text(i).strip() for i in range(n)], dtype=object)
+        repeated = (texts[1:] == texts[:-1]) & (self.starts[1:] <= self.ends[:-1])
+        firsts = np.flatnonzero(np.concatenate(([True], ~repeated)))
+        starts = self.starts[firsts]
+        ends = np.maximum.reduceat(self.ends, firsts)
+        starts[1:] = np.maximum(starts[1:], ends[:-1])
+        ends = np.maximum(ends, starts)
+        return Subtitles(starts, ends, *Subtitles.pack_texts(texts[firsts]))
+
+    def _merge(self, firsts: np.ndarray) -> 'Subtitles':
+        """Merges groups of consecutive cues, firsts - index of first cue of each group"""
+        lasts = np.append(firsts[1:], len(self)) - 1
+        starts = self.starts[firsts]
+        ends = np.maximum.reduceat(self.ends, firsts)
+        texts = [self.texts(first, last) for first, last in zip(firsts, lasts)]
+        return Subtitles(starts, ends, *Subtitles.pack_texts(texts))
@@ -0,0 +1,91 @@
+import json
+
+import numpy as np
+import pytest
+
+from subtitles import SEPARATOR, Subtitles, line, parse_cues, parse_timed_text
+
+SRT = ('1\n00:00:01,500 --> 00:00:02,000\n<i>Hello</i>\nworld\n\n'
+       '2\n00:00:03,000 --> 00:00:04,000\n\n'
+       '3\n00:00:05.5 --> 00:00:06.25\nlast')
+VTT = ('WEBVTT\n\nNOTE comment\n\nSTYLE\n::cue { color: lime }\n\n'
+       '00:01.000 --> 00:02.000 align:start position:10%\n<v Bob><b>Hi</b> there\n\n'
+       'intro\n1:00:00.000 --> 1:00:01.000\nhour\n')
+
+
+def test_srt_cues():
+    # comma and dot millis, short millis are fractions of second, empty cue keeps its timing
+    assert parse_cues(SRT).lines == [line(1500, 2000, 500, '<i>Hello</i>\nworld'), line(3000, 4000, 1000, ''),
+                                     line(5500, 6250, 750, 'last')]
+
+
+def test_vtt_cues():
+    # header, NOTE and STYLE blocks, cue settings and identifiers are skipped, tags are stripped
+    assert parse_cues(VTT, strip_tags=True).lines == [line(1000, 2000, 1000, 'Hi there'),
+                                                      line(3600000, 3601000, 1000, 'hour')]
+
+
+@pytest.mark.parametrize('name, content', [('a.srt', SRT), ('a.vtt', VTT)])
+def test_files_with_bom_and_crlf(tmp_path, name, content):
+    path = tmp_path / name
+    path.write_bytes(b'\xef\xbb\xbf' + content.replace('\n', '\r\n').encode())
+    expected = parse_cues(content, strip_tags=name.endswith('.vtt'))
+    assert Subtitles.from_file(path).lines == expected.lines
+
+
+def test_no_cues():
+    assert len(parse_cues('')) == 0 and len(parse_cues('WEBVTT\n\n')) == 0
+    assert Subtitles.from_lines([]).join_lines().lines == []
+
+
+def test_json3():
+    content = json.dumps({'events': [
+        {'tStartMs': 0, 'dDurationMs': 1500, 'segs': [{'utf8': 'hello'}, {'utf8': '  big\nworld'}]},
+        {'tStartMs': 1000, 'dDurationMs': 10, 'aAppend': 1, 'segs': [{'utf8': '\n'}]},
+        {'tStartMs': 1200, 'dDurationMs': 500},
+        {'tStartMs': 2000, 'segs': [{'utf8': 'no duration'}]}]})
+    assert parse_timed_text(content).lines == [line(0, 1500, 1500, 'hello big world'),
+                                               line(2000, 2000, 0, 'no duration')]
+
+
+def test_srv3_and_legacy_xml():
+    srv3 = ('<?xml version="1.0" encoding="utf-8" ?><timedtext format="3"><body>'
+            '<p t="100" d="900">one <s>two</s></p><p t="1000" d="5"> </p><p t="1500" d="500">&amp; three</p>'
+            '</body></timedtext>')
+    assert parse_timed_text(srv3).lines == [line(100, 1000, 900, 'one two'), line(1500, 2000, 500, '& three')]
+    legacy = ('<?xml version="1.0" encoding="utf-8" ?><transcript>'
+              '<text start="0.5" dur="1.25">it&amp;#39;s</text><text start="2" dur="1">next</text></transcript>')
+    assert parse_timed_text(legacy).lines == [line(500, 1750, 1250, "it's"), line(2000, 3000, 1000, 'next')]
+
+
+def test_bytes_round_trip():
+    subtitles = Subtitles.from_lines([line(0, 1000, 1000, 'plain'), line(900, 2000, 1100, ''),
+                                      line(2500, 2600, 100, f'ünïcode {SEPARATOR} and\nnewline')])
+    restored = Subtitles.from_bytes(subtitles.to_bytes())
+    assert restored.lines == subtitles.lines
+    assert restored.lines[2].text == 'ünïcode   and\nnewline'
+    assert Subtitles.from_bytes(Subtitles.from_lines([]).to_bytes()).lines == []
+
+
+def test_join_lines_groups_runs_up_to_max_duration():
+    subtitles = Subtitles.from_lines([
+        line(0, 4000, 4000, 'a'), line(4000, 8000, 4000, 'b'), line(7000, 12000, 5000, 'c'),
+        line(12000, 16000, 4000, 'd'),  # run without breaks reaches 16 s at d
+        line(17000, 18000, 1000, 'e'),  # break before e
+        line(20000, 40000, 20000, 'long'),  # single line longer than max_duration
+        line(40000, 41000, 1000, 'f')])
+    joined = subtitles.join_lines(max_duration=15.0)
+    assert joined.lines == [line(0, 12000, 12000, 'a b c'), line(12000, 16000, 4000, 'd'),
+                            line(17000, 18000, 1000, 'e'), line(20000, 40000, 20000, 'long'),
+                            line(40000, 41000, 1000, 'f')]
+    assert subtitles.join_lines(max_duration=100.0).lines == [
+        line(0, 16000, 16000, 'a b c d'), line(17000, 18000, 1000, 'e'), line(20000, 41000, 21000, 'long f')]
+
+
+def test_join_lines_keeps_overlapped_cue_in_its_run():
+    # b ends before a, break before c is measured from a's end
+    subtitles = Subtitles.from_lines([line(0, 5000, 5000, 'a'), line(1000, 2000, 1000, 'b'),
+                                      line(4000, 6000, 2000, 'c'), line(6500, 7000, 500, 'd')])
+    assert subtitles.join_lines(max_duration=15.0).lines == [line(0, 6000, 6000, 'a b c'),
+                                                             line(6500, 7000, 500, 'd')]
+    np.testing.assert_array_equal(subtitles.gaps(), [0, 0, 500])
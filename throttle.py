@@ -0,0 +1,242 @@
+import heapq
+import logging
+import random
+import socket
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+from typing import Iterable, Iterator, Optional
+
+import requests
+
+import metrics
+
+log = logging.getLogger(__name__)
+
+THROTTLE_STATUSES = {429, 503}
+TRANSIENT_STATUSES = {408, 429, 500, 502, 503, 504}
+
+deferred = namedtuple('deferred', 'key item error')  # item failed with transient error, it is retried later
+
+
+class TransientError(Exception):
+    """Request could succeed if retried later"""
+
+    def __init__(self, message: str, status: int = None):
+        super().__init__(message)
+        self.status = status
+
+
+def status_code(e: BaseException) -> Optional[int]:
+    """HTTP status of requests, urllib or aiohttp HTTP errors"""
+    response = getattr(e, 'response', None)
+    status = getattr(response, 'status_code', None) or getattr(e, 'status', None) or getattr(e, 'code', None)
+    return status if isinstance(status, int) else None
+
+
+def is_throttled(e: BaseException) -> bool:
+    """Server asks to slow down or does not keep up"""
+    return status_code(e) in THROTTLE_STATUSES or isinstance(e, (TimeoutError, socket.timeout, requests.Timeout))
+
+
+def is_transient(e: BaseException) -> bool:
+    """Failure could go away if retried later, it should not be cached as permanent"""
+    return (isinstance(e, (TransientError, ConnectionError, requests.ConnectionError)) or is_throttled(e)
+            or status_code(e) in TRANSIENT_STATUSES)
+
+
+class TokenBucket:
+    """Allows rate requests per second on average and bursts of up to burst requests"""
+
+    def __init__(self, rate: float, burst: float = None):
+        self.rate = rate
+        self.burst = burst or max(rate, 1.0)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def reserve(self, tokens: float = 1.0) -> float:
+        """Takes tokens, returns seconds to wait before they could be used"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= tokens
+            return max(-self._tokens / self.rate, 0.0)
+
+    def acquire(self, tokens: float = 1.0) -> None:
+        delay = self.reserve(tokens)
+        if delay:
+            time.sleep(delay)
+
+
+class Throttle:
+    """Adaptive limit of requests of one stage: token bucket caps request rate, in-flight requests are capped
+    by concurrency limit adjusted AIMD-style. Limit and rate grow additively while requests succeed fast
+    and are cut multiplicatively on throttle responses, timeouts or latency above latency_tolerance times
+    the best latency seen for the same kind of request. latency_tolerance=None cuts on throttle responses
+    and timeouts only, for requests whose latency depends on body size like downloads.
+    Cuts happen at most once per cooldown, so a burst of errors counts once.
+    State is per process, each worker process adapts on its own"""
+
+    def __init__(self, name: str, rate: float = 10.0, max_concurrency: int = 16, min_concurrency: int = 1,
+                 min_rate: float = 0.2, increase: float = 1.0, decrease: float = 0.5,
+                 latency_tolerance: Optional[float] = 3.0, cooldown: float = 5.0):
+        self.name = name
+        self.bucket = TokenBucket(rate)
+        self.max_rate = rate
+        self.min_rate = min(min_rate, rate)
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.limit = float(max_concurrency)
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_tolerance = latency_tolerance
+        self.cooldown = cooldown
+        self.inflight = 0
+        self.best_latency = {}  # kind of request -> best latency
+        self._last_cut = 0.0
+        self._condition = threading.Condition()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_condition']
+        state['inflight'] = 0
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._condition = threading.Condition()
+
+    @contextmanager
+    def slot(self, kind: str = 'request'):
+        """Waits for free slot and token, records outcome of requests made inside"""
+        with self._condition:
+            while self.inflight >= int(self.limit):
+                self._condition.wait()
+            self.inflight += 1
+        self.bucket.acquire()
+        start = time.monotonic()
+        try:
+            yield
+        except BaseException as e:
+            self._release()
+            self.record(time.monotonic() - start, throttled=is_throttled(e), kind=kind)
+            raise
+        self._release()
+        self.record(time.monotonic() - start, kind=kind)
+
+    def _release(self) -> None:
+        with self._condition:
+            self.inflight -= 1
+            self._condition.notify()
+
+    def reserve(self) -> float:
+        """Takes token, returns seconds to wait before request, for callers which cannot block like asyncio ones"""
+        return self.bucket.reserve()
+
+    def record(self, latency: float, throttled: bool = False, kind: str = 'request') -> None:
+        with self._condition:
+            slow = False
+            if not throttled:
+                best = self.best_latency[kind] = min(self.best_latency.get(kind, latency), latency)
+                slow = self.latency_tolerance is not None and latency > self.latency_tolerance * max(best, 0.05)
+            if throttled or slow:
+                self._cut(throttled)
+            else:
+                self.limit = min(self.limit + self.increase / self.limit, self.max_concurrency)
+                self.bucket.rate = min(self.bucket.rate + self.increase / self.limit, self.max_rate)
+            self._condition.notify_all()
+        metrics.set_gauge('throttle_limit', self.limit, stage=self.name)
+        metrics.set_gauge('throttle_rate', self.bucket.rate, stage=self.name)
+
+    def _cut(self, throttled: bool) -> None:
+        now = time.monotonic()
+        if now - self._last_cut < self.cooldown:
+            return
+        self._last_cut = now
+        self.limit = max(self.limit * self.decrease, self.min_concurrency)
+        if throttled:
+            self.bucket.rate = max(self.bucket.rate * self.decrease, self.min_rate)
+        metrics.inc('throttled_total', stage=self.name, reason='throttled' if throttled else 'slow')
+        log.warning(f'{self.name} {"throttled" if throttled else "slow"}: concurrency limit {self.limit:.1f}, '
+                    f'rate {self.bucket.rate:.2f}/s')
+
+
+class Requeue:
+    """Items failed with transient errors, each is retried up to attempts times
+    after jittered exponential backoff"""
+
+    def __init__(self, attempts: int = 5, delay: float = 30.0, max_delay: float = 900.0):
+        self.attempts = attempts
+        self.delay = delay
+        self.max_delay = max_delay
+        self._failures = {}
+        self._heap = []
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        state['_heap'] = []
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def backoff(self, key: str) -> float:
+        """Counts failure of key, returns delay before its next attempt.
+        Failures are counted in this instance, pickled copies of process workers count their own"""
+        with self._lock:
+            failures = self._failures[key] = self._failures.get(key, 0) + 1
+        return self.delay_after(failures)
+
+    def delay_after(self, failures: int) -> float:
+        """Delay before next attempt of item failed failures times, for failures counted elsewhere"""
+        return random.uniform(0.5, 1.0) * min(self.max_delay, self.delay * 2 ** (failures - 1))
+
+    def defer(self, key: str, item: tuple) -> bool:
+        """Schedules item retry, False when it failed too many times already"""
+        if self._failures.get(key, 0) >= self.attempts:
+            return False
+        due = time.monotonic() + self.backoff(key)
+        with self._lock:
+            heapq.heappush(self._heap, (due, key, item))
+        metrics.inc('retries_total')
+        return True
+
+    def due(self) -> Iterator[tuple]:
+        """Pops items whose delay passed"""
+        while True:
+            with self._lock:
+                if not self._heap or self._heap[0][0] > time.monotonic():
+                    return
+                _, _, item = heapq.heappop(self._heap)
+            yield item
+
+    def merge(self, items: Iterable[tuple]) -> Iterator[tuple]:
+        """Items with due retries put in between"""
+        for item in items:
+            yield from self.due()
+            yield item
+        yield from self.due()
+
+    def wait(self) -> Iterator[tuple]:
+        """Yields deferred items as their delays pass, until none is left"""
+        while self._heap:
+            time.sleep(max(self._heap[0][0] - time.monotonic(), 0))
+            yield from self.due()
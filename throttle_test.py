@@ -0,0 +1,88 @@
+import time
+
+import pytest
+import requests
+
+from throttle import Requeue, Throttle, TokenBucket, TransientError, is_throttled, is_transient
+
+
+def http_error(status: int) -> requests.HTTPError:
+    response = requests.Response()
+    response.status_code = status
+    return requests.HTTPError(f'HTTP {status}', response=response)
+
+
+def test_classification():
+    assert is_throttled(http_error(429)) and is_throttled(http_error(503)) and is_throttled(requests.Timeout())
+    assert is_transient(http_error(502)) and is_transient(TransientError('x')) and is_transient(ConnectionError())
+    assert not is_transient(http_error(404)) and not is_transient(ValueError())
+
+
+def test_token_bucket_burst_then_rate():
+    bucket = TokenBucket(rate=10.0, burst=2)
+    assert bucket.reserve() == 0 and bucket.reserve() == 0
+    assert bucket.reserve() == pytest.approx(0.1, abs=0.01)
+    assert bucket.reserve() == pytest.approx(0.2, abs=0.01)
+
+
+def test_token_bucket_refills():
+    bucket = TokenBucket(rate=100.0, burst=1)
+    bucket.acquire()
+    start = time.monotonic()
+    bucket.acquire()
+    assert time.monotonic() - start == pytest.approx(0.01, abs=0.01)
+
+
+def test_aimd_cut_once_per_cooldown_and_additive_increase():
+    throttle = Throttle('test', rate=8.0, max_concurrency=8, cooldown=60.0)
+    throttle.record(0.1, throttled=True)
+    throttle.record(0.1, throttled=True)  # same burst of errors
+    assert (throttle.limit, throttle.bucket.rate) == (4.0, 4.0)
+    for _ in range(4):
+        throttle.record(0.1)
+    assert 4.9 < throttle.limit < 5.0 and throttle.bucket.rate < 5.0
+    for _ in range(1000):
+        throttle.record(0.1)
+    assert (throttle.limit, throttle.bucket.rate) == (8, 8.0)
+
+
+def test_slow_requests_are_compared_with_same_kind():
+    throttle = Throttle('test', max_concurrency=16, cooldown=0.0)
+    throttle.record(0.04, kind='head')
+    for _ in range(5):
+        throttle.record(1.5, kind='range')
+    assert throttle.limit == 16
+    throttle.record(5.0, kind='range')
+    assert throttle.limit == 8
+    assert throttle.bucket.rate == 10.0  # slow requests do not lower rate
+
+
+def test_no_latency_tolerance_cuts_on_throttling_only():
+    throttle = Throttle('test', max_concurrency=16, latency_tolerance=None, cooldown=0.0)
+    throttle.record(0.01)
+    throttle.record(100.0)
+    assert throttle.limit == 16
+    with pytest.raises(requests.HTTPError):
+        with throttle.slot():
+            raise http_error(429)
+    assert throttle.limit == 8 and throttle.inflight == 0
+
+
+def test_requeue_backoff_doubles_with_jitter_and_cap():
+    requeue = Requeue(attempts=10, delay=1.0, max_delay=6.0)
+    delays = [requeue.backoff('a') for _ in range(5)]
+    for delay, full in zip(delays, [1, 2, 4, 6, 6]):
+        assert full / 2 <= delay <= full
+    assert 0.5 <= requeue.backoff('b') <= 1.0
+
+
+def test_requeue_gives_up_after_attempts_and_yields_due_items():
+    requeue = Requeue(attempts=2, delay=0.01, max_delay=0.02)
+    assert requeue.defer('a', ('a',)) and requeue.defer('b', ('b',))
+    assert list(requeue.due()) == [] and len(requeue) == 2
+    assert sorted(requeue.wait()) == [('a',), ('b',)] and not len(requeue)
+    assert requeue.defer('a', ('a',))
+    assert not requeue.defer('a', ('a',))
+    assert list(requeue.merge([('c',)])) == [('c',)]
+    time.sleep(0.03)
+    assert list(requeue.merge([('c',)])) == [('a',), ('c',)]
@@ -0,0 +1,52 @@
+import logging
+import os
+import time
+from pathlib import Path
+from typing import Iterable, Tuple
+
+log = logging.getLogger(__name__)
+
+
+class TranscriptWriter:
+    """Appends (transcript, text) lines of each processed item to output/transcript.lst and output/text.txt
+    as soon as they are available. Files are flushed every flush_every items and fsynced every fsync_interval seconds"""
+
+    def __init__(self, output_path: Path, flush_every: int = 10, fsync_interval: float = 30.0, mode: str = 'a'):
+        self.transcript_path = output_path / 'transcript.lst'
+        self.text_path = output_path / 'text.txt'
+        self.flush_every = flush_every
+        self.fsync_interval = fsync_interval
+        self.mode = mode
+        self.items = 0
+        self.lines = 0
+        self._last_fsync = time.monotonic()
+        self._transcript_fp = None
+        self._text_fp = None
+
+    def __enter__(self):
+        self._transcript_fp = self.transcript_path.open(self.mode)
+        self._text_fp = self.text_path.open(self.mode)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.flush(fsync=True)
+        self._transcript_fp.close()
+        self._text_fp.close()
+        log.info(f'Written {self.lines} lines of {self.items} items to {self.transcript_path}')
+
+    def write(self, lines: Iterable[Tuple[str, str]]) -> None:
+        for fields in lines:
+            self._transcript_fp.write(fields[0])
+            self._text_fp.write(fields[1])
+            self.lines += 1
+        self.items += 1
+        if self.items % self.flush_every == 0:
+            self.flush(fsync=time.monotonic() - self._last_fsync > self.fsync_interval)
+
+    def flush(self, fsync: bool = False) -> None:
+        for fp in (self._transcript_fp, self._text_fp):
+            fp.flush()
+            if fsync:
+                os.fsync(fp.fileno())
+        if fsync:
+            self._last_fsync = time.monotonic()
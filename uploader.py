@@ -0,0 +1,188 @@
+import json
+import logging
+import shutil
+import tempfile
+import threading
+import time
+from abc import ABC, abstractmethod
+from multiprocessing.dummy import Pool as ThreadPool
+from pathlib import Path
+from typing import Dict, Optional
+
+log = logging.getLogger(__name__)
+
+MANIFEST_NAME = 'manifest.json'
+
+
+class StorageBackend(ABC):
+    """Destination of dataset files, names are relative to backend prefix"""
+
+    @abstractmethod
+    def upload(self, local_path: Path, name: str) -> None:
+        raise NotImplementedError()
+
+    @abstractmethod
+    def size(self, name: str) -> Optional[int]:
+        """Size of uploaded object or None if there is no such object"""
+        raise NotImplementedError()
+
+    @abstractmethod
+    def uri(self, name: str) -> str:
+        raise NotImplementedError()
+
+    def write_text(self, name: str, text: str) -> None:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tmp_path = Path(tmp_dir) / name
+            tmp_path.write_text(text)
+            self.upload(tmp_path, name)
+
+
+class LocalBackend(StorageBackend):
+    """Copies files to local or mounted directory, stand-in for GCS in tests and dry runs"""
+
+    def __init__(self, root: Path):
+        self.root = Path(root)
+
+    def upload(self, local_path, name):
+        target = self.root / name
+        target.parent.mkdir(parents=True, exist_ok=True)
+        tmp_target = target.with_name(target.name + '.part')
+        shutil.copyfile(str(local_path), str(tmp_target))
+        tmp_target.rename(target)
+
+    def size(self, name):
+        target = self.root / name
+        return target.stat().st_size if target.exists() else None
+
+    def uri(self, name):
+        return (self.root / name).resolve().as_uri()
+
+
+class GCSBackend(StorageBackend):
+    """Uploads to gs://bucket/prefix. Objects larger than composite_threshold are uploaded as
+    parallel parts of part_size and composed into single object on the server"""
+
+    def __init__(self, bucket_name: str, prefix: str = '', composite_threshold: int = 64 * 2 ** 20,
+                 part_size: int = 32 * 2 ** 20):
+        self.bucket_name = bucket_name
+        self.prefix = prefix.strip('/')
+        self.composite_threshold = composite_threshold
+        self.part_size = part_size
+        self._bucket = None
+        self._lock = threading.Lock()
+
+    @property
+    def bucket(self):
+        with self._lock:
+            if self._bucket is None:
+                from google.cloud import storage
+                self._bucket = storage.Client().bucket(self.bucket_name)
+            return self._bucket
+
+    def upload(self, local_path, name):
+        size = local_path.stat().st_size
+        if size <= self.composite_threshold:
+            self.bucket.blob(self._key(name)).upload_from_filename(str(local_path))
+            return
+        # compose accepts at most 32 sources
+        part_size = max(self.part_size, -(-size // 32))
+        offsets = list(range(0, size, part_size))
+        parts = [self.bucket.blob(f'{self._key(name)}.part-{i:02d}') for i in range(len(offsets))]
+
+        def upload_part(args):
+            part, offset = args
+            with local_path.open('rb') as fp:
+                fp.seek(offset)
+                part.upload_from_file(fp, size=min(part_size, size - offset))
+
+        with ThreadPool(len(parts)) as pool:
+            pool.map(upload_part, zip(parts, offsets))
+        self.bucket.blob(self._key(name)).compose(parts)
+        for part in parts:
+            part.delete()
+
+    def size(self, name):
+        blob = self.bucket.get_blob(self._key(name))
+        return blob.size if blob is not None else None
+
+    def uri(self, name):
+        return f'gs://{self.bucket_name}/{self._key(name)}'
+
+    def _key(self, name):
+        return f'{self.prefix}/{name}' if self.prefix else name
+
+
+def create_backend(uri: str) -> StorageBackend:
+    """gs://bucket/prefix or local directory"""
+    if uri.startswith('gs://'):
+        bucket_name, _, prefix = uri[len('gs://'):].partition('/')
+        return GCSBackend(bucket_name, prefix)
+    return LocalBackend(Path(uri))
+
+
+class Uploader:
+    """Uploads files in background threads while dataset is being built.
+    submit blocks when max_pending uploads are queued, so finished files are pushed as fast as
+    backend allows without unbounded queue. Files are uploaded as is, audio is already compressed.
+    close uploads everything left in output, waits and writes manifest of all uploaded files"""
+
+    def __init__(self, backend: StorageBackend, workers: int = 8, max_pending: int = None, attempts: int = 3):
+        self.backend = backend
+        self.workers = workers
+        self.attempts = attempts
+        self.uploaded: Dict[str, int] = {}
+        self.failed: Dict[str, str] = {}
+        self._submitted = set()
+        self._slots = threading.Semaphore(max_pending or 4 * workers)
+        self._lock = threading.Lock()
+        self._pool = ThreadPool(workers)
+
+    def submit(self, local_path: Path, name: str) -> None:
+        if name in self._submitted:
+            return
+        self._submitted.add(name)
+        self._slots.acquire()
+        self._pool.apply_async(self._upload, (local_path, name))
+
+    def sync(self, root: Path) -> None:
+        """Submits all files under root which were not submitted yet, named by path relative to root"""
+        for local_path in sorted(root.rglob('*')):
+            if local_path.is_file() and not local_path.name.endswith('.tmp'):
+                self.submit(local_path, local_path.relative_to(root).as_posix())
+
+    def close(self, root: Path = None) -> str:
+        """Returns uri of manifest"""
+        if root is not None:
+            self.sync(root)
+        self._pool.close()
+        self._pool.join()
+        if self.failed:
+            raise RuntimeError(f'Failed to upload {len(self.failed)} files: {list(self.failed.items())[:10]}')
+        manifest = dict(created=time.time(), files=[dict(name=name, size=size)
+                                                    for name, size in sorted(self.uploaded.items())])
+        self.backend.write_text(MANIFEST_NAME, json.dumps(manifest, indent=1))
+        log.info(f'Uploaded {len(self.uploaded)} files, {sum(self.uploaded.values()) / 2 ** 30:.2f} GB, '
+                 f'manifest {self.backend.uri(MANIFEST_NAME)}')
+        return self.backend.uri(MANIFEST_NAME)
+
+    def _upload(self, local_path: Path, name: str) -> None:
+        try:
+            size = local_path.stat().st_size
+            for attempt in range(1, self.attempts + 1):
+                try:
+                    if self.backend.size(name) != size:  # already uploaded by interrupted run
+                        self.backend.upload(local_path, name)
+                    break
+                except Exception as e:
+                    if attempt == self.attempts:
+                        raise
+                    log.warning(f'Retrying upload of {name} after {e!r}')
+                    time.sleep(2 ** attempt)
+            with self._lock:
+                self.uploaded[name] = size
+        except Exception as e:
+            log.exception(f'Got exception while uploading {local_path}')
+            with self._lock:
+                self.failed[name] = repr(e)
+        finally:
+            self._slots.release()
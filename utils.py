@@ -5,8 +5,12 @@ import random
 import logging
 from pathlib import Path
 import tarfile
+from typing import Iterator
 
-import cache
+import numpy as np
+
+import metrics
+from content_store import file_digest
 
 log = logging.getLogger(__name__)
 
@@ -78,19 +82,55 @@ def start_debug(port=55555):
         # log.warning(msg)
 
 
-@cache.cache
-def convert(file_path, extension, samplerate=16000):
-    path = Path(f'/tmp/cprc/coverted/')
-    path.mkdir(exist_ok=True, parents=True)
+def converted_path(file_path, extension):
+    """Named by content digest of file, so identical audio downloaded under different urls is converted once"""
+    return Path('/tmp/cprc/coverted/') / f'{file_digest(file_path)}{extension}'
 
-    hash = cache.hash(file_path)
-    tmp_file_name = path / f'{hash}{extension}'
 
-    cmd = f'ffmpeg -i "{file_path}" -vn -ac 1 -sample_fmt s16 -ar {samplerate} "{tmp_file_name}"'
-    run(cmd)
+def convert(file_path, extension, samplerate=16000):
+    """Converts file to mono 16bit audio, existing output is reused.
+    Output is written under temporary name first, so evicted or interrupted conversions are never reused"""
+    tmp_file_name = converted_path(file_path, extension)
+    hit = tmp_file_name.exists()
+    metrics.inc('cache_total', cache='converted', result='hit' if hit else 'miss')
+    if hit:
+        return tmp_file_name
+    tmp_file_name.parent.mkdir(exist_ok=True, parents=True)
+
+    part_file_name = tmp_file_name.with_name(f'{tmp_file_name.stem}.part{extension}')
+    cmd = f'ffmpeg -y -i "{file_path}" -vn -ac 1 -sample_fmt s16 -ar {samplerate} "{part_file_name}"'
+    with metrics.timer('convert'):
+        run(cmd)
+    part_file_name.rename(tmp_file_name)
+    metrics.inc('bytes_total', tmp_file_name.stat().st_size, kind='converted')
     return tmp_file_name
 
 
+def decode_stream(file_path, samplerate=16000, chunk_duration=0.5) -> Iterator[np.ndarray]:
+    """Decodes file with ffmpeg to mono 16bit PCM and yields it in chunks of chunk_duration seconds.
+    Nothing is written to disk"""
+    cmd = ['ffmpeg', '-nostdin', '-nostats', '-loglevel', 'error', '-i', str(file_path),
+           '-vn', '-ac', '1', '-ar', str(samplerate), '-f', 's16le', '-acodec', 'pcm_s16le', '-']
+    log.debug(f'Executing: {cmd}')
+    chunk_bytes = int(samplerate * chunk_duration) * 2
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        while True:
+            data = proc.stdout.read(chunk_bytes)
+            if not data:
+                break
+            yield np.frombuffer(data[:len(data) // 2 * 2], dtype=np.int16)
+        stderr = proc.stderr.read().decode('utf-8', errors='replace')
+        if proc.wait():
+            raise subprocess.CalledProcessError(proc.returncode, cmd, stderr=stderr)
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+        proc.stdout.close()
+        proc.stderr.close()
+
+
 def add_ffmpeg_to_path():
     # making ffmpeg accesible for pydub an utils.convert
     # TODO: Resolve path if called in genrule as binary param
@@ -1,19 +1,41 @@
+import io
 import logging
 import os
 import re
 import shutil
 import socket
+import time
 from abc import ABC, abstractmethod
-# from multiprocessing.pool import Pool
-from multiprocessing.dummy import Pool
-
-import sox
-from typing import Dict, Iterable, Tuple, Generator, List
+from functools import partial
+from multiprocessing.dummy import Pool as ThreadPool
+from typing import Callable, Dict, Iterable, Tuple, Generator, List, Optional
 from pathlib import Path
+
+import numpy as np
+import soundfile
+
+import executors
+import features
+import metrics
+import planner
+import schedule
+import throttle
 import utils
+from shards import ShardReader, ShardWriter, line_samples, sample_key
+from artifacts import ArtifactStore
+from content_store import ContentStore, content_entry, file_digest, params_digest
+from throttle import deferred
+from manifest import Manifest, lines_duration
+from work_queue import Heartbeat, QueueBackend, claimed_items, worker_id
+from segmenter import Segmenter, load_pcm, segment, to_mono, with_features
+from silence import SilenceFilter
+from transcript import TranscriptWriter
+from uploader import Uploader
 
 log = logging.getLogger(__name__)
 
+STAGES = ('fetch', 'convert')
+
 
 def new_work_path() -> Path:
     """Create work path and return it"""
@@ -38,10 +60,11 @@ class WorkBase(ABC):
     """This class contains all base dataset preprocessing logic.
     Preprocessing consists of following stages:
     1. Collect pairs of audio/text files and return them via _files_generator method(implement it in subclass).
-    2. For each pair call process method(implement it in subclass).
+    2. For each pair call fetch and process methods(implement _fetch and _process in subclass).
         It should split input audio file into samples and save them to output/audio dir
         It also should create and return pair of temporary transcript.lst and text.txt files
-    3. Merge above temporary files into output/transcript.lst output/text.txt files
+    3. Append returned lines to output/transcript.lst output/text.txt files as soon as items are processed.
+    4. Write output/transcript_sorted.lst and output/buckets.json with samples sorted and bucketed by duration.
 
     transcript.lst contents example:
         14_1channel.ogg.000012727-000013727.flac audio/14_1channel.ogg.000012727-000013727.flac 1.00 right
@@ -55,47 +78,335 @@ class WorkBase(ABC):
 
     """
 
-    def __init__(self, work_path: Path, dataset_path: Path, dataset: str, platform: str, workers:int = os.cpu_count()) -> None:
+    def __init__(self, work_path: Path, dataset_path: Path, dataset: str, platform: str, workers:int = os.cpu_count(),
+                 silence_statistic: str = 'rms', silence_threshold: float = 0.01,
+                 executor: str = 'thread', io_workers: int = None, cpu_workers: int = None,
+                 max_inflight: int = None, resume: bool = False,
+                 cache_budget: int = None, cache_max_age: float = None, stream_audio: bool = False,
+                 queue: QueueBackend = None, lease: float = 600.0, packed: bool = False,
+                 shard_size: int = 256 * 2 ** 20, uploader: Uploader = None, export_metrics: bool = False,
+                 progress_interval: float = 60.0, dedup: bool = True, requeue: throttle.Requeue = None,
+                 features: features.LogMel = None, order: str = 'file') -> None:
         self.dataset_path = dataset_path
         self.work_path = work_path
+        self.metrics_path = work_path if export_metrics else None
+        self.progress_interval = progress_interval
+        self.total_items = None  # could be set by _files_generator once items are known, used for ETA
         self.output_path = Path().cwd() / dataset
-        if self.output_path.exists():
-            shutil.rmtree(str(self.output_path))
+        self.resume = resume
+        self.manifest = Manifest(self.work_path / 'manifest.sqlite')
+        self.artifacts = ArtifactStore(budget=cache_budget, max_age=cache_max_age)
+        self.content = ContentStore(Path('/tmp/cprc/content.sqlite')) if dedup else None
         self.output_audio_path = self.output_path / 'audio'
-        self.output_audio_path.mkdir(parents=True, exist_ok=True)
+        self.shards_path = self.output_path / 'shards'
+        self.features_path = self.output_path / 'features'
+        self.packed = packed
+        self.shard_size = shard_size
+        self.segmenter = Segmenter(self.output_audio_path,
+                                   silence_filter=SilenceFilter(silence_statistic, silence_threshold), packed=packed,
+                                   features=features)
+        self.stream_audio = stream_audio
+        self.queue = queue
+        self.lease = lease
+        self.requeue = requeue if requeue is not None else throttle.Requeue()
+        if order not in schedule.ORDERS:
+            raise ValueError(f'Unknown order {order}, expected one of {schedule.ORDERS}')
+        self.order = order
+        self.uploader = uploader
+        self.manifest_uri = None
         self.platform = platform
         self.workers = workers
+        metrics.configure(self.metrics_path)
+        self.executor = executors.create(executor, workers=workers, io_workers=io_workers, cpu_workers=cpu_workers,
+                                         max_inflight=max_inflight)
         socket.setdefaulttimeout(30)
 
+    def __getstate__(self):
+        # process workers get pickled copy, uploader threads and locks and executor pools stay in main process
+        state = self.__dict__.copy()
+        state['uploader'] = None
+        state['executor'] = None
+        return state
+
     def run(self) -> None:
-        """Run dataset preprocessing"""
+        """Run dataset preprocessing.
+        Executor decides where fetch and process run: threads, processes or I/O threads feeding CPU processes,
+        at most max_inflight items are submitted at once, so memory does not grow with playlist size.
+        Progress of each item is recorded in work_path/manifest.sqlite. With resume=True output is kept,
+        finished items are skipped, failed ones are retried and transcripts are rebuilt from the manifest.
+        With queue given, the first host adds items to the shared queue and workers of all hosts running with it
+        claim them with leases, each host writes its own output.
+        With packed=True samples are streamed into size bounded tar shards in output/shards, see shards.ShardWriter.
+        With features given, features of samples are streamed into float16 shards in output/features,
+        see features.FeatureWriter, output/features/index.lst locates features of each transcript.lst line.
+        With uploader given, samples or finalized shards are uploaded while processing goes on, the rest of output
+        at the end, manifest_uri is set to uri of uploaded files manifest.
+        With export_metrics=True metrics are exported to work_path/metrics.json and work_path/metrics.prom,
+        progress line with ETA is logged every progress_interval seconds anyway"""
+        if not self.resume:
+            self._clear_output()
+        if not self.packed:
+            self.output_audio_path.mkdir(parents=True, exist_ok=True)
+        finished = self._finished() if self.resume else set()
+        log.info(f'Skipping {len(finished)} finished items')
+        seeded = self.queue is not None and self.queue.seeded()
+        items = self._pending_items(finished) if not seeded else ()
+        if self.order == 'lpt' and not seeded:
+            items = self._longest_first(list(items))
+        progress = metrics.Progress(self.progress_interval, total=lambda: self._total_items(progress, len(finished)))
+        heartbeat = None
+        if self.queue is not None:
+            if not seeded:
+                # items are stored as generated, other hosts do not generate them again,
+                # data which expires is attached by _dispatched after claiming
+                added = self.queue.add(items, key=lambda item: self._item_key(*item))
+                self.queue.mark_seeded()
+                log.info(f'Added {added} items to queue {self.queue.stats()}')
+            heartbeat = Heartbeat(self.queue, worker_id(), self.lease)
+            heartbeat.start()
+            # items are claimed as workers get free, so hosts with idle workers get their share
+            claimed = claimed_items(self.queue, heartbeat.worker, self.lease, batch=self.workers,
+                                    poll_interval=min(10.0, self.lease / 3))
+            items = (self._claimed_item(*item) for item in claimed)
+        shard_writer = ShardWriter(self.shards_path, self.shard_size, on_finalize=self._shard_finalized) \
+            if self.packed else None
+        feature_writer = features.FeatureWriter(self.features_path, self.segmenter.features.config(),
+                                                self.shard_size, on_finalize=self._shard_finalized) \
+            if self.segmenter.features is not None else None
+        items = progress.track(self._dispatched(items))
+        try:
+            with TranscriptWriter(self.output_path, mode='w') as writer:
+                for key, lines in self.manifest.items() if self.resume else ():
+                    if key in finished:
+                        writer.write(lines)
+                for lines in self._retried(partial(self.executor.imap_unordered, self), items):
+                    if isinstance(lines, deferred):
+                        self._failed(lines.key, lines.error)
+                        lines = []
+                    progress.update(lines_duration(lines) / 1000)
+                    if feature_writer is not None:
+                        feature_writer.write(features.line_features(lines))
+                    if shard_writer is not None:
+                        shard_writer.write(line_samples(lines))
+                    elif self.uploader is not None:
+                        for transcript, *_ in lines:
+                            name = transcript.split(' ', 1)[0]
+                            self.uploader.submit(self.output_audio_path / name, f'audio/{name}')
+                    writer.write([line[:2] for line in lines])
+                    self.artifacts.maybe_evict()
+            if shard_writer is not None:
+                shard_writer.finalize()
+            if feature_writer is not None:
+                feature_writer.finalize()
+        finally:
+            if heartbeat is not None:
+                heartbeat.stop()
+        self.artifacts.evict()
+        planner.write_sorted_manifest(self.output_path)
+        if feature_writer is not None:
+            features.write_index(self.output_path)
+        if self.uploader is not None:
+            self.manifest_uri = self.uploader.close(self.output_path)
+        progress.report()
+        if self.content is not None:
+            log.info(f'Dedup {self.content.stats()}')
+        log.info(f'Finished {self.manifest.stats()}')
 
-        def cb(exc):
-            log.error(exc)
-            # executor.terminate()
+    def run_stage(self, stage: str) -> None:
+        """Runs only fetch or fetch and convert stages of all items in threads.
+        Results stay in download/convert caches, where next stages find them. Manifest and output are not touched"""
+        if stage not in STAGES:
+            raise ValueError(f'Unknown stage {stage}, expected one of {STAGES}')
+        succeeded = failed = 0
+        with ThreadPool(self.workers) as pool:
+            imap = partial(executors.bounded_imap_unordered, pool, partial(self._run_stage_item, stage),
+                           limit=2 * self.workers)
+            items = self._longest_first(list(self._items())) if self.order == 'lpt' else self._items()
+            for ok in self._retried(imap, self._dispatched(items)):
+                ok = ok is True
+                succeeded += ok
+                failed += not ok
+                self.artifacts.maybe_evict()
+        self.artifacts.evict()
+        log.info(f'Finished {stage} stage: {succeeded} items succeeded, {failed} failed')
 
-        results = []
-        with Pool(self.workers) as executor:
-            for item in self._files_generator():
-                item = item if isinstance(item, tuple) else (item,)  # _files_generator can return tuple or single item
-                result = executor.apply_async(self.process, args=item, error_callback=cb)
-                results.append(result)
-            executor.close()
-            executor.join()
-
-        log.info('Merging results')
-        # transcript_path = self.output_path / 'transcript.lst'
-        # text_path = self.output_path / 'text.txt'
-        # with transcript_path.open('w') as transcript_fp, text_path.open('w') as text_fp:
-        #     for result in results:
-        #         try:
-        #             lines = result.get(timeout=5*60)
-        #             for fields in lines:
-        #                 transcript_fp.write(fields[0])
-        #                 text_fp.write(fields[1])
-        #         except Exception:
-        #             log.exception(f'Got exception while processing result')
-        log.info('Finished')
+    def _run_stage_item(self, stage: str, item: tuple):
+        try:
+            fetched = self._fetch(*item)
+            if fetched is None:
+                return False
+            try:
+                if stage == 'convert':
+                    self._convert(*fetched)
+            finally:
+                self._release(*fetched)
+            return True
+        except Exception as e:
+            if throttle.is_transient(e):
+                return deferred(self._item_key(*item), item, repr(e))
+            log.exception(f'Got exception while running {stage} stage of {item}')
+            return False
+
+    def _retried(self, imap: Callable[[Iterable], Iterable], items: Iterable[tuple]) -> Iterable:
+        """Results of imap over items. Deferred items are put back among items once their delay passes,
+        items still deferred when items are exhausted are run again in following rounds.
+        Deferred items which failed too many times are yielded as they are"""
+        while True:
+            for result in imap(self.requeue.merge(items)):
+                if not isinstance(result, deferred):
+                    yield result
+                elif self.requeue.defer(result.key, result.item):
+                    log.warning(f'Requeued {result.key} after {result.error}, {len(self.requeue)} items deferred')
+                else:
+                    log.error(f'Giving up {result.key} after {self.requeue.attempts} transient failures')
+                    yield result
+            if not len(self.requeue):
+                return
+            items = self.requeue.wait()
+
+    def plan(self, speed: float = 25.0, overhead: float = 10.0, workers: Iterable[int] = None) -> dict:
+        """Dry run: logs audio hours of items left to process and estimated wall time of processing them
+        in file order and longest first with each of workers counts, half, configured and double number
+        of workers by default. Nothing is processed and output is not touched.
+        speed - audio seconds one worker processes per second, overhead - seconds per item (download etc.)"""
+        finished = self._finished() if self.resume else set()
+        items = list(self._pending_items(finished))
+        durations = self._durations(items)
+        result = schedule.summary(durations)
+        log.info(f'Plan: {result["items"]} items ({result["unknown"]} of unknown duration), '
+                 f'{result["audio_hours"]:.1f} audio h, longest {result["longest_hours"]:.2f} h')
+        if workers is None:
+            configured = getattr(self.executor, 'cpu_workers', self.workers)  # pipeline processes in cpu workers
+            workers = sorted({max(configured // 2, 1), configured, 2 * configured})
+        result['estimates'] = [schedule.estimate(durations, count, speed, overhead) for count in workers]
+        for estimate in result['estimates']:
+            log.info(f'Plan: {estimate["workers"]} workers, file order {estimate["file_order_hours"]:.2f} h, '
+                     f'longest first {estimate["lpt_hours"]:.2f} h, lower bound {estimate["lower_bound_hours"]:.2f} h, '
+                     f'speedup {estimate["speedup"]:.2f}x')
+        return result
+
+    def _clear_output(self) -> None:
+        """Output is rebuilt from scratch, samples of previous run are not reused by dedup either"""
+        if self.output_path.exists():
+            shutil.rmtree(str(self.output_path))
+        if self.content is not None:
+            self.content.forget(self.output_path)
+
+    def _pending_items(self, finished: set) -> Iterable[tuple]:
+        return (item for item in self._items() if self._item_key(*item) not in finished)
+
+    def _longest_first(self, items: List[tuple]) -> List[tuple]:
+        """Items ordered longest first by _durations for order='lpt', so long items do not keep a single worker
+        busy at the end of the run. plan() estimates the gain without processing anything"""
+        durations = self._durations(items)
+        log.info(f'Ordered {len(items)} items longest first, '
+                 f'{sum(d is None for d in durations)} of unknown duration are put in the middle')
+        return schedule.lpt_order(items, durations)
+
+    def _durations(self, items: List[tuple]) -> List[Optional[float]]:
+        """Audio durations of items in seconds, None where unknown. Should be cheap: metadata caches,
+        batched metadata requests. Could be implemented in subclasses"""
+        return [None] * len(items)
+
+    def _items(self) -> Iterable[tuple]:
+        # _files_generator can return tuple or single item
+        return (item if isinstance(item, tuple) else (item,) for item in self._files_generator())
+
+    def _finished(self) -> set:
+        """Keys of finished items. In packed mode samples of unfinalized shards are lost on interruption,
+        so items are finished only when all their samples are in finalized shards. The same holds for features"""
+        readers = []
+        if self.packed:
+            readers.append(ShardReader(self.shards_path) if self.shards_path.exists() else ())
+        if self.segmenter.features is not None:
+            readers.append(features.FeatureReader(self.features_path)
+                           if (self.features_path / 'config.json').exists() else ())
+        if not readers:
+            return self.manifest.keys()
+        return {key for key, lines in self.manifest.items()
+                if all(sample_key(transcript) in reader for transcript, _ in lines for reader in readers)}
+
+    def _total_items(self, progress: metrics.Progress, skipped: int):
+        """Number of items to process in this run, None while unknown"""
+        if self.queue is not None:
+            unfinished = self.queue.unfinished()
+            metrics.set_gauge('queue_depth', unfinished, queue='work')
+            return progress.items + unfinished
+        return self.total_items and max(self.total_items - skipped, 0)
+
+    def _shard_finalized(self, shard_path: Path) -> None:
+        """Called for each finalized samples or features shard, could be overridden to start more downstream
+        steps early"""
+        if self.uploader is not None:
+            for path in (shard_path.with_suffix('.idx'), shard_path):
+                self.uploader.submit(path, f'{shard_path.parent.name}/{path.name}')
+
+    def run_item(self, item: tuple) -> list:
+        """Fetch and process single item in current worker"""
+        fetched = self.fetch(item)
+        if fetched is None:
+            return []
+        if isinstance(fetched, deferred):
+            return fetched
+        return self.process_item(fetched)
+
+    def fetch(self, item: tuple):
+        """Returns arguments tuple for process, None if item should be skipped
+        or deferred if it failed with transient error and should be retried later"""
+        metrics.configure(self.metrics_path)  # no-op unless called in new worker process
+        key = self._item_key(*item)
+        try:
+            with metrics.timer('fetch'):
+                fetched = self._fetch(*item)
+        except Exception as e:
+            if throttle.is_transient(e):
+                return self._deferred(key, item, repr(e))
+            log.exception(f'Got exception while fetching {item}')
+            self._failed(key, repr(e))
+            return None
+        if fetched is None:
+            self._failed(key, 'skipped by fetch')
+        return fetched
+
+    def _deferred(self, key: str, item: tuple, error: str) -> Optional[deferred]:
+        """Items failed to fetch with transient errors (throttling, timeouts) are retried with delay.
+        Queue items are returned to the queue right away, until they are claimed max_attempts times,
+        others are deferred by main process, until they fail requeue.attempts times"""
+        log.warning(f'Got transient error while fetching {item}: {error}')
+        if self.queue is None:
+            return deferred(key, item, error)
+        self.manifest.failed(key, error)
+        # requeue of process worker is a pickled copy, failures are counted by the queue as attempts
+        self.queue.fail(key, error, delay=self.requeue.delay_after(self.queue.attempts(key)))
+        metrics.inc('retries_total')
+        metrics.flush()
+        return None
+
+    def process_item(self, item: tuple) -> list:
+        metrics.configure(self.metrics_path)
+        key = self._item_key(*item)
+        try:
+            with metrics.timer('process'):
+                lines = self.process(*item)
+        except Exception as e:
+            self._failed(key, repr(e))
+            return []
+        # packed audio is written to shards by main process, manifest keeps transcript lines only
+        self.manifest.done(key, [line[:2] for line in lines])
+        if self.queue is not None:
+            self.queue.complete(key, [line[:2] for line in lines])
+        metrics.inc('items_total', status='done')
+        metrics.inc('audio_seconds_total', lines_duration(lines) / 1000)
+        metrics.flush()
+        return lines
+
+    def _failed(self, key: str, error: str) -> None:
+        self.manifest.failed(key, error)
+        if self.queue is not None:
+            self.queue.fail(key, error)
+        metrics.inc('items_total', status='failed')
+        metrics.inc('failures_total', reason=metrics.failure_reason(error))
+        metrics.flush()
 
     def process(self, *args, **kwargs):
         try:
@@ -105,61 +416,146 @@ class WorkBase(ABC):
             raise
 
     def _process_allignment(self, alignment):
+        return self._process_allignments([alignment])
+
+    def _process_allignments(self, alignments: Iterable) -> List[Tuple[str, str]]:
+        """Cuts word aligned audio files at words starting 20 s after previous cut, see planner.alignment_cuts.
+        Cut points are computed on arrays of word starts, duration is taken from decoded audio
+        and each file is decoded once"""
+        results = []
+        for alignment in alignments:
+            audio_path = alignment.get_audio_file()
+            if alignment.get_wer() >= 90:
+                log.error(f'WER {alignment.get_wer()} for {audio_path}')
+                continue
+            words = list(alignment.get_words())  # could be any iterable, it was only iterated once
+            texts = [word.get_word() for word in words]
+            starts = np.fromiter((word.get_start() or 0 for word in words), dtype=np.int64, count=len(words))
+            with metrics.timer('decode'):
+                pcm, samplerate = load_pcm(audio_path, mmap_threshold=self.segmenter.mmap_threshold)
+            audio_duration = len(pcm) * 1000 // samplerate
+            firsts, stops, seg_starts, seg_ends = planner.alignment_cuts(starts, audio_duration)
+            segments = [segment(int(start), int(end), ' '.join(texts[first:stop]))
+                        for first, stop, start, end in zip(firsts, stops, seg_starts, seg_ends)]
+            accum_duration = self.segmenter.write_pcm(audio_path.name, pcm, samplerate, segments, results)
+            if accum_duration != audio_duration:
+                log.error(f'Accum duration and audio duration missmatch {accum_duration}!={audio_duration}')
+            log.info(f'Processed {audio_path}: {len(words)} words, {len(segments)} segments')
+        return results
+
+    def _deduplicated(self, key: str, audio_path: Path, process: Callable[[], list],
+                      poll_interval: float = 5.0) -> list:
+        """Runs process, unless audio with the same content was already segmented with the same parameters
+        by another item. Then samples of that item are reused: nothing is added when they are in this output
+        already, they are copied when they are in output of other dataset.
+        When other item is segmenting the same content right now, waits for it, unless its worker is gone"""
+        if self.content is None:
+            return process()
+        content_key = f'{file_digest(audio_path)}:{params_digest(self._segmentation_params())}'
+        while True:
+            entry = self.content.claim(content_key, key, self.output_path)
+            if entry is None:
+                break
+            if entry.lines is None:
+                time.sleep(poll_interval)
+                continue
+            lines = self._reuse(entry) if entry.item_key != key else None
+            if lines is not None:
+                duration = lines_duration(entry.lines)
+                if entry.output_path != self.output_path:
+                    # following duplicates in this output refer to the copies
+                    self.content.put(content_key, key, self.output_path, lines, duration)
+                self.content.reused(content_key, duration)
+                metrics.inc('dedup_total', result='hit')
+                metrics.inc('dedup_seconds_total', duration / 1000)
+                log.info(f'{key} has the same audio as {entry.item_key}, reused {len(entry.lines)} samples')
+                return lines
+            self.content.claim(content_key, key, self.output_path, force=True)
+            break
+        metrics.inc('dedup_total', result='miss')
+        try:
+            lines = process()
+        except BaseException:
+            self.content.unclaim(content_key, key)
+            raise
+        self.content.put(content_key, key, self.output_path, lines, lines_duration(lines))
+        return lines
+
+    def _reuse(self, entry: content_entry) -> Optional[list]:
+        """Lines of entry samples for this output, None if samples are gone.
+        Features are computed from copied samples, as they are not kept in content store"""
+        if entry.output_path == self.output_path:
+            return []
         results = []
-        audio_path = alignment.get_audio_file()
-        log.info(f'Processing {audio_path}')
-        audio_duration = sox.file_info.duration(audio_path) * 1000
-        accum_duration = 0
-        if alignment.get_wer() >= 90:
-            log.error(f'WER {alignment.get_wer()} for {audio_path}')
-            return results
-        prev_start = 0
-        current_sample_text = []
-        for alignment_word in alignment.get_words():
-            word = alignment_word.get_word()
-            start = alignment_word.get_start()
-            log.info(f'For {audio_path.name} got word {word} at {start}')
-            if start and start - prev_start > 20 * 1000:
-                # Pad by 200ms, because VAD starting word is generaly in middle of the word
-                start -= 200
-                accum_duration += self._save_part(prev_start, start, audio_path,
-                                                  ' '.join(current_sample_text),
-                                                  results)
-                prev_start = start
-                current_sample_text = []
-            current_sample_text.append(word)
-        if len(current_sample_text) > 0:
-            if audio_duration - prev_start > 20 * 1000:
-                log.error(f'Big last segment: {audio_duration - prev_start}')
+        pcms = []
+        reader = None
+        for transcript, text in entry.lines:
+            name, path, rest = transcript.split(' ', 2)
+            if path.startswith('shards/'):
+                reader = reader or ShardReader(entry.output_path / 'shards')
+                if sample_key(transcript) not in reader:
+                    return None
+                data = reader[sample_key(transcript)]['audio']
+            elif (entry.output_path / path).exists():
+                data = (entry.output_path / path).read_bytes()
             else:
-                accum_duration += self._save_part(prev_start, audio_duration, audio_path,
-                                                  ' '.join(current_sample_text), results)
-        if accum_duration != audio_duration:
-            log.error(f'Accum duration and audio duration missmatch {accum_duration}!={audio_duration}')
-        log.info(f'Processed {audio_path}')
+                return None
+            if self.packed:
+                results.append((f'{name} shards/{name} {rest}', text, data))
+            else:
+                (self.output_audio_path / name).write_bytes(data)
+                results.append((f'{name} audio/{name} {rest}', text))
+            if self.segmenter.features is not None:
+                pcms.append(to_mono(soundfile.read(io.BytesIO(data), dtype='int16', always_2d=True)[0]))
+        if pcms:
+            with metrics.timer('features'):
+                results = with_features(results, self.segmenter.features.batch(pcms))
         return results
 
-    def _save_part(self, start, end, audio_path, text, results):
-        sample_name = re.sub('[^\d-]', '', f'{start}-{end}')
-        sample_name = f'{audio_path.name}-{sample_name}.flac'
-        sample_path = self.output_audio_path / sample_name
-        log.info(f'Saving part: {sample_path.name}')
-        text = re.sub(r'\s+', ' ', text)
-        tfm = sox.Transformer()
-        tfm.trim(start / 1000.0, end / 1000.0)
-        tfm.build(audio_path.as_posix(), sample_path.as_posix())
-
-        duration = (end - start)
-        rms_amp = sox.file_info.stat(str(sample_path))['RMS     amplitude']
-        # Filter out mostly silent samples
-        if rms_amp > 0.01:
-            transcript_result = f'{sample_path.name} audio/{sample_path.name} {duration:.2f} {text} \n'
-            text_result = f'{text}\n'
-            results.append((transcript_result, text_result))
-        else:
-            log.warn(f'Skipped silent file {sample_name} with RMS {rms_amp}')
-            sample_path.unlink()
-        return duration
+    def _segmentation_params(self) -> dict:
+        """Parameters which samples depend on, could be extended in subclasses"""
+        return dict(silence_statistic=self.segmenter.silence_filter.statistic,
+                    silence_threshold=self.segmenter.silence_filter.threshold)
+
+    def _save_parts(self, audio_path: Path, segments: List[segment], results: List[Tuple[str, str]]) -> int:
+        """Decode audio_path once and save all segments, lines of non silent ones are appended to results"""
+        return self.segmenter.write(audio_path, segments, results)
+
+    def _stream_parts(self, audio_path: Path, audio_name: str, segments: List[segment],
+                      results: List[Tuple[str, str]], samplerate: int = 16000) -> int:
+        """Decode audio_path with ffmpeg pipe and save segments as soon as they are decoded,
+        no intermediate converted file is written"""
+        return self.segmenter.write_stream(audio_name, utils.decode_stream(audio_path, samplerate=samplerate),
+                                           samplerate, segments, results)
+
+    def _item_key(self, *args) -> str:
+        """Identifier of item in manifest, could be overridden in subclasses"""
+        return str(args[0])
+
+    def _dispatched(self, items: Iterable[tuple]) -> Iterable[tuple]:
+        """Items right before they are submitted to executor, after ordering and queue claims.
+        Could be overridden in subclasses to attach data which expires, like signed urls,
+        so it is neither computed long ahead nor stored in queue"""
+        return items
+
+    def _claimed_item(self, *args) -> tuple:
+        """Item claimed from queue, where it is stored as json list. Could be overridden in subclasses
+        to restore types of item fields"""
+        return args
+
+    def _fetch(self, *args) -> tuple:
+        """I/O bound stage, could be implemented in subclasses.
+        Should return arguments for _process or None to skip item"""
+        return args
+
+    def _convert(self, *args) -> None:
+        """Conversion part of _process which could run ahead as separate stage, takes _fetch result.
+        Could be implemented in subclasses"""
+        pass
+
+    def _release(self, *args) -> None:
+        """Releases what _fetch holds for _process, when item is not processed. Could be implemented in subclasses"""
+        pass
 
     @abstractmethod
     def _process(self, audio_path: Path, txt_path: Path) -> Tuple[Path, Path]:
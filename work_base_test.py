@@ -0,0 +1,351 @@
+import json
+import multiprocessing
+import os
+import pickle
+import time
+from collections import namedtuple
+from pathlib import Path
+
+import numpy as np
+import pytest
+import soundfile
+
+from content_store import ContentStore, file_digest, params_digest
+from segmenter import segment
+from shards import ShardReader, ShardWriter, sample_key
+from throttle import Requeue
+from uploader import LocalBackend, Uploader
+from work_base import WorkBase
+from work_queue import SqliteQueueBackend
+
+SAMPLERATE = 16000
+
+
+def tone(seed: int, seconds: float = 2.0) -> np.ndarray:
+    return (np.random.default_rng(seed).standard_normal(int(seconds * SAMPLERATE)) * 3000).astype(np.int16)
+
+
+class ToneWork(WorkBase):
+    """Items are names of synthetic audio files in work_path, each is cut into one second samples.
+    contents maps name to seed of its audio, names with the same seed have identical audio"""
+
+    def __init__(self, *args, contents: dict = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.contents = contents or dict(a=1, b=2, c=3)
+
+    def _files_generator(self):
+        yield from self.contents
+
+    def _process(self, name):
+        audio_path = self.work_path / f'{name}.wav'
+        if not audio_path.exists():
+            soundfile.write(str(audio_path), tone(self.contents[name]), SAMPLERATE)
+        return self._deduplicated(name, audio_path, lambda: self._segment(audio_path))
+
+    def _segment(self, audio_path: Path) -> list:
+        results = []
+        self._save_parts(audio_path, [segment(0, 1000, f'{audio_path.stem} one'),
+                                      segment(1000, 2000, f'{audio_path.stem} two')], results)
+        return results
+
+
+@pytest.fixture
+def root(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+def create(root: Path, work_type: type = ToneWork, **kwargs) -> ToneWork:
+    kwargs = dict(dict(work_path=root / 'work', dataset_path=None, dataset='ds', platform='cpu', workers=2,
+                       dedup=False), **kwargs)
+    kwargs['work_path'].mkdir(parents=True, exist_ok=True)
+    work = work_type(**kwargs)
+    if work.content is not None:
+        work.content = ContentStore(root / 'content.sqlite')  # shared by datasets of one test only
+    return work
+
+
+def transcript(root: Path, dataset: str = 'ds') -> list:
+    return sorted((root / dataset / 'transcript.lst').read_text().splitlines())
+
+
+@pytest.mark.parametrize('executor', ['process', 'pipeline'])
+def test_run_in_processes_with_uploader(root, executor):
+    work = create(root, executor=executor, uploader=Uploader(LocalBackend(root / 'uploaded')))
+    work.run()
+    assert len(transcript(root)) == 6
+    uploaded = {path.relative_to(root / 'uploaded').as_posix() for path in (root / 'uploaded').rglob('*')}
+    assert {'manifest.json', 'transcript.lst', 'audio/a.wav-0-1000.flac'} <= uploaded
+    assert work.manifest_uri.endswith('manifest.json')
+
+
+class FlakyToneWork(ToneWork):
+    """Processing of items named in failing raises"""
+    failing = ()
+
+    def _process(self, name):
+        if name in self.failing:
+            raise RuntimeError(f'{name} failed')
+        return super()._process(name)
+
+
+def processed_items(work: WorkBase) -> list:
+    processed = []
+    original = work.run_item
+    work.run_item = lambda item: processed.append(item[0]) or original(item)
+    return processed
+
+
+def test_resume_skips_finished_and_retries_failed_items(root):
+    work = create(root, FlakyToneWork, contents=dict(a=1, b=2))
+    work.failing = ('b',)
+    work.run()
+    assert sample_names(transcript(root)) == {'a.wav-0-1000.flac', 'a.wav-1000-2000.flac'}
+    modified = (root / 'ds' / 'audio' / 'a.wav-0-1000.flac').stat().st_mtime_ns
+    # c was not processed at all, like items left when run is interrupted
+    work = create(root, FlakyToneWork, contents=dict(a=1, b=2, c=3), resume=True)
+    processed = processed_items(work)
+    work.run()
+    assert sorted(processed) == ['b', 'c']
+    assert len(transcript(root)) == 6 and work.manifest.stats()['done']['items'] == 3
+    assert (root / 'ds' / 'audio' / 'a.wav-0-1000.flac').stat().st_mtime_ns == modified
+
+
+def test_resume_redoes_items_of_unfinalized_shard(root, monkeypatch):
+    finalize = ShardWriter.finalize
+    finalized = []
+
+    def interrupted_finalize(writer):
+        if len(finalized) == 2:
+            raise KeyboardInterrupt()  # killed while third shard is written
+        finalized.append(finalize(writer))
+        return finalized[-1]
+
+    monkeypatch.setattr(ShardWriter, 'finalize', interrupted_finalize)
+    work = create(root, packed=True, shard_size=1, workers=1)
+    with pytest.raises(KeyboardInterrupt):
+        work.run()
+    assert work.manifest.stats()['done']['items'] == 3 and len(ShardReader(root / 'ds' / 'shards')) == 4
+    monkeypatch.setattr(ShardWriter, 'finalize', finalize)
+    work = create(root, packed=True, shard_size=1, workers=1, resume=True)
+    processed = processed_items(work)
+    work.run()
+    assert processed == ['c']
+    reader = ShardReader(root / 'ds' / 'shards')
+    assert len(reader) == 6 and not list((root / 'ds' / 'shards').glob('*.tmp'))
+    assert all(sample_key(line) in reader for line in transcript(root))
+
+
+class TimedToneWork(ToneWork):
+    durations = dict(a=1200.0, b=None, c=2400.0)
+
+    def _durations(self, items):
+        return [self.durations[name] for name, in items]
+
+
+def test_dry_run_keeps_output(root):
+    create(root, dedup=True).run()
+    before = {path: path.read_bytes() for path in (root / 'ds').rglob('*') if path.is_file()}
+    work = create(root, dedup=True)
+    work.plan()
+    assert {path: path.read_bytes() for path in (root / 'ds').rglob('*') if path.is_file()} == before
+    assert work.content.claim(next(iter(work.content.connection.execute('SELECT key FROM contents')))[0],
+                              'other', root / 'other').lines is not None
+
+
+def test_plan_estimates_worker_counts(root):
+    work = create(root, TimedToneWork, workers=4)
+    result = work.plan(speed=1.0, overhead=0.0)
+    assert not (root / 'ds').exists()
+    assert (result['items'], result['unknown'], result['audio_hours']) == (3, 1, 1.5)
+    assert [e['workers'] for e in result['estimates']] == [2, 4, 8]
+    assert all(type(value) in (int, float) for e in result['estimates'] for value in e.values())
+    two = result['estimates'][0]
+    # unknown duration gets median 1800 s, in file order the longest item starts last on worker busy for 1200 s
+    assert (two['file_order_hours'], two['lpt_hours'], two['speedup']) == pytest.approx((1.0, 5 / 6, 1.2))
+
+
+def test_longest_first_order(root):
+    work = create(root, TimedToneWork, order='lpt', workers=1)
+    processed = processed_items(work)
+    work.run()
+    assert processed == ['c', 'b', 'a']
+
+
+def test_run_stage_keeps_output(root):
+    create(root).run()
+    before = transcript(root)
+    create(root).run_stage('fetch')
+    assert transcript(root) == before and (root / 'ds' / 'audio' / 'a.wav-0-1000.flac').exists()
+
+
+class Word(namedtuple('Word', 'word start')):
+    def get_word(self):
+        return self.word
+
+    def get_start(self):
+        return self.start
+
+
+class Alignment(namedtuple('Alignment', 'audio_file words wer')):
+    def get_audio_file(self):
+        return self.audio_file
+
+    def get_words(self):
+        return (Word(*word) for word in self.words)  # only iterable, like words of aligner results
+
+    def get_wer(self):
+        return self.wer
+
+
+def test_alignments_are_cut_at_late_words(root):
+    work = create(root)
+    work.output_audio_path.mkdir(parents=True)
+    audio_path = root / 'a.wav'
+    soundfile.write(str(audio_path), tone(1, seconds=50.0), SAMPLERATE)
+    words = [('one', 0), ('two', 5000), ('three', 21000), ('four', None), ('five', 30000), ('six', 45000)]
+    lines = work._process_allignments([Alignment(audio_path, words, 10), Alignment(audio_path, words, 95)])
+    assert [transcript for transcript, _ in lines] == [
+        'a.wav-0-20800.flac audio/a.wav-0-20800.flac 20800.00 one two \n',
+        'a.wav-20800-44800.flac audio/a.wav-20800-44800.flac 24000.00 three four five \n',
+        'a.wav-44800-50000.flac audio/a.wav-44800-50000.flac 5200.00 six \n']
+
+
+tone_record = namedtuple('tone_record', 'seed')
+
+
+class QueuedToneWork(ToneWork):
+    """Seeds of audio are attached to claimed items like expiring metadata records, processing takes at least
+    delay seconds"""
+    delay = 0.0
+
+    def _files_generator(self):
+        (self.work_path / 'generated').touch()
+        yield from self.contents
+
+    def _dispatched(self, items):
+        return ((name, tone_record(self.contents[name])) for name, in items)
+
+    def _process(self, name, record):
+        assert isinstance(record, tone_record) and record.seed == self.contents[name]
+        time.sleep(self.delay)
+        return super()._process(name)
+
+
+def run_host(root: Path, queue_path: Path, lease: float, delay: float) -> None:
+    root.mkdir()
+    os.chdir(root)
+    work = create(root, QueuedToneWork, contents={name: seed for seed, name in enumerate('abcdef')}, workers=1,
+                  queue=SqliteQueueBackend(queue_path), lease=lease)
+    work.delay = delay
+    work.run()
+
+
+def start_host(root: Path, queue_path: Path, lease: float = 600.0, delay: float = 0.0) -> multiprocessing.Process:
+    host = multiprocessing.Process(target=run_host, args=(root, queue_path, lease, delay))
+    host.start()
+    return host
+
+
+def queue_tasks(queue: SqliteQueueBackend) -> dict:
+    return {key: (status, attempts) for key, status, attempts in
+            queue.connection.execute('SELECT key, status, attempts FROM tasks')}
+
+
+def test_hosts_share_queue(root):
+    queue = SqliteQueueBackend(root / 'queue.sqlite')
+    # leases are kept by heartbeats while items take longer to process
+    first = start_host(root / 'first', queue.path, lease=0.6, delay=0.5)
+    while not queue.seeded():
+        time.sleep(0.05)
+    second = start_host(root / 'second', queue.path, lease=0.6, delay=0.5)
+    for host in (first, second):
+        host.join(60)
+        assert host.exitcode == 0
+    assert queue_tasks(queue) == {name: ('done', 1) for name in 'abcdef'}
+    assert not (root / 'second' / 'work' / 'generated').exists()
+    assert {tuple(json.loads(item)) for item, in queue.connection.execute('SELECT item FROM tasks')} == \
+        {(name,) for name in 'abcdef'}
+    first_lines, second_lines = transcript(root / 'first'), transcript(root / 'second')
+    assert first_lines and second_lines and len(first_lines) + len(second_lines) == 12
+    assert {line.split()[0] for line in first_lines}.isdisjoint(line.split()[0] for line in second_lines)
+
+
+def test_leases_of_dead_worker_are_reclaimed(root):
+    queue = SqliteQueueBackend(root / 'queue.sqlite')
+    queue.add([(name,) for name in 'abcdef'])
+    queue.mark_seeded()
+    assert [task.key for task in queue.claim('dead', lease=0.1, limit=2)] == ['a', 'b']
+    time.sleep(0.2)
+    host = start_host(root / 'host', queue.path, lease=1.5)
+    host.join(60)
+    assert host.exitcode == 0
+    assert queue_tasks(queue) == dict({name: ('done', 1) for name in 'cdef'}, a=('done', 2), b=('done', 2))
+    assert len(transcript(root / 'host')) == 12
+
+
+def test_queue_backoff_grows_in_process_workers(root):
+    queue = SqliteQueueBackend(root / 'queue.sqlite', max_attempts=3)
+    work = create(root, queue=queue, requeue=Requeue(attempts=2, delay=10.0, max_delay=100.0))
+    queue.add([('a',)])
+    for attempt in range(1, 4):
+        assert [task.attempts for task in queue.claim('worker', lease=600.0)] == [attempt]
+        # each transient failure happens in a fresh copy of work, like in process workers
+        pickle.loads(pickle.dumps(work))._deferred('a', ('a',), 'TransientError()')
+        lease_until, = queue.connection.execute('SELECT lease_until FROM tasks').fetchone()
+        assert 5.0 * 2 ** (attempt - 1) <= lease_until - time.time() <= 10.0 * 2 ** (attempt - 1)
+        queue.connection.execute('UPDATE tasks SET lease_until = 0')  # delay passed
+    assert queue_tasks(queue) == dict(a=('failed', 3))
+
+
+def sample_names(lines: list) -> set:
+    return {line.split()[0] for line in lines}
+
+
+def test_identical_audio_is_segmented_once(root):
+    work = create(root, dedup=True, contents=dict(a=1, b=1, c=2))
+    work.run()
+    # a and b have the same audio, the one segmented first contributes samples of both
+    names = sample_names(transcript(root))
+    assert len(names) == 4 and {name.split('.')[0] for name in names} in ({'a', 'c'}, {'b', 'c'})
+    assert work.content.stats()['contents'] == 2 and work.content.stats()['reused'] == 1
+
+
+def test_samples_are_copied_from_other_output(root):
+    create(root, dedup=True, contents=dict(a=1, c=2)).run()
+    other = create(root, dedup=True, dataset='other', contents=dict(d=1))
+    other.run()
+    # d reuses a's samples, copied into its output
+    assert transcript(root, 'other') == [line for line in transcript(root) if line.startswith('a.wav')]
+    assert (root / 'other' / 'audio' / 'a.wav-0-1000.flac').read_bytes() == \
+        (root / 'ds' / 'audio' / 'a.wav-0-1000.flac').read_bytes()
+    # entry points to the copy now, rebuilding first output does not lose it
+    create(root, dedup=True, contents=dict(c=2)).run()
+    create(root, dedup=True, dataset='third', contents=dict(e=1)).run()
+    assert len(transcript(root, 'third')) == 2 and other.content.stats()['reused'] == 2
+
+
+def test_rebuilt_output_forgets_its_samples(root):
+    create(root, dedup=True, contents=dict(a=1)).run()
+    work = create(root, dedup=True, contents=dict(b=1))
+    work.run()
+    # a's samples were deleted with the output, b is segmented again instead of referring to them
+    assert sample_names(transcript(root)) == {'b.wav-0-1000.flac', 'b.wav-1000-2000.flac'}
+    assert work.content.stats()['reused'] == 0
+
+
+def claim_and_die(store: ContentStore, key: str) -> None:
+    store.claim(key, 'killed', Path('/nowhere'))
+
+
+def test_claim_of_killed_run_is_taken_over(root):
+    work = create(root, dedup=True, contents=dict(a=1))
+    work.content.claim_timeout = 30.0
+    soundfile.write(str(root / 'work' / 'a.wav'), tone(1), SAMPLERATE)
+    key = f'{file_digest(root / "work" / "a.wav")}:{params_digest(work._segmentation_params())}'
+    killed = multiprocessing.Process(target=claim_and_die, args=(work.content, key))
+    killed.start()
+    killed.join()
+    start = time.monotonic()
+    work.run()
+    assert time.monotonic() - start < 5 and len(transcript(root)) == 2
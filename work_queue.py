@@ -0,0 +1,196 @@
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import namedtuple
+from pathlib import Path
+from typing import Iterable, Iterator, List
+
+from store import SqliteStore
+
+log = logging.getLogger(__name__)
+
+task = namedtuple('task', 'key item attempts')
+
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+FAILED = 'failed'
+
+
+def worker_id() -> str:
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+class QueueBackend(ABC):
+    """Shared store of tasks processed by workers on several hosts.
+    Worker claims tasks with time limited lease and extends it with heartbeats while processing.
+    Tasks with expired leases are claimable again, so tasks of dead workers are reclaimed automatically.
+    Items are stored as json lists, whole items are stored, so workers need not generate them again"""
+
+    @abstractmethod
+    def add(self, items: Iterable[tuple], key=lambda item: str(item[0])) -> int:
+        """Adds tasks, already known keys are ignored. Returns number of added tasks"""
+        raise NotImplementedError()
+
+    @abstractmethod
+    def seeded(self) -> bool:
+        """True when all items were added by some worker, other workers only claim them"""
+        raise NotImplementedError()
+
+    @abstractmethod
+    def mark_seeded(self) -> None:
+        raise NotImplementedError()
+
+    @abstractmethod
+    def claim(self, worker: str, lease: float, limit: int = 1) -> List[task]:
+        raise NotImplementedError()
+
+    @abstractmethod
+    def heartbeat(self, worker: str, lease: float) -> None:
+        """Extends leases of all tasks held by worker"""
+        raise NotImplementedError()
+
+    @abstractmethod
+    def complete(self, key: str, result) -> None:
+        raise NotImplementedError()
+
+    @abstractmethod
+    def fail(self, key: str, error: str, delay: float = 0.0) -> None:
+        """Task is returned to queue until it fails max_attempts times, it is claimable again after delay seconds"""
+        raise NotImplementedError()
+
+    @abstractmethod
+    def attempts(self, key: str) -> int:
+        """Number of times task was claimed by workers of all hosts"""
+        raise NotImplementedError()
+
+    @abstractmethod
+    def unfinished(self) -> int:
+        """Number of pending and leased tasks"""
+        raise NotImplementedError()
+
+    @abstractmethod
+    def stats(self) -> dict:
+        raise NotImplementedError()
+
+
+class SqliteQueueBackend(SqliteStore, QueueBackend):
+    """Queue in sqlite db, could be placed on filesystem shared by hosts"""
+    journal_mode = 'DELETE'
+    schema = '''
+        CREATE TABLE IF NOT EXISTS tasks (
+            key TEXT PRIMARY KEY,
+            item TEXT NOT NULL,
+            status TEXT NOT NULL,
+            worker TEXT,
+            lease_until REAL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            result TEXT,
+            error TEXT,
+            updated REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status, lease_until);
+        CREATE TABLE IF NOT EXISTS meta (
+            name TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+    '''
+
+    def __init__(self, path: Path, max_attempts: int = 3, timeout: float = 300.0):
+        super().__init__(path, timeout=timeout)
+        self.max_attempts = max_attempts
+
+    def add(self, items, key=lambda item: str(item[0])):
+        now = time.time()
+        with self.transaction() as connection:
+            before = connection.total_changes
+            connection.executemany(
+                'INSERT OR IGNORE INTO tasks (key, item, status, updated) VALUES (?, ?, ?, ?)',
+                ((key(item), json.dumps(list(item), default=str), PENDING, now) for item in items))
+            return connection.total_changes - before
+
+    def seeded(self):
+        return self.connection.execute("SELECT 1 FROM meta WHERE name = 'seeded'").fetchone() is not None
+
+    def mark_seeded(self):
+        self.connection.execute("INSERT OR REPLACE INTO meta VALUES ('seeded', ?)", (worker_id(),))
+
+    def claim(self, worker, lease, limit=1):
+        now = time.time()
+        with self.transaction() as connection:
+            rows = connection.execute(
+                '''SELECT key, item, attempts FROM tasks
+                   WHERE (status = ? AND COALESCE(lease_until, 0) <= ?) OR (status = ? AND lease_until < ?)
+                   ORDER BY rowid LIMIT ?''', (PENDING, now, LEASED, now, limit)).fetchall()
+            connection.executemany(
+                'UPDATE tasks SET status = ?, worker = ?, lease_until = ?, attempts = attempts + 1, updated = ? '
+                'WHERE key = ?', ((LEASED, worker, now + lease, now, key) for key, _, _ in rows))
+        return [task(key, tuple(json.loads(item)), attempts + 1) for key, item, attempts in rows]
+
+    def heartbeat(self, worker, lease):
+        self.connection.execute('UPDATE tasks SET lease_until = ? WHERE worker = ? AND status = ?',
+                                (time.time() + lease, worker, LEASED))
+
+    def complete(self, key, result):
+        self.connection.execute('UPDATE tasks SET status = ?, result = ?, error = NULL, updated = ? WHERE key = ?',
+                                (DONE, json.dumps(result), time.time(), key))
+
+    def fail(self, key, error, delay=0.0):
+        # lease_until of pending task is the time it becomes claimable
+        now = time.time()
+        self.connection.execute(
+            'UPDATE tasks SET status = CASE WHEN attempts >= ? THEN ? ELSE ? END, lease_until = ?, error = ?, '
+            'updated = ? WHERE key = ?', (self.max_attempts, FAILED, PENDING, now + delay, error, now, key))
+
+    def attempts(self, key):
+        row = self.connection.execute('SELECT attempts FROM tasks WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else 0
+
+    def unfinished(self):
+        count, = self.connection.execute('SELECT COUNT(*) FROM tasks WHERE status IN (?, ?)',
+                                         (PENDING, LEASED)).fetchone()
+        return count
+
+    def stats(self):
+        return dict(self.connection.execute('SELECT status, COUNT(*) FROM tasks GROUP BY status'))
+
+
+class Heartbeat(threading.Thread):
+    """Extends leases of worker every interval seconds until stopped"""
+
+    def __init__(self, backend: QueueBackend, worker: str, lease: float):
+        super().__init__(daemon=True)
+        self.backend = backend
+        self.worker = worker
+        self.lease = lease
+        self.interval = lease / 3
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.backend.heartbeat(self.worker, self.lease)
+            except Exception:
+                log.exception('Got exception while sending heartbeat')
+
+    def stop(self):
+        self._stopped.set()
+
+
+def claimed_items(backend: QueueBackend, worker: str, lease: float, batch: int = 8,
+                  poll_interval: float = 10.0) -> Iterator[tuple]:
+    """Yields items claimed from queue until there are no pending or leased tasks left.
+    When everything left is leased by other workers, polls for expired leases"""
+    while True:
+        tasks = backend.claim(worker, lease, limit=batch)
+        if tasks:
+            for claimed in tasks:
+                yield claimed.item
+        elif backend.unfinished():
+            time.sleep(poll_interval)
+        else:
+            return
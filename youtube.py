@@ -1,3 +1,4 @@
+import itertools
 import logging
 import os
 import re
@@ -5,54 +6,166 @@ from datetime import datetime
 
 
 import utils
-from subtitles import Subtitles
 from work_base import WorkBase, prepare_mapping
+import ingest
+import metrics
+import planner
 from pathlib import Path
-from episode import Episode
+from typing import Tuple
+from episode import EpisodeSource, episode_folder, video_id
+from resolver import MetadataResolver
+from downloader import Downloader
+from throttle import Throttle
 log = logging.getLogger(__name__)
 
 
-import itertools
+class YouTube(WorkBase):
+    def __init__(self, *args, metadata_concurrency: int = None, metadata_batch: int = 256,
+                 download_chunk_size: int = 8 * 1024 * 1024, download_parallelism: int = 4,
+                 min_duration: float = 5.0, target_duration: float = 10.0, max_duration: float = 15.0,
+                 shard: Tuple[int, int] = None, metadata_rate: float = 5.0, download_rate: float = 20.0,
+                 max_connections: int = 16, timed_text: bool = False,
+                 caption_languages: Tuple[str, ...] = ('en', 'en-US', 'en-GB'), auto_captions: bool = False,
+                 record_max_age: float = 3600.0, **kwargs):
+        """metadata_concurrency - resolve metadata of not cached episodes with async resolver in batches
+        of metadata_batch urls as they are dispatched, instead of one pytube request per episode
+        download_chunk_size, download_parallelism - audio streams are downloaded in ranges of that size in parallel
+        min_duration, target_duration, max_duration - samples durations in seconds, see planner.plan_cuts
+        shard - (index, count), process only videos of that hash partition
+        metadata_rate, download_rate - max requests per second of metadata and download stages,
+        max_connections - max in-flight requests of each stage. Both are lowered while YouTube throttles,
+        see throttle.Throttle
+        timed_text - captions are fetched as timed text and parsed in memory, cues are kept in episode cache
+        caption_languages - captions languages in order of preference, auto_captions - fall back to auto-generated
+        captions of these languages
+        record_max_age - records resolved for ordering by durations are used while younger than that, in seconds"""
+        super().__init__(*args, **kwargs)
+        self.metadata_concurrency = metadata_concurrency
+        self.metadata_batch = metadata_batch
+        self.record_max_age = record_max_age
+        self.shard = shard
+        downloader = Downloader(chunk_size=download_chunk_size, parallelism=download_parallelism,
+                                throttle=Throttle('download', rate=download_rate, max_concurrency=max_connections,
+                                                  latency_tolerance=None))
+        self.episodes = EpisodeSource(downloader=downloader, timed_text=timed_text,
+                                      metadata_throttle=Throttle('metadata', rate=metadata_rate,
+                                                                 max_concurrency=max_connections),
+                                      caption_languages=caption_languages, auto_captions=auto_captions)
+        self.durations = dict(min_duration=int(min_duration * 1000), target_duration=int(target_duration * 1000),
+                              max_duration=int(max_duration * 1000))
 
+    def _files_generator(self):
+        with Path(self.dataset_path).open() as fp:
+            urls = ingest.ingest(fp, shard=self.shard)
+        self.total_items = len(urls)
+        self.episodes.preload(urls)
+        yield from urls
 
-def pairwise(iterable):
-    "s -> (s0,s1), (s1,s2), (s2, s3), ..."
-    a, b = itertools.tee(iterable)
-    next(b, None)
-    return zip(a, b)
+    def _dispatched(self, items):
+        """Records resolved ahead by _durations are used while younger than record_max_age. With metadata_concurrency
+        set, records of other not cached episodes are resolved in batches as items are dispatched, stream urls
+        of records expire, so they are not resolved long ahead nor stored in queue.
+        Batches of claimed items are as large as claims, so no more items are held than were claimed"""
+        if not self.metadata_concurrency and not self.episodes.resolved:
+            yield from items
+            return
+        resolver = MetadataResolver(concurrency=self.metadata_concurrency, throttle=self.episodes.metadata_throttle) \
+            if self.metadata_concurrency else None
+        items = iter(items)
+        while True:
+            batch = list(itertools.islice(items, self.workers if self.queue is not None else self.metadata_batch))
+            if not batch:
+                return
+            records = {}
+            for url, *_ in batch:
+                record = self.episodes.take(video_id(url), self.record_max_age)
+                if record is not None:
+                    records[record.video_id] = record
+            missing = [video_id(url) for url, *_ in batch
+                       if video_id(url) not in self.episodes.preloaded and video_id(url) not in records]
+            if resolver is not None and missing:
+                with metrics.timer('resolve'):
+                    records.update(resolver.resolve(missing))
+            for url, *_ in batch:
+                yield url, records.get(video_id(url))
 
+    def _durations(self, items):
+        """Durations of cached episodes, others are resolved now in batches. Only durations order the work,
+        resolved records are kept for _dispatched, so their watch pages are not fetched again"""
+        durations = {}
+        missing = []
+        for url, *_ in items:
+            ep_id = video_id(url)
+            info = self.episodes.preloaded.get(ep_id)
+            if info and info.duration:
+                durations[ep_id] = float(info.duration)
+            elif not (info and info.error):
+                missing.append(ep_id)
+        if missing:
+            resolver = MetadataResolver(concurrency=self.metadata_concurrency or 16,
+                                        throttle=self.episodes.metadata_throttle)
+            for i in range(0, len(missing), self.metadata_batch):
+                with metrics.timer('resolve'):
+                    records = resolver.resolve(missing[i:i + self.metadata_batch])
+                self.episodes.keep(records)
+                durations.update((ep_id, record.duration) for ep_id, record in records.items() if record.duration)
+            log.info(f'Resolved durations of {len(missing)} episodes')
+        return [durations.get(video_id(item[0])) for item in items]
 
-class YouTube(WorkBase):
-    def _files_generator(self):
-        processed_urls = set()
-        with Path(self.dataset_path).open() as fp:
-            for url in fp:
-                if url and url not in processed_urls:
-                    processed_urls.add(url)
-                    yield url.strip('\n')
+    def _fetch(self, url, record=None):
+        folder = episode_folder(video_id(url))
+        self.artifacts.access(folder)
+        self.artifacts.pin(folder)  # before download, so eviction does not remove it in flight, released by _process
+        try:
+            episode = self.episodes.cached(url, record)
+        except BaseException:
+            self.artifacts.release(folder)
+            raise
+        if not episode:
+            self.artifacts.release(folder)
+            return None
+        return url, episode
 
-    def _process(self, url):
+    def _process(self, url, episode=None):
         log.info(f'Processing {url}')
-        episode = Episode.cached(url)
+        episode = episode or self.episodes.cached(url)
         if not episode:
             return []
-        tmp_audio_path = utils.convert(file_path=episode.audio_path, extension='.flac')
+        try:
+            return self._deduplicated(url, episode.audio_path, lambda: self._process_audio(url, episode))
+        finally:
+            self._release(url, episode)
+
+    def _process_audio(self, url, episode):
+        if self.stream_audio:
+            return self._process_episode(url, episode)
+        converted_path = utils.converted_path(episode.audio_path, '.flac')
+        self.artifacts.access(converted_path)
+        with self.artifacts.use(converted_path):
+            return self._process_episode(url, episode)
+
+    def _convert(self, url, episode):
+        if not self.stream_audio:
+            utils.convert(file_path=episode.audio_path, extension='.flac')
+
+    def _release(self, url, episode):
+        self.artifacts.release(episode.audio_path.parent)
+
+    def _segmentation_params(self) -> dict:
+        return dict(super()._segmentation_params(), **self.durations)
 
-        subtitles = Subtitles.from_srt(episode.captions_path)
+    def _process_episode(self, url, episode):
+        subtitles = self.episodes.subtitles(episode)
 
         results = []
-        start = None
-        accum_text = []
-        for line, next_line in pairwise(subtitles.lines):
-            # log.info(f'Processing {line}')
-            if start is None:
-                start = line.start
-            accum_text.append(line.text)
-            if line.end - start > 10 * 1000:
-                self._save_part(start, line.end, tmp_audio_path, ' '.join(accum_text), results)
-                accum_text = []
-                start = next_line.start
+        segments = planner.plan_segments(subtitles, **self.durations)
+        if self.stream_audio:
+            # samples are named the same way as in converted file mode
+            audio_name = utils.converted_path(episode.audio_path, '.flac').name
+            self._stream_parts(episode.audio_path, audio_name, segments, results)
+        else:
+            tmp_audio_path = utils.convert(file_path=episode.audio_path, extension='.flac')
+            self._save_parts(tmp_audio_path, segments, results)
 
         log.info(f'Processed {url}')
         return results
-        # shutil.rmtree(ep_folder, ignore_errors=True)  # remove episode folder and files